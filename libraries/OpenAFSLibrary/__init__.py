@@ -21,6 +21,7 @@
 
 from keywords import *
 from version import VERSION
+from OpenAFSLibrary.util import LibraryListener
 
 __version__ = VERSION
 
@@ -32,7 +33,8 @@ class OpenAFSLibrary(
     _PathKeywords,
     _ACLKeywords,
     _VolumeKeywords,
-    _RxKeywords):
+    _RxKeywords,
+    _MmapKeywords):
     """Robot Framework test library for OpenAFS (preliminary).
 
     `OpenAFSLibrary` provides keywords for basic OpenAFS testing. It
@@ -57,6 +59,10 @@ class OpenAFSLibrary(
     | AFS_DAFS          | Run the DAFS fileserver |
     | AFS_CSDB_DIST     | Pathname of file with extra CellServDB entries |
     | DO_TEARDOWN       | Perform the cell teardown after running the tests |
+    | RUN_BACKEND       | Program execution backend; one of 'subprocess','forkserver' |
+    | SUDO_BACKEND      | Privileged command backend; one of 'sudo','helper' |
+    | AFS_LAZY_LOGOUT   | Keep the token on Logout for the next Login |
+    | AFS_TOKEN_MIN_LIFETIME | Minimum seconds left to reuse a token |
 
     == Kerberos options ==
 
@@ -112,6 +118,7 @@ class OpenAFSLibrary(
     | ASETKEY |   `/usr/afs/bin/asetkey` |
     | BOS     |   `/usr/afs/bin/bos` |
     | FS      |   `/usr/afs/bin/fs` |
+    | PAGSH   |   `/usr/afsws/bin/pagsh` |
     | PTS     |   `/usr/afs/bin/pts` |
     | RXDEBUG |   `/usr/afsws/etc/rxdebug` |
     | TOKENS  |   `/usr/afsws/bin/tokens` |
@@ -129,5 +136,6 @@ class OpenAFSLibrary(
     """
     ROBOT_LIBRARY_SCOPE = 'GLOBAL'
     ROBOT_LIBRARY_VERSION = __version__
+    ROBOT_LIBRARY_LISTENER = LibraryListener()
 
 
@@ -27,6 +27,7 @@ from path import _PathKeywords
 from acl import _ACLKeywords
 from volume import _VolumeKeywords
 from rx import _RxKeywords
+from mmapio import _MmapKeywords
 
 __all__ = [
     '_InstallationKeywords',
@@ -36,5 +37,6 @@ __all__ = [
     '_PathKeywords',
     '_ACLKeywords',
     '_VolumeKeywords',
-    '_RxKeywords'
+    '_RxKeywords',
+    '_MmapKeywords'
 ]
@@ -22,10 +22,48 @@
 import sys
 import os
 import re
+import time
+import random
+import fnmatch
+import threading
 from robot.api import logger
-from OpenAFSLibrary.util import get_var,fs
+from OpenAFSLibrary.util import get_var,fs,fs_lines,run_program,pts,add_command_hook, \
+    add_reset_hook,is_true
+from OpenAFSLibrary.util.parallel import parallel_map, PARALLEL_LIMIT
 
-_RIGHTS = list("rlidwkaABCDEFGH")
+_RIGHTS = "rlidwkaABCDEFGH"
+
+# Each right is a bit of a rights mask, in the standard order.
+_BITS = dict([(r, 1 << i) for i,r in enumerate(_RIGHTS)])
+ALL = (1 << len(_RIGHTS)) - 1
+READ = _BITS['r'] | _BITS['l']
+WRITE = READ | _BITS['i'] | _BITS['d'] | _BITS['w'] | _BITS['k']
+_ALIASES = {'all':ALL, 'none':0, 'read':READ, 'write':WRITE}
+
+# Rights strings by mask, filled on demand.
+_STRINGS = {}
+
+def to_mask(rights):
+    """Returns the rights mask of a string of right characters.
+
+    A exception is thrown for illegal characters. Duplicate
+    characters are silently ignored.
+    """
+    mask = 0
+    for r in rights:
+        bit = _BITS.get(r)
+        if bit is None:
+            raise AssertionError("Illegal rights character: %s" % (r))
+        mask |= bit
+    return mask
+
+def to_string(mask):
+    """Returns the right characters of a rights mask in canonical order."""
+    s = _STRINGS.get(mask)
+    if s is None:
+        s = "".join([r for r in _RIGHTS if mask & _BITS[r]])
+        _STRINGS[mask] = s
+    return s
 
 def normalize(rights):
     """Normalize a list of ACL right characters.
@@ -34,19 +72,10 @@ def normalize(rights):
     thrown for illegal characters. Duplicate characters are silently
     removed.
     """
-    # First, check for illegal chars.
-    for r in rights:
-        if not r in _RIGHTS:
-            raise AssertionError("Illegal rights character: %s" % (r))
-    # Create a set in the standard order.
-    normalized = []
-    for r in _RIGHTS:
-        if r in rights:
-            normalized.append(r)
-    return normalized
+    return list(to_string(to_mask(rights)))
 
 def parse(rights):
-    """ Returns a list string of right chars from a string.
+    """ Returns the sign and rights mask of a rights string.
 
     Unlike the fs commands, the leading char may be a '+'
     or '-' to indicate the type of rights.  Right alias names
@@ -55,27 +84,89 @@ def parse(rights):
     Illegal chars will throw an exception.  Duplicate chars
     are silently removed.
     """
-    sign = '+'            # default is positive rights
-    rights = list(rights) # split into chars
+    sign = '+'  # default is positive rights
 
     # An optional leading '+' or '-' indicates positive
     # or negative rights.
-    if len(rights) >= 0 and rights[0] in ('+', '-'):
+    if rights and rights[0] in ('+', '-'):
         sign = rights[0]
         rights = rights[1:]
 
-    # Convert the aliases to the list of rights bits.
-    w = "".join(rights)
-    if w == "all":
-        rights = _RIGHTS
-    elif w == "none":
-        rights = list()
-    elif w == "read":
-        rights = list("rl")
-    elif w == "write":
-        rights = list("rlidwk")
+    # Convert the aliases to the rights bits.
+    mask = _ALIASES.get(rights)
+    if mask is None:
+        mask = to_mask(rights)
+    return (sign, mask)
+
+class Entry(object):
+    """The positive and negative rights of a name."""
+    __slots__ = ('name', 'pos', 'neg')
+
+    def __init__(self, name, pos=0, neg=0):
+        self.name = name
+        self.pos = pos
+        self.neg = neg
+
+    def __eq__(self, other):
+        return self.pos == other.pos and self.neg == other.neg and self.name == other.name
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __str__(self):
+        if self.neg == 0:
+            return "%s+%s" % (self.name, to_string(self.pos))
+        return "%s+%s-%s" % (self.name, to_string(self.pos), to_string(self.neg))
+
+# Maximum size of the path arguments of one fs command, well under the
+# system argument limit to leave room for the environment.
+ARGS_SIZE = 64 * 1024
+
+def _chunks(paths, size=ARGS_SIZE):
+    """Split a list of paths into lists which fit on a command line."""
+    seen = set()
+    chunk = []
+    total = 0
+    for path in paths:
+        if path in seen:
+            continue
+        seen.add(path)
+        if chunk and total + len(path) + 1 > size:
+            yield chunk
+            chunk = []
+            total = 0
+        chunk.append(path)
+        total += len(path) + 1
+    if chunk:
+        yield chunk
 
-    return (sign, normalize(rights))
+def _parse_listacl(lines):
+    """Yield the path and ACL test object of each directory in fs listacl output."""
+    path = None
+    acl = None
+    section = None
+    for line in lines:
+        if line.startswith("Access list for"):
+            if path is not None:
+                yield (path, acl)
+            path = line.rstrip()[len("Access list for "):-len(" is")]
+            acl = AccessControlList()
+            section = None
+            continue
+        if line.startswith("Normal rights:"):
+            section = "+"
+            continue
+        if line.startswith("Negative rights:"):
+            section = "-"
+            continue
+        m = re.match(r'  (\S+) (\S+)', line)
+        if m:
+            name,rights = (m.group(1),m.group(2))
+            if acl is None or not section in ('+', '-'):
+                raise AssertionError("Failed to parse fs listacl; missing section label")
+            acl.add(name, section + rights)
+    if path is not None:
+        yield (path, acl)
 
 class AccessControlList:
     """ACL rights checking."""
@@ -94,38 +185,38 @@ class AccessControlList:
     @classmethod
     def from_path(cls, path):
         """Read an ACL from AFS directory to create an ACL test object."""
-        if not os.path.exists(path):
-            raise AssertionError("Path does not exist: %s" % (path))
-        if not os.path.isdir(path):
-            raise AssertionError("Path is not a directory: %s" % (path))
-        acl = AccessControlList()
-        section = None
-        output = fs('listacl', path)
-        for line in output.splitlines():
-            if line.startswith("Access list for"):
-                continue
-            if line.startswith("Normal rights:"):
-                section = "+"
-                continue
-            if line.startswith("Negative rights:"):
-                section = "-"
-                continue
-            m = re.match(r'  (\S+) (\S+)', line)
-            if m:
-                name,rights = (m.group(1),m.group(2))
-                if not section in ('+', '-'):
-                    raise AssertionError("Failed to parse fs listacl; missing section label")
-                acl.add(name, section + rights)
-        return acl
+        return cls.from_paths([path])[path]
+
+    @classmethod
+    def from_paths(cls, paths):
+        """Read the ACLs of many AFS directories.
+
+        The ACLs are listed with as few fs listacl commands as possible.
+        Returns a dictionary of ACL test objects by path.
+        """
+        paths = list(paths)
+        for path in paths:
+            if not os.path.exists(path):
+                raise AssertionError("Path does not exist: %s" % (path))
+            if not os.path.isdir(path):
+                raise AssertionError("Path is not a directory: %s" % (path))
+        acls = {}
+        for chunk in _chunks(paths):
+            for path,acl in _parse_listacl(fs_lines('listacl', '-path', *chunk)):
+                acls[path] = acl
+        for path in paths:
+            if path not in acls:
+                raise AssertionError("Failed to parse fs listacl; missing path %s" % (path))
+        return acls
 
     def __init__(self):
         """Create a new empty ACL test object."""
-        self.acls = {}
+        self.acls = {}  # entries by name
 
     def __eq__(self, other):
         """Returns true if ACL test objects have the same entries."""
         if isinstance(other, self.__class__):
-            return self.__str__() == other.__str__()
+            return self.acls == other.acls
         else:
             return False
 
@@ -135,52 +226,261 @@ class AccessControlList:
 
     def __str__(self):
         """Returns a flat string listing all the entries in this ACL test object."""
-        sep = ","
-        items = []
-        for name in sorted(self.acls.keys()):
-            (pos,neg) = self.acls[name]
-            if neg == "":
-                items.append("%s+%s" % (name, pos))
-            else:
-                items.append("%s+%s-%s" % (name, pos, neg))
-        return sep.join(items)
+        return ",".join([str(self.acls[name]) for name in sorted(self.acls.keys())])
 
     def add(self, name, rights):
         """Add an entry."""
-        if name not in self.acls:
-            self.acls[name] = ('','')
-        acl = self.acls[name] # current entry
-        (sign,rights) = parse(rights)
+        (sign,mask) = parse(rights)
+        entry = self.acls.get(name)
+        if entry is None:
+            entry = self.acls[name] = Entry(name)
         # Update the rights.
         if sign == '+':
-            pos = "".join(normalize(rights + list(acl[0])))
-            neg = acl[1]
-        elif sign == '-':
-            pos = acl[0]
-            neg = "".join(normalize(rights + list(acl[1])))
+            entry.pos |= mask
         else:
-            assert "Internal error"
-        if pos == '' and neg == '':
+            entry.neg |= mask
+        if entry.pos == 0 and entry.neg == 0:
             del self.acls[name]  # cleared
-        else:
-            self.acls[name] = (pos, neg)
 
     def contains(self, name, rights):
         """Returns true if an entry exists with a matching name and rights."""
-        if name not in self.acls:
+        entry = self.acls.get(name)
+        if entry is None:
             return False
-        acl = self.acls[name] # current entry
-        (sign,rights) = parse(rights)
-        rights = "%s%s" % (sign, "".join(rights))
+        (sign,mask) = parse(rights)
         if sign == '+':
-            current = "+%s" % acl[0]
-        elif sign == '-':
-            current = "-%s" % acl[1]
+            return entry.pos == mask
         else:
-            assert "Internal error"
-        if rights != current:
-            return False
-        return True
+            return entry.neg == mask
+
+    def diff(self, other):
+        """Returns the differences from this ACL to another ACL.
+
+        Entries only in the other ACL are prefixed with '+', entries
+        missing from the other ACL with '-', and changed entries are
+        shown as 'old => new'.
+        """
+        lines = []
+        for name in sorted(set(self.acls.keys()) | set(other.acls.keys())):
+            a = self.acls.get(name)
+            b = other.acls.get(name)
+            if a is None:
+                lines.append("+%s" % b)
+            elif b is None:
+                lines.append("-%s" % a)
+            elif a != b:
+                lines.append("%s => %s" % (a, b))
+        return lines
+
+# pts subcommands which do not change any users or groups.
+PTS_QUERIES = ('pts membership', 'pts examine', 'pts listentries', 'pts listowned',
+    'pts listmax', 'pts help', 'pts apropos')
+
+class GroupMembership(object):
+    """The groups of each user, from pts membership.
+
+    The groups are looked up once per user and kept until a pts command
+    which may change the users or groups is run, or the next suite or
+    test starts.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.groups = {}
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.groups = {}
+        finally:
+            self.lock.release()
+
+    def command_hook(self, tag, seconds, rc, size):
+        if tag.startswith('sudo '):
+            tag = tag[len('sudo '):]  # run as root with Sudo
+        if tag.startswith('pts ') and tag not in PTS_QUERIES:
+            self.clear()
+
+    def get(self, user):
+        """Returns the set of groups the user is a member of."""
+        groups = self.groups.get(user)
+        if groups is not None:
+            self.hits += 1
+            return groups
+        self.misses += 1
+        groups = set()
+        if user not in ('system:anyuser', 'anonymous'):
+            output = pts('membership', '-nameorid', user)
+            for line in output.splitlines()[1:]:  # skip the 'Groups ... is a member of:' line
+                if line.strip():
+                    groups.add(line.strip())
+        self.lock.acquire()
+        try:
+            self.groups[user] = groups
+        finally:
+            self.lock.release()
+        return groups
+
+_membership = GroupMembership()
+add_command_hook(_membership.command_hook)
+add_reset_hook(_membership.clear)
+
+def effective_rights(acl, user, groups, authenticated=True):
+    """Returns the rights mask a user has from an ACL.
+
+    The rights are the positive rights of the entries for the user, the
+    user's groups, system:anyuser and, when authenticated,
+    system:authuser, less the negative rights of the same entries.
+    Members of system:administrators always have the l and a rights.
+    Host and IP address based rights are not considered.
+    """
+    names = set(groups)
+    names.add('system:anyuser')
+    if authenticated and user not in ('system:anyuser', 'anonymous'):
+        names.add(user)
+        names.add('system:authuser')
+    pos = 0
+    neg = 0
+    for name in names:
+        entry = acl.acls.get(name)
+        if entry is not None:
+            pos |= entry.pos
+            neg |= entry.neg
+    rights = pos & ~neg
+    if 'system:administrators' in names:
+        rights |= _BITS['l'] | _BITS['a']
+    return rights
+
+def _caller_access(paths):
+    """Returns the rights mask of the current token on each path, from the fileserver."""
+    access = {}
+    for chunk in _chunks(paths):
+        for line in fs_lines('getcalleraccess', '-path', *chunk):
+            m = re.match(r'Callers access to (.*) is (\S*)\s*$', line)
+            if m:
+                access[m.group(1)] = to_mask(m.group(2))
+    return access
+
+def _split_acl(acl):
+    """Returns the list of (name, rights) pairs of a list of ACL entries.
+
+    The entries may be given as a string of names and rights, separated by
+    spaces or commas, or as a list of 'name rights' strings.
+    """
+    if acl is None:
+        return []
+    if isinstance(acl, basestring):
+        acl = [acl]
+    words = []
+    for entry in acl:
+        words.extend(entry.replace(",", " ").split())
+    if len(words) % 2:
+        raise AssertionError("Invalid ACL entries: %s" % (" ".join(words)))
+    return [(words[i], words[i+1]) for i in xrange(0, len(words), 2)]
+
+def _literal_length(pattern):
+    """Returns the number of characters of a glob pattern other than wildcards."""
+    return len(re.sub(r'\[[^\]]*\]|[*?]', '', pattern))
+
+class AccessControlSpec(object):
+    """The expected ACLs of the directories in a tree.
+
+    The spec is a list of glob patterns of the directory paths, relative to
+    the top of the tree ('.' is the top directory), each with the expected
+    ACL entries. The first matching pattern is used. The spec may be given
+    as a list of lines of the form '<pattern> <name> <rights> [<name>
+    <rights> ...]', or as a dictionary of patterns to entries. A dictionary
+    has no order, so its patterns are tried most specific first: the
+    patterns with the most characters other than wildcards first, then in
+    alphabetical order.
+    """
+
+    def __init__(self, spec):
+        self.rules = []
+        if isinstance(spec, dict):
+            items = sorted(spec.items(), key=lambda item: (-_literal_length(item[0]), item[0]))
+        else:
+            if isinstance(spec, basestring):
+                spec = spec.splitlines()
+            items = []
+            for line in spec:
+                line = line.strip()
+                if line == "" or line.startswith("#"):
+                    continue
+                parts = line.split(None, 1)
+                items.append((parts[0], parts[1] if len(parts) > 1 else ""))
+        for pattern,entries in items:
+            entries = ["%s %s" % entry for entry in _split_acl(entries)]
+            acl = AccessControlList.from_args(*entries)
+            self.rules.append((pattern, re.compile(fnmatch.translate(pattern)), acl))
+
+    def expected(self, relpath):
+        """Returns the expected ACL of a directory, or None if there is no match."""
+        for pattern,regex,acl in self.rules:
+            if regex.match(relpath):
+                return acl
+        return None
+
+def _windows(items, size):
+    """Yield lists of up to size items from an iterator."""
+    window = []
+    for item in items:
+        window.append(item)
+        if len(window) == size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+def mount_points(paths):
+    """Returns the set of the paths which are mount points.
+
+    The paths are checked with as few fs lsmount commands as possible.
+    """
+    found = set()
+    for chunk in _chunks(paths):
+        # fs lsmount fails when any of the paths is not a mount point.
+        rc,out,err = run_program([get_var('FS'), 'lsmount', '-dir'] + chunk)
+        for line in out.splitlines():
+            m = re.match(r"'(.*)' is a mount point for volume ", line)
+            if m:
+                found.add(m.group(1))
+    return found
+
+def _walk_levels(path, cross_mounts=False):
+    """Yield the directories of a tree, one level at a time.
+
+    Symlinks are not followed. Mount points below the top directory are
+    skipped unless cross_mounts is true; the mount points of each level
+    are found with batched fs lsmount commands.
+    """
+    level = [path]
+    while level:
+        yield level
+        children = []
+        for parent in level:
+            for name in sorted(os.listdir(parent)):
+                child = os.path.join(parent, name)
+                if os.path.isdir(child) and not os.path.islink(child):
+                    children.append(child)
+        if children and not cross_mounts:
+            skip = mount_points(children)
+            children = [c for c in children if c not in skip]
+        level = children
+
+def _walk_dirs(path):
+    """Yield the directories of a tree, top down."""
+    for dirpath,dirnames,filenames in os.walk(path):
+        dirnames.sort()
+        yield dirpath
+
+def _paths(path):
+    """Returns the list of paths of a keyword path argument."""
+    if isinstance(path, basestring):
+        return [path]
+    return list(path)
 
 class _ACLKeywords(object):
     """ACL testing keywords."""
@@ -189,22 +489,226 @@ class _ACLKeywords(object):
         """Add access rights to a path."""
         fs('setacl', '-dir', path, '-acl', name, rights)
 
+    def apply_access_rights_recursively(self, path, acl=None, mode='set', clear=False,
+                                        source=None, cross_mounts=False, limit=None, batch=100):
+        """Apply an ACL to a directory and all of the directories below it.
+
+        The `mode` is one of:
+        | set  | Set the `acl` entries with fs setacl |
+        | copy | Copy the ACL of the `source` directory with fs copyacl |
+
+        The `acl` is a list of name and rights pairs, e.g.
+        `system:anyuser rl user1 rlidwk`, or a list of 'name rights' strings.
+        Rights prefixed with '-' are set as negative rights. When `clear` is
+        true, the existing entries are removed first (fs -clear).
+
+        Several directories are given to each fs command (up to `batch`),
+        and up to `limit` commands are run at the same time. Mount points
+        below `path` are not crossed unless `cross_mounts` is true. Returns
+        the number of directories changed.
+        """
+        if mode not in ('set', 'copy'):
+            raise AssertionError("Invalid mode: %s" % (mode))
+        clear = is_true(clear)
+        batch = int(batch)
+        limit = int(limit) if limit else PARALLEL_LIMIT
+        commands = []
+        if mode == 'copy':
+            if not source:
+                raise AssertionError("A source directory is required to copy an ACL.")
+            command = ['copyacl', '-fromdir', source, '-todir']
+            options = ['-clear'] if clear else []
+            commands.append((command, options))
+        else:
+            pos = []
+            neg = []
+            for name,rights in _split_acl(acl):
+                if rights.startswith('-'):
+                    neg.extend([name, rights[1:]])
+                else:
+                    pos.extend([name, rights.lstrip('+')])
+            if clear and not pos:
+                raise AssertionError("Refusing to clear the ACL without any positive entries.")
+            if pos:
+                options = ['-acl'] + pos
+                if clear:
+                    options.append('-clear')
+                commands.append((['setacl', '-dir'], options))
+            if neg:
+                commands.append((['setacl', '-dir'], ['-acl'] + neg + ['-negative']))
+
+        def apply(dirs):
+            for command,options in commands:
+                fs(*(command + dirs + options))
+
+        count = 0
+        start = time.time()
+        for level in _walk_levels(path, is_true(cross_mounts)):
+            parallel_map(apply, _windows(level, batch), limit=limit)
+            count += len(level)
+        elapsed = time.time() - start
+        logger.info("Applied the ACL to %d directories in %.1f seconds (%.1f directories/sec)" % \
+            (count, elapsed, count / elapsed if elapsed else 0))
+        return count
+
+    def get_effective_rights(self, path, user):
+        """Returns the rights a user has on a directory, computed from the ACL
+        of the directory and the user's groups. See `effective_rights`."""
+        acl = AccessControlList.from_path(path)
+        return to_string(effective_rights(acl, user, _membership.get(user)))
+
+    def effective_rights_should_be(self, path, user, rights):
+        """Fails if the rights of a user on a directory are not the given rights."""
+        self.effective_rights_should_match(["%s %s %s" % (path, user, rights)])
+
+    def effective_rights_should_match(self, checks, sample=0):
+        """Fails if the rights of users on directories are not the expected rights.
+
+        The `checks` is a list of lines of the form '<path> <user> <rights>'.
+        The rights are computed from the ACLs of the directories, which are
+        listed with batched fs listacl commands, and the groups of the users,
+        from pts membership. No login is needed.
+
+        To verify the computed rights, a `sample` number of the checks are
+        cross-checked against the fileserver by running fs getcalleraccess
+        with a token for each sampled user. The tokens are acquired in
+        temporary credential contexts, so the current token is not changed.
+        """
+        if isinstance(checks, basestring):
+            checks = checks.splitlines()
+        parsed = []
+        for line in checks:
+            line = line.strip()
+            if not line:
+                continue
+            parts = line.rsplit(None, 2)
+            if len(parts) != 3:
+                raise AssertionError("Invalid check: %s" % (line))
+            path,user,rights = parts
+            sign,mask = parse(rights)
+            parsed.append((path, user, mask))
+        acls = AccessControlList.from_paths(set([p for p,u,m in parsed]))
+        users = sorted(set([u for p,u,m in parsed]))
+        groups = dict(zip(users, parallel_map(_membership.get, users)))
+        failed = []
+        for path,user,mask in parsed:
+            rights = effective_rights(acls[path], user, groups[user])
+            if rights != mask:
+                failed.append("%s %s: expected %s, got %s" % \
+                    (path, user, to_string(mask), to_string(rights)))
+        logger.info("Checked %d effective rights; pts membership cache: %d hits, %d misses" % \
+            (len(parsed), _membership.hits, _membership.misses))
+        if failed:
+            raise AssertionError("%d of %d rights do not match:\n%s" % \
+                (len(failed), len(parsed), "\n".join(failed)))
+        sample = min(int(sample), len(parsed))
+        if sample:
+            self._cross_check(random.sample(parsed, sample), acls, groups)
+
+    def _cross_check(self, checks, acls, groups):
+        """Compare computed rights with the rights reported by the fileserver."""
+        from OpenAFSLibrary.keywords.login import run_as_user
+        by_user = {}
+        for path,user,mask in checks:
+            by_user.setdefault(user, []).append(path)
+        failed = []
+        for user in sorted(by_user.keys()):
+            paths = by_user[user]
+            access = run_as_user(user, _caller_access, paths)
+            for path in paths:
+                computed = effective_rights(acls[path], user, groups[user])
+                actual = access.get(path)
+                if computed != actual:
+                    failed.append("%s %s: computed %s, fileserver %s" % (path, user,
+                        to_string(computed), to_string(actual) if actual is not None else None))
+        logger.info("Cross-checked %d effective rights with the fileserver." % (len(checks)))
+        if failed:
+            raise AssertionError("Computed rights do not match the fileserver:\n%s" % ("\n".join(failed)))
+
     def access_control_list_matches(self, path, *acls):
-        """Fails if an ACL does not match the given ACL."""
-        logger.debug("access_control_list_matches: path=%s, acls=[%s]" % (path, ",".join(acls)))
-        a1 = AccessControlList.from_path(path)
+        """Fails if an ACL does not match the given ACL.
+
+        The `path` may be a list of paths, to check many directories with
+        a single fs listacl command.
+        """
+        paths = _paths(path)
+        logger.debug("access_control_list_matches: path=%s, acls=[%s]" % (",".join(paths), ",".join(acls)))
         a2 = AccessControlList.from_args(*acls)
-        logger.debug("a1=%s" % a1)
         logger.debug("a2=%s" % a2)
-        if a1 != a2:
-            raise AssertionError("ACLs do not match: path=%s args=%s" % (a1, a2))
+        found = AccessControlList.from_paths(paths)
+        for p in paths:
+            a1 = found[p]
+            logger.debug("a1=%s" % a1)
+            if a1 != a2:
+                raise AssertionError("ACLs do not match: path=%s acl=%s args=%s" % (p, a1, a2))
 
     def access_control_list_contains(self, path, name, rights):
-        """Fails if an ACL does not contain the given rights."""
-        logger.debug("access_control_list_contains: path=%s, name=%s, rights=%s" % (path, name, rights))
-        a = AccessControlList.from_path(path)
-        if not a.contains(name, rights):
-            raise AssertionError("ACL entry rights do not match for name '%s'")
+        """Fails if an ACL does not contain the given rights.
+
+        The `path` may be a list of paths, to check many directories with
+        a single fs listacl command.
+        """
+        paths = _paths(path)
+        logger.debug("access_control_list_contains: path=%s, name=%s, rights=%s" % (",".join(paths), name, rights))
+        found = AccessControlList.from_paths(paths)
+        for p in paths:
+            if not found[p].contains(name, rights):
+                raise AssertionError("ACL entry rights do not match for name '%s': path=%s" % (name, p))
+
+    def access_control_lists_should_match_spec(self, path, spec, limit=None, batch=100, report=None):
+        """Fails if the ACLs of the directories in a tree do not match a spec.
+
+        The `spec` is a list of glob patterns and expected ACL entries; see
+        `AccessControlSpec`. For example:
+        | @{spec}= | Create List | private/* system:administrators rlidwka user1 rlidwk |
+        | ... | * system:administrators rlidwka system:anyuser rl |
+        | Access Control Lists Should Match Spec | ${PATH} | ${spec} |
+
+        The tree is walked and the ACLs are listed in batches of `batch`
+        directories per fs listacl, with up to `limit` batches at the same
+        time. Only one window of directories is held in memory at a time.
+        Each mismatch is logged as it is found, and written to the `report`
+        file if given. Directories which match no pattern are not checked.
+
+        A mismatch lists the unexpected entries ('+name+rights'), the missing
+        entries ('-name+rights') and the changed entries ('expected => actual').
+        """
+        batch = int(batch)
+        limit = int(limit) if limit else PARALLEL_LIMIT
+        spec = AccessControlSpec(spec)
+        checked = 0
+        mismatches = 0
+        first = []
+        out = open(report, "w") if report else None
+        start = time.time()
+        try:
+            for window in _windows(_walk_dirs(path), batch * limit):
+                dirs = [(d, spec.expected(os.path.relpath(d, path))) for d in window]
+                dirs = [(d, acl) for d,acl in dirs if acl is not None]
+                batches = list(_windows([d for d,acl in dirs], batch))
+                found = {}
+                for acls in parallel_map(AccessControlList.from_paths, batches, limit=limit):
+                    found.update(acls)
+                for d,expected in dirs:
+                    changes = expected.diff(found[d])
+                    if changes:
+                        line = "%s: %s" % (d, ", ".join(changes))
+                        logger.info(line)
+                        if out:
+                            out.write(line + "\n")
+                        if len(first) < 10:
+                            first.append(line)
+                        mismatches += 1
+                checked += len(dirs)
+        finally:
+            if out:
+                out.close()
+        elapsed = time.time() - start
+        logger.info("Checked %d directories in %.1f seconds (%.1f directories/sec)" % \
+            (checked, elapsed, checked / elapsed if elapsed else 0))
+        if mismatches:
+            raise AssertionError("%d of %d directories do not match the ACL spec:\n%s" % \
+                (mismatches, checked, "\n".join(first)))
 
     def access_control_should_exist(self, path, name):
         """Fails if the access control does not exist for the the given user or group name."""
@@ -263,14 +767,15 @@ def _test2():
         "user2": ("rlw","l"),
         "user3": ("rlidwk",""),
         "user5": ("rl",""),
-        "user6": ("rlidwkl",""),
+        "user6": ("rlidwk",""),
         "user7": ("","rlidwk"),
     }
     a = AccessControlList()
     for case in cases:
         name,rights = case.split()
         a.add(name, rights)
-    assert cmp(a.acls, expected)
+    got = dict([(e.name, (to_string(e.pos), to_string(e.neg))) for e in a.acls.values()])
+    assert got == expected, "expected=%s, got=%s" % (expected, got)
 
 def _test3():
     p = '/afs/robotest/test'
@@ -310,16 +815,322 @@ def _test4():
     assert a.contains("user3", "+rlidwk")
     assert not a.contains("user4", "none")
 
-def main():
+def _test5():
+    output = [
+        "Access list for /afs/robotest/a is\n",
+        "Normal rights:\n",
+        "  system:administrators rlidwka\n",
+        "  system:anyuser rl\n",
+        "\n",
+        "Access list for /afs/robotest/b c is\n",
+        "Normal rights:\n",
+        "  user1 rl\n",
+        "Negative rights:\n",
+        "  user2 l\n",
+    ]
+    acls = dict(_parse_listacl(output))
+    assert sorted(acls.keys()) == ["/afs/robotest/a", "/afs/robotest/b c"]
+    assert acls["/afs/robotest/a"] == AccessControlList.from_args(
+        "system:administrators rlidwka", "system:anyuser rl")
+    assert acls["/afs/robotest/b c"].contains("user2", "-l")
+    paths = ["/afs/robotest/d%d" % i for i in range(0, 1000)]
+    chunks = list(_chunks(paths + paths[:10], size=1000))
+    assert sum(chunks, []) == paths
+    assert max([len(" ".join(c)) for c in chunks]) < 1000
+
+def _test6():
+    assert parse("all") == ('+', ALL)
+    assert parse("-read") == ('-', READ)
+    assert parse("") == ('+', 0)
+    assert to_string(WRITE) == "rlidwk"
+    assert to_mask("lr") == READ
+    a1 = AccessControlList.from_args("user1 rl", "user2 -l")
+    a2 = AccessControlList.from_args("user2 -l", "user1 lr")
+    assert a1 == a2
+    a2.add("user1", "w")
+    assert a1 != a2
+    assert str(a1) == "user1+rl,user2+-l"
+
+def _test7():
+    global fs_lines  # monkey patch a test stub.
+    import tempfile, shutil
+    top = tempfile.mkdtemp()
+    try:
+        for d in ("a", "a/x", "b", "b/private", "c"):
+            os.mkdir(os.path.join(top, d))
+        actual = {
+            ".": "system:administrators rlidwka",
+            "a": "system:administrators rlidwka",
+            "a/x": "system:administrators rlidwka",
+            "b": "system:administrators rlidwka user1 rl",
+            "b/private": "system:administrators rlidwka user1 rlw",
+            "c": "system:anyuser rl",
+        }
+        def stub(*args):
+            for p in args[2:]:
+                yield "Access list for %s is\n" % p
+                yield "Normal rights:\n"
+                entries = actual[os.path.relpath(p, top)].split()
+                for i in xrange(0, len(entries), 2):
+                    yield "  %s %s\n" % (entries[i], entries[i+1])
+        fs_lines = stub
+        spec = [
+            "b/private system:administrators rlidwka user1 rlidwk",
+            "b system:administrators rlidwka,user1 rl",
+            "c",
+            "a* system:administrators rlidwka",
+            ". system:administrators rlidwka",
+        ]
+        k = _ACLKeywords()
+        k.access_control_lists_should_match_spec(top, [spec[1], spec[3], spec[4]], batch=2, limit=2)
+        report = os.path.join(top, "report")
+        try:
+            k.access_control_lists_should_match_spec(top, spec, batch=1, limit=3, report=report)
+            assert False, "no mismatch"
+        except AssertionError as e:
+            assert str(e).startswith("2 of 6 directories"), str(e)
+        lines = open(report).read().splitlines()
+        assert lines == [
+            "%s/b/private: user1+rlidwk => user1+rlw" % top,
+            "%s/c: +system:anyuser+rl" % top,
+        ], lines
+        # Overlapping patterns of a dictionary match the most specific first.
+        spec = AccessControlSpec({"*":"system:anyuser rl", "a/*":"user1 rl", "a/x":"user2 rl",
+                                  "[ab]/*":"user3 rl", "b*":"user4 rl", "?":"user5 rl"})
+        assert [pattern for pattern,regex,acl in spec.rules] == ["a/x", "a/*", "[ab]/*", "b*", "*", "?"]
+        assert str(spec.expected("a/x")) == "user2+rl"
+        assert str(spec.expected("a/y")) == "user1+rl"
+        assert str(spec.expected("b/y")) == "user3+rl"
+        assert str(spec.expected("b")) == "user4+rl"
+        assert str(spec.expected("c")) == "system:anyuser+rl"
+        # Lines are tried in the given order.
+        spec = AccessControlSpec("* system:anyuser rl\na/* user1 rl")
+        assert str(spec.expected("a/x")) == "system:anyuser+rl"
+    finally:
+        shutil.rmtree(top)
+
+def _test8():
+    global fs, run_program  # monkey patch test stubs.
+    import tempfile, shutil, threading
+    top = tempfile.mkdtemp()
+    try:
+        for d in ("a", "a/x", "a/x/y", "b", "mnt", "mnt/z"):
+            os.mkdir(os.path.join(top, d))
+        os.symlink(os.path.join(top, "a"), os.path.join(top, "link"))
+        lock = threading.Lock()
+        calls = []
+        def fs_stub(*args):
+            lock.acquire()
+            calls.append(args)
+            lock.release()
+        def lsmount_stub(args):
+            out = ""
+            for p in args[3:]:
+                if p.endswith("/mnt"):
+                    out += "'%s' is a mount point for volume '#test.mnt'\n" % p
+            return (1, out, "")
+        fs = fs_stub
+        run_program = lsmount_stub
+        k = _ACLKeywords()
+        count = k.apply_access_rights_recursively(top, "user1 rl, user2 -l", batch=2)
+        assert count == 5, count  # top, a, b, a/x, a/x/y
+        setacl = [c for c in calls if c[-1] != '-negative']
+        negative = [c for c in calls if c[-1] == '-negative']
+        assert sum([len(c) - 5 for c in setacl]) == 5
+        assert sum([len(c) - 6 for c in negative]) == 5
+        assert setacl[0][-3:] == ('-acl', 'user1', 'rl')
+        assert negative[0][-4:] == ('-acl', 'user2', 'l', '-negative')
+        del calls[:]
+        count = k.apply_access_rights_recursively(top, mode='copy', source="/afs/x",
+                    clear=True, cross_mounts=True, batch=100)
+        assert count == 7, count
+        assert len(calls) == 4  # one per level
+        assert calls[0] == ('copyacl', '-fromdir', '/afs/x', '-todir', top, '-clear')
+        try:
+            k.apply_access_rights_recursively(top, "user1 -l", clear="true")
+            assert False, "cleared with no positive entries"
+        except AssertionError as e:
+            assert str(e).startswith("Refusing")
+    finally:
+        shutil.rmtree(top)
+
+def _test9():
+    global fs_lines, pts  # monkey patch test stubs.
+    acl = AccessControlList.from_args("system:administrators rlidwka", "system:anyuser l",
+        "system:authuser rl", "group1 rlidwk", "user2 -wd")
+    assert to_string(effective_rights(acl, "user1", set())) == "rl"
+    assert to_string(effective_rights(acl, "user1", set(), authenticated=False)) == "l"
+    assert to_string(effective_rights(acl, "user2", set(["group1"]))) == "rlik"
+    assert to_string(effective_rights(acl, "admin", set(["system:administrators"]))) == "rlidwka"
+    acl = AccessControlList.from_args("system:administrators -a")
+    assert to_string(effective_rights(acl, "admin", set(["system:administrators"]))) == "la"
+    calls = []
+    def pts_stub(*args):
+        calls.append(args)
+        return {"user1":"Groups user1 (id: 1) is a member of:\n  group1\n",
+                "user2":"Groups user2 (id: 2) is a member of:\n"}[args[2]]
+    def fs_stub(*args):
+        for p in args[2:]:
+            yield "Access list for %s is\n" % p
+            yield "Normal rights:\n"
+            yield "  group1 rlidwk\n"
+            yield "  system:anyuser rl\n"
+    pts = pts_stub
+    fs_lines = fs_stub
+    m = GroupMembership()
+    assert m.get("user1") == set(["group1"])
+    assert m.get("user1") == set(["group1"])
+    assert (m.hits, m.misses, len(calls)) == (1, 1, 1)
+    m.command_hook("pts examine", 0, 0, 0)
+    m.get("user1")
+    assert len(calls) == 1
+    m.command_hook("pts adduser", 0, 0, 0)
+    m.get("user1")
+    assert len(calls) == 2
+    m.command_hook("sudo pts creategroup", 0, 0, 0)
+    m.get("user1")
+    assert len(calls) == 3
+    _membership.clear()
+    k = _ACLKeywords()
+    d = os.path.dirname(os.path.abspath(__file__))  # any directory
+    k.effective_rights_should_match(["%s user1 rlidwk" % d, "%s user2 read" % d])
+    try:
+        k.effective_rights_should_be(d, "user2", "rlidwk")
+        assert False, "no mismatch"
+    except AssertionError as e:
+        assert "expected rlidwk, got rl" in str(e), str(e)
+
+_FAKE_PAGSH = """#!/bin/sh
+FAKE_PAG=$$
+export FAKE_PAG
+exec /bin/sh "$@"
+"""
+
+_FAKE_AKLOG = """#!/bin/sh
+# usage: aklog ... -principal <principal>; the token holds the principal
+while [ $# -gt 1 ]; do
+    if [ "$1" = "-principal" ]; then
+        echo "$2" > "$FAKE_PAG_DIR/pag.$FAKE_PAG"
+    fi
+    shift
+done
+"""
+
+_FAKE_UNLOG = """#!/bin/sh
+rm -f "$FAKE_PAG_DIR/pag.$FAKE_PAG"
+"""
+
+_FAKE_FS = """#!/bin/sh
+# usage: fs getcalleraccess -path <path>...
+shift 2
+for p in "$@"; do
+    if [ "`cat $FAKE_PAG_DIR/pag.$FAKE_PAG`" = "user1@ROBOTEST" ]; then
+        echo "Callers access to $p is rlidwk"
+    else
+        echo "Callers access to $p is rl"
+    fi
+done
+"""
+
+def _test10():
+    global fs_lines  # monkey patch a test stub.
+    import tempfile, shutil
+    import OpenAFSLibrary.keywords.login as login
+    from OpenAFSLibrary.util import run_program
+    tmpdir = tempfile.mkdtemp()
+    tools = {}
+    for name,script in (('pagsh', _FAKE_PAGSH), ('aklog', _FAKE_AKLOG), ('unlog', _FAKE_UNLOG),
+                        ('fs', _FAKE_FS), ('tokens', "#!/bin/sh\n")):
+        tools[name] = os.path.join(tmpdir, name)
+        f = open(tools[name], 'w')
+        f.write(script)
+        f.close()
+        os.chmod(tools[name], 0755)
+    settings = {'SITE':tmpdir, 'PAGSH':tools['pagsh'], 'AKLOG':tools['aklog'],
+                'UNLOG':tools['unlog'], 'TOKENS':tools['tokens'], 'AFS_AKIMPERSONATE':True,
+                'AFS_LAZY_LOGOUT':True, 'AFS_CELL':"robotest", 'KRB_REALM':"ROBOTEST"}
+    def fs_stub(*args):
+        rc,out,err = run_program([tools['fs']] + list(args))
+        return out.splitlines()
+    saved = fs_lines, login.get_var, os.environ.get('FAKE_PAG_DIR')
+    fs_lines = fs_stub
+    login.get_var = settings.get
+    os.environ['FAKE_PAG_DIR'] = tmpdir
+    try:
+        # The caller holds an admin token, outside of any PAG.
+        caller = os.path.join(tmpdir, "pag.")
+        open(caller, "w").write("admin@ROBOTEST\n")
+        d = os.path.dirname(os.path.abspath(__file__))
+        acls = {d:AccessControlList.from_args("user1 rlidwk", "system:anyuser rl")}
+        groups = {"user1":set(), "user2":set()}
+        k = _ACLKeywords()
+        k._cross_check([(d, "user1", to_mask("rlidwk")), (d, "user2", READ)], acls, groups)
+        assert open(caller).read() == "admin@ROBOTEST\n"
+        assert sorted(os.listdir(tmpdir)) == sorted(tools.keys() + ["pag."]), os.listdir(tmpdir)
+        acls[d] = AccessControlList.from_args("user2 rlidwk", "system:anyuser rl")
+        try:
+            k._cross_check([(d, "user2", to_mask("rlidwk"))], acls, groups)
+            assert False, "no mismatch"
+        except AssertionError as e:
+            assert "computed rlidwk, fileserver rl" in str(e), str(e)
+        assert open(caller).read() == "admin@ROBOTEST\n"
+    finally:
+        fs_lines, login.get_var, pag_dir = saved
+        if pag_dir is None:
+            del os.environ['FAKE_PAG_DIR']
+        else:
+            os.environ['FAKE_PAG_DIR'] = pag_dir
+        shutil.rmtree(tmpdir)
+
+#
+# Benchmark
+#
+def bench(count=10000):
+    """Measure the ACL test object operations per second, and the self tests."""
+    import time
+    args = ["system:administrators rlidwka", "system:anyuser rl", "user1 rl",
+            "user2 rwl", "user2 -l", "user3 +rlidwk", "user4 none", "user5 read", "user6 write"]
+    start = time.time()
+    acls = [AccessControlList.from_args(*args) for i in xrange(0, count)]
+    built = time.time()
+    for a in acls:
+        a == acls[0]
+    compared = time.time()
+    for a in acls:
+        a.contains("user2", "rlw")
+        a.contains("user3", "rlidwk")
+    checked = time.time()
+    for i in xrange(0, count / 100):
+        _test1()
+        _test2()
+        _test4()
+        _test5()
+        _test6()
+    tested = time.time()
+    print "%-10s %10.0f acls/sec" % ("build", count / (built - start))
+    print "%-10s %10.0f acls/sec" % ("compare", count / (compared - built))
+    print "%-10s %10.0f lookups/sec" % ("contains", 2 * count / (checked - compared))
+    print "%-10s %10.0f runs/sec" % ("selftest", (count / 100) / (tested - checked))
+
+def main(args):
     global get_var  # monkey patch a test stub.
     get_var = lambda name: {'FS':"/usr/afs/bin/fs"}[name]
+    if args and args[0] == "--bench":
+        bench(*[int(a) for a in args[1:2]])
+        return
     _test1()
     _test2()
     _test3()
     _test4()
+    _test5()
+    _test6()
+    _test7()
+    _test8()
+    _test9()
+    _test10()
 
 if __name__ == "__main__":
-    # usage: python -m OpenAFSLibrary.keywords.acl
-    main()
+    # usage: python -m OpenAFSLibrary.keywords.acl [--bench [<count>]]
+    main(sys.argv[1:])
 
 
@@ -23,36 +23,14 @@ import os
 import re
 import sys
 import time
-from struct import pack,calcsize
+import atexit
+import threading
+from struct import pack
 from robot.api import logger
-from OpenAFSLibrary.util import get_var
-
-KRB_KEYTAB_MAGIC = 0x0502
-KRB_NT_PRINCIPAL = 1
-
-# IANA Kerberos Encryption Type Numbers
-KRB_ENCTYPE_NUMBERS = {
-    'des-cbc-crc': 1,
-    'des-cbc-md4': 2,
-    'des-cbc-md5': 3,
-    'des3-cbc-md5': 5,
-    'des3-cbc-sha1': 7,
-    'dsaWithSHA1-CmsOID': 9,
-    'md5WithRSAEncryption-CmsOID': 10,
-    'sha1WithRSAEncryption-CmsOID': 11,
-    'rc2CBC-EnvOID': 12,
-    'rsaEncryption-EnvOID': 13,
-    'rsaES-OAEP-ENV-OID': 14,
-    'des-ede3-cbc-Env-OID': 15,
-    'des3-cbc-sha1-kd': 16,
-    'aes128-cts-hmac-sha1-96': 17, # common
-    'aes256-cts-hmac-sha1-96': 18, # common
-    'rc4-hmac': 23,
-    'rc4-hmac-exp': 24,
-    'camellia128-cts-cmac': 25,
-    'camellia256-cts-cmac': 26,
-    'subkey-keymaterial': 65,
-}
+from OpenAFSLibrary.util import get_var, record_command
+from OpenAFSLibrary.util.kadmin import KadminSession, parse_principal_keys
+from OpenAFSLibrary.util.keytab import KRB_KEYTAB_MAGIC, \
+    KRB_ENCTYPE_NUMBERS, KRB_ENCTYPE_NAMES, KeytabWriter, des_key, read_keytab
 
 KRB_ENCTYPE_DESCS = {
     'aes128-cts-hmac-sha1-96': "AES-128 CTS mode with 96-bit SHA-1 HMAC",
@@ -62,75 +40,111 @@ KRB_ENCTYPE_DESCS = {
     'des-cbc-crc': "DES cbc mode with CRC-32",
 }
 
+# The names of KRB_ENCTYPE_DESCS which differ from the IANA names.
+KRB_ENCTYPE_ALIASES = {
+    'arcfour-hmac': 'rc4-hmac',
+}
+
+# The enctype names of the keytab entries by number; the names of the klist
+# descriptions are used where they differ.
+KRB_KEYTAB_ENCTYPE_NAMES = dict(KRB_ENCTYPE_NAMES)
+for alias,name in KRB_ENCTYPE_ALIASES.items():
+    KRB_KEYTAB_ENCTYPE_NAMES[KRB_ENCTYPE_NUMBERS[name]] = alias
+
 def encryption_type_number(enctype):
     """Get the enctype number of an enctype string."""
+    enctype = KRB_ENCTYPE_ALIASES.get(enctype, enctype)
     if not enctype in KRB_ENCTYPE_NUMBERS:
         raise AssertionError("Unknown enctype: %s" % (enctype))
     return KRB_ENCTYPE_NUMBERS[enctype]
 
+def keytab_enctype_name(number):
+    """Get the enctype string of a keytab entry enctype number."""
+    name = KRB_KEYTAB_ENCTYPE_NAMES.get(number)
+    if name is None:
+        raise AssertionError("Invalid enctype number: %d" % (number))
+    return name
+
 def encryption_type_is_des(enctype):
     eno = encryption_type_number(enctype)
     return (eno in [1, 2, 3, 15])
 
+# The kadmin.local process, started on first use.
+_kadmin = None
+_kadmin_lock = threading.Lock()
+
+# Encryption type names by description.
+KRB_ENCTYPE_BY_DESC = dict([(v, k) for k,v in KRB_ENCTYPE_DESCS.items()])
+
 def normalize_enctype(enctype):
-    if enctype in KRB_ENCTYPE_NUMBERS:
+    if enctype in KRB_ENCTYPE_NUMBERS or enctype in KRB_ENCTYPE_ALIASES:
         return enctype
-    for k in KRB_ENCTYPE_DESCS:
-        if enctype == KRB_ENCTYPE_DESCS[k]:
-            return k
-    raise AssertionError("Invalid enctype string: %s" % (enctype))
+    name = KRB_ENCTYPE_BY_DESC.get(enctype)
+    if name is None:
+        raise AssertionError("Invalid enctype string: %s" % (enctype))
+    return name
 
 def get_keytab_keys(keytab):
     """Read the list of (kvno,principal,enctype) tuples from a keytab."""
-    klist = get_var('KLIST')
-    entries = []
-    command = "%s -e -k -t %s" % (klist, keytab)
-    logger.info("Running: %s " % (command))
-    pipe = os.popen(command)
-    for line in pipe.readlines():
-        logger.info(line.rstrip())
-        if line.startswith('Keytab name:'):
-            continue
-        if line.startswith('KVNO'):
-            continue
-        if line.startswith('----'):
-            continue
-        m = re.match(r'^\s*(\d+)\s+(\S+)\s+(\S+)\s+(\S+)\s+\((.+)\)', line)
-        if m:
-            kvno = int(m.group(1))
-            principal = m.group(4)
-            enctype = normalize_enctype(m.group(5))
-        else:
-           raise AssertionError("Unexpected klist line: %s" % (line))
-        entries.append({'kvno':kvno, 'principal':principal, 'enctype':enctype})
-    rc = pipe.close()
-    if rc:
-        raise AssertionError("klist failed: exit code=%d" % (rc))
-    return entries
-
-def get_principal_keys(principal):
-    kadmin_local = get_var('KADMIN_LOCAL')
+    try:
+        entries = read_keytab(keytab).entries
+    except (IOError, OSError, ValueError) as e:
+        raise AssertionError("Failed to read keytab '%s': %s" % (keytab, e))
     keys = []
-    if "'" in principal:
-        raise AssertionError("Invalid principal string: %s" % (principal))
-    command = "sudo -n %s -q 'get_principal %s'" % (kadmin_local, principal)
-    logger.info("Running: %s" % command)
-    pipe = os.popen(command)
-    for line in pipe.readlines():
-        logger.info(line.rstrip())
-        if line.startswith("Key:"):
-            k = [x.strip() for x in line.replace("Key:", "", 1).split(',')]
-            kvno = int(k[0].strip('vno '))
-            enctype = k[1]
-            salt = k[2]
-            if salt == 'no salt':
-                salt = 'normal'
-            keys.append({'kvno':kvno, 'enctype':enctype, 'salt':salt, 'principal':principal})
-    rc = pipe.close()
-    if rc:
-        raise AssertionError("kadmin.local failed: exit code=%d" % (rc))
+    for entry in entries:
+        enctype = keytab_enctype_name(entry.enctype)
+        logger.info("%d %s (%s)" % (entry.kvno, entry.principal, enctype))
+        keys.append({'kvno':entry.kvno, 'principal':entry.principal, 'enctype':enctype})
     return keys
 
+def _check_arg(value, what):
+    """Fails if the value would be split or quoted by kadmin."""
+    if re.search(r'[\s"\']', value):
+        raise AssertionError("Invalid %s string: %s" % (what, value))
+
+def stop_kadmin_session():
+    """Stop the kadmin.local process, if running."""
+    global _kadmin
+    _kadmin_lock.acquire()
+    try:
+        if _kadmin is not None:
+            _kadmin.stop()
+            _kadmin = None
+    finally:
+        _kadmin_lock.release()
+
+atexit.register(stop_kadmin_session)
+
+def kadmin_query(request):
+    """Run a kadmin.local request. Returns the output lines.
+
+    The requests are sent to one kadmin.local process, started with sudo
+    on first use, instead of starting sudo and kadmin.local each time.
+    """
+    global _kadmin
+    kadmin_local = get_var('KADMIN_LOCAL')
+    _kadmin_lock.acquire()
+    try:
+        if _kadmin is not None and _kadmin.command[-1] != kadmin_local:
+            _kadmin.stop()
+            _kadmin = None
+        if _kadmin is None:
+            _kadmin = KadminSession(['sudo', '-n', kadmin_local], done=record_command)
+        session = _kadmin
+    finally:
+        _kadmin_lock.release()
+    logger.info("Running: kadmin.local: %s" % (request))
+    lines = session.query(request)
+    for line in lines:
+        logger.info(line)
+    errors = session.errors(lines, request)
+    return (lines, errors)
+
+def get_principal_keys(principal):
+    _check_arg(principal, "principal")
+    lines,errors = kadmin_query("get_principal %s" % (principal))
+    return parse_principal_keys(lines, principal)
+
 def get_key_version_number(keytab, cell, realm, enctype="des-cbc-crc"):
     """Get the kvno of the AFS service key.
 
@@ -139,9 +153,18 @@ def get_key_version_number(keytab, cell, realm, enctype="des-cbc-crc"):
     """
     logger.info("Searching for afs/%s@%s (or afs@%s) with enctype %s in %s" % \
         (cell, realm, realm, enctype, keytab))
-    p = re.compile(r'afs(/%s)?@%s$' % (cell, realm))
-    e = re.compile(r'%s$' % (enctype))
-    kvnos = [k['kvno'] for k in get_keytab_keys(keytab) if p.match(k['principal']) and e.match(k['enctype'])]
+    if enctype in KRB_ENCTYPE_NUMBERS or enctype in KRB_ENCTYPE_ALIASES:
+        try:
+            index = read_keytab(keytab)
+        except (IOError, OSError, ValueError) as e:
+            raise AssertionError("Failed to read keytab '%s': %s" % (keytab, e))
+        eno = encryption_type_number(enctype)
+        kvnos = [index.kvno(p, eno) for p in ("afs/%s@%s" % (cell, realm), "afs@%s" % (realm))]
+        kvnos = [k for k in kvnos if k is not None]
+    else:
+        p = re.compile(r'afs(/%s)?@%s$' % (cell, realm))
+        e = re.compile(r'%s$' % (enctype))
+        kvnos = [k['kvno'] for k in get_keytab_keys(keytab) if p.match(k['principal']) and e.match(k['enctype'])]
     if len(kvnos) == 0:
         raise AssertionError("Failed to find a kvno in keytab '%s'." % (keytab))
     kvno = sorted(kvnos, reverse=True)[0]
@@ -149,51 +172,31 @@ def get_key_version_number(keytab, cell, realm, enctype="des-cbc-crc"):
 
 def add_principal(principal):
     """Add a principal to the Kerberos realm."""
-    kadmin_local = get_var('KADMIN_LOCAL')
-    if "'" in principal:
-        raise AssertionError("Invalid principal string: %s" % (principal))
-    command = "sudo -n %s -q 'add_principal -randkey %s'" % (kadmin_local, principal)
-    logger.info("Running: %s" % command)
-    pipe = os.popen(command)
-    for line in pipe.readlines():
-        logger.info(line.rstrip())
-    rc = pipe.close()
-    if rc:
-        raise AssertionError("kadmin.local failed: exit code=%d" % (rc))
+    _check_arg(principal, "principal")
+    lines,errors = kadmin_query("add_principal -randkey %s" % (principal))
+    if errors:
+        raise AssertionError("kadmin.local failed: %s" % (errors[0]))
 
 def add_entry_to_keytab(keytab, principal, enctype=None, salt='normal'):
     """Write an entry to a keytab."""
-    kadmin_local = get_var('KADMIN_LOCAL')
-    if principal and "'" in principal:
-        raise AssertionError("Invalid principal string: %s" % (principal))
-    if enctype and "'" in enctype:
-        raise AssertionError("Invalid enctype string: %s" % (enctype))
-    if salt and "'" in salt:
-        raise AssertionError("Invalid salt string: %s" % (salt))
-
+    _check_arg(keytab, "keytab")
+    if principal:
+        _check_arg(principal, "principal")
+    if enctype:
+        _check_arg(enctype, "enctype")
+    if salt:
+        _check_arg(salt, "salt")
     if enctype:
         query = "ktadd -k %s -e %s:%s %s" % (keytab, enctype, salt, principal)
     else:
         query = "ktadd -k %s %s" % (keytab, principal)
-    command = "sudo -n %s -q '%s'" % (kadmin_local, query)
-    logger.info("Running: %s " % (command))
-    pipe = os.popen(command)
-    for line in pipe.readlines():
-        logger.info(line.rstrip())
-    rc = pipe.close()
-    if rc:
-        raise AssertionError("kadmin.local failed: exit code=%d" % (rc))
+    lines,errors = kadmin_query(query)
+    if errors:
+        raise AssertionError("kadmin.local failed: %s" % (errors[0]))
 
 def generate_des_key():
     """Generate a random DES key with correct parity bits."""
-    keybytes = bytearray(os.urandom(8))
-    key = bytearray(0)
-    for i in keybytes:
-        b = bin(i & 0xfe)
-        nb = len(b.split('1'))
-        # nb is one more than the number of bits set
-        key.append(int(b, 2) + (nb % 2))
-    return bytes(key)
+    return des_key()
 
 def create_empty_keytab(keytab):
     """Create an emtpy keytab file.
@@ -251,54 +254,30 @@ def create_fake_keytab(self, keytab, cell, realm, enctype):
     keytab format. The key is not cryptographically strong; only use this
     for test systems.
     """
-    # The following C-like structure definitions illustrate the MIT keytab
-    # file format. All values are in network byte order. All text is ASCII.
-    #
-    #   keytab {
-    #       uint16_t file_format_version;                    /* 0x502 */
-    #       keytab_entry entries[*];
-    #   };
-    #   keytab_entry {
-    #       int32_t size;
-    #       uint16_t num_components;    /* sub 1 if version 0x501 */
-    #       counted_octet_string realm;
-    #       counted_octet_string components[num_components];
-    #       uint32_t name_type;   /* not present if version 0x501 */
-    #       uint32_t timestamp;
-    #       uint8_t vno8;
-    #       keyblock key;
-    #       uint32_t vno; /* only present if >= 4 bytes left in entry */
-    #   };
-    #   counted_octet_string {
-    #       uint16_t length;
-    #       uint8_t data[length];
-    #   };
-    #   keyblock {
-    #       uint16_t type;
-    #       counted_octet_string key;
-    #   };
-    num_components = 2
-    name_type = KRB_NT_PRINCIPAL
-    timestamp = int(time.time())
-    vno = 1
-    eno = encryption_type_number(enctype)
-    if eno in (1, 2, 3):
-        key = generate_des_key()
-    elif eno == 17:
-        key = os.urandom(16)
-    elif eno == 18:
-        key = os.urandom(32)
-    else:
-        AssertionError("Cannot create fake keytab for enctype %s" % (enctype))
-    fmt = "HH%dsH%dsH%dsLLBHH%ds" % (len(realm), len("afs"), len(cell), len(key))
-    size = calcsize("!"+fmt) # get the entry size
-    f = open(keytab, "w")
-    f.write(pack('!h', KRB_KEYTAB_MAGIC))
-    f.write(pack("!l"+fmt,
-        size, num_components,
-        len(realm), realm, len("afs"), "afs", len(cell), cell, name_type,
-        timestamp, vno, eno, len(key), key))
-    f.close()
+    writer = KeytabWriter()
+    try:
+        writer.add("afs/%s@%s" % (cell, realm), encryption_type_number(enctype))
+        writer.write(keytab)
+    except (IOError, OSError, ValueError) as e:
+        raise AssertionError("Failed to create fake keytab '%s': %s" % (keytab, e))
+
+def create_fake_keytabs(keytab, principals, enctypes, kvno=1, append=False):
+    """Write random keys for a list of principals to one keytab.
+
+    Each principal gets a key of each of the enctypes. The existing
+    entries are kept in append mode, except for the ones with the same
+    principal, enctype and kvno, which are rewritten.
+    """
+    writer = KeytabWriter()
+    try:
+        if append and os.path.exists(keytab):
+            writer.load(keytab)
+        for principal in principals:
+            for enctype in enctypes:
+                writer.add(principal, encryption_type_number(enctype), kvno=kvno)
+        writer.write(keytab)
+    except (IOError, OSError, ValueError) as e:
+        raise AssertionError("Failed to create fake keytab '%s': %s" % (keytab, e))
 
 class _KeytabKeywords(object):
 
@@ -361,3 +340,59 @@ class _KeytabKeywords(object):
         else:
             create_afs_service_keytab(self, keytab, cell, realm, enctype)
 
+    def create_fake_user_keytabs(self, directory, name, count, realm,
+                                 enctypes='aes256-cts-hmac-sha1-96', kvno=1):
+        """Create test keytabs for a numbered set of users for akimpersonate.
+
+        A keytab named <user>.keytab is written to the directory for each of
+        the users <name>1 to <name><count>, with a random key for each of
+        the comma separated enctypes. Returns the list of keytab paths.
+        """
+        if isinstance(enctypes, basestring):
+            enctypes = [e.strip() for e in enctypes.split(",")]
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        start = time.time()
+        paths = []
+        for i in xrange(1, int(count) + 1):
+            user = "%s%d" % (name, i)
+            path = os.path.join(directory, "%s.keytab" % (user))
+            create_fake_keytabs(path, ["%s@%s" % (user, realm)], enctypes, kvno=kvno)
+            paths.append(path)
+        logger.info("Created %d keytabs in %.3f seconds." % (len(paths), time.time() - start))
+        return paths
+
+#
+# Unit tests
+#
+def _test1():
+    import tempfile, shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "afs.keytab")
+        w = KeytabWriter()
+        w.add("afs/robotest@ROBOTEST", "rc4-hmac", kvno=3)
+        w.add("afs/robotest@ROBOTEST", "aes256-cts-hmac-sha1-96", kvno=4)
+        w.write(path)
+        keys = get_keytab_keys(path)
+        assert [k['enctype'] for k in keys] == ['arcfour-hmac', 'aes256-cts-hmac-sha1-96'], keys
+        assert get_key_version_number(path, "robotest", "ROBOTEST", "arcfour-hmac") == 3
+        assert get_key_version_number(path, "robotest", "ROBOTEST", "rc4-hmac") == 3
+        assert get_key_version_number(path, "robotest", "ROBOTEST", "aes.*") == 4
+        assert encryption_type_number('arcfour-hmac') == 23
+        w.add("afs/robotest@ROBOTEST", 99, key="x" * 16)
+        w.write(path)
+        try:
+            get_keytab_keys(path)
+            assert False, "no error for unknown enctype"
+        except AssertionError as e:
+            assert "Invalid enctype number: 99" in str(e), str(e)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def main():
+    _test1()
+
+if __name__ == "__main__":
+    # usage: python -m OpenAFSLibrary.keywords.keytab
+    main()
@@ -20,8 +20,131 @@
 #
 
 import os
+import re
+import time
+import thread
 from robot.api import logger
-from OpenAFSLibrary.util import get_var,run_program
+from robot.libraries.BuiltIn import BuiltIn
+from OpenAFSLibrary.util import get_var,run_program,is_true
+from OpenAFSLibrary.util.parallel import parallel_map
+from OpenAFSLibrary.util.credentials import create_context,remove_context,current_context,run_as
+
+# Tokens with less time left than this are acquired again, unless the
+# AFS_TOKEN_MIN_LIFETIME setting is given.
+TOKEN_MIN_LIFETIME = 600
+
+# A line of the tokens output, for example:
+#   User's (AFS ID 1) tokens for afs@robotest [Expires Apr 14 08:00]
+#   User's (AFS ID 1) rxkad tokens for robotest [Expires Apr 14 08:00]
+TOKEN_LINE = re.compile(r"^User(?:'s \(AFS ID (?P<id>-?\d+)\)| (?P<name>\S+)'s)"
+                        r"(?: \w+)? tokens for (?:afs@)?(?P<cell>\S+) \[(?P<expires>[^\]]*)\]")
+
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+def parse_expires(text, now=None):
+    """Returns the expiration time of a token, or None if it has expired.
+
+    The tokens output does not include the year; the year is the one which
+    puts the time nearest to now.
+    """
+    m = re.match(r'Expires (\w{3})\s+(\d+) (\d+):(\d+)', text)
+    if not m or m.group(1) not in MONTHS:
+        return None
+    if now is None:
+        now = time.time()
+    month = MONTHS.index(m.group(1)) + 1
+    day,hour,minute = [int(x) for x in m.group(2, 3, 4)]
+    year = time.localtime(now).tm_year
+    times = [time.mktime((y, month, day, hour, minute, 0, 0, 0, -1)) for y in (year - 1, year, year + 1)]
+    return min(times, key=lambda t: abs(t - now))
+
+def parse_tokens(output, now=None):
+    """Returns the list of (viceid, cell, expires) of the tokens output."""
+    tokens = []
+    for line in output.splitlines():
+        m = TOKEN_LINE.match(line.strip())
+        if m:
+            viceid = m.group('id')
+            if viceid is not None:
+                viceid = int(viceid)
+            tokens.append((viceid, m.group('cell'), parse_expires(m.group('expires'), now)))
+    return tokens
+
+def get_tokens():
+    """Returns the tokens held by the cache manager."""
+    tokens = get_var('TOKENS')
+    rc,out,err = run_program([tokens])
+    if rc:
+        raise AssertionError("tokens failed: '%s'; exit code = %d" % (tokens, rc))
+    return parse_tokens(out)
+
+class TokenCache(object):
+    """Remembers the user of the current token to avoid logging in again.
+
+    A login is skipped when the token acquired for the same user and cell
+    is still held with enough time left. The tokens are checked each time,
+    so a token removed or expired behind our back is acquired again.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.ccaches = set()  # the credential caches created by login
+        self.clear()
+
+    def clear(self):
+        self.user = None
+        self.cell = None
+        self.viceid = None
+
+    def find(self, tokens, cell, viceid=None):
+        """Returns the (viceid, expires) of the token for the cell."""
+        for token in tokens:
+            if token[1] == cell and (viceid is None or token[0] == viceid):
+                return token[0], token[2]
+        return None, None
+
+    def check(self, user, cell, min_lifetime, now=None):
+        """Returns true if the current token can be used for the user."""
+        if user != self.user or cell != self.cell:
+            return False
+        if now is None:
+            now = time.time()
+        viceid,expires = self.find(get_tokens(), cell, self.viceid)
+        return expires is not None and expires - now >= min_lifetime
+
+    def login(self, user, cell, acquire, min_lifetime=TOKEN_MIN_LIFETIME):
+        """Call acquire(user) unless there is a usable token for the user."""
+        if self.check(user, cell, min_lifetime):
+            self.hits += 1
+            logger.info("Using the current token for %s in cell %s." % (user, cell))
+            return False
+        self.misses += 1
+        self.clear()
+        acquire(user)
+        viceid,expires = self.find(get_tokens(), cell)
+        if expires is not None:
+            self.user = user
+            self.cell = cell
+            self.viceid = viceid
+        return True
+
+_tokens = TokenCache()
+
+def token_cache():
+    """Returns the token cache of the current credential context."""
+    context = current_context()
+    if context is None:
+        return _tokens
+    return context.data.setdefault('tokens', TokenCache())
+
+def credential_cache(user):
+    """Returns the path of the Kerberos credential cache of a user, or of
+    the current credential context."""
+    context = current_context()
+    if context is not None:
+        return context.ccache
+    return os.path.join(get_var('SITE'), "krb5cc.%s" % (user.replace('/', '.')))
 
 def get_principal(user, realm):
     """Convert OpenAFS k4 style names to k5 style principals."""
@@ -64,7 +187,8 @@ def login_with_keytab(user):
         raise AsseritionError("Keytab file '%s' is missing." % keytab)
     if not os.path.isdir(site):
         raise AsseritionError("SITE directory '%s' is missing." % site)
-    krb5cc = os.path.join(site, "krb5cc")
+    krb5cc = credential_cache(user)
+    token_cache().ccaches.add(krb5cc)  # destroyed on logout
     cmd = "KRB5CCNAME=%s %s -5 -k -t %s %s" % (krb5cc, kinit, keytab, principal)
     rc,out,err = run_program(cmd)
     if rc:
@@ -74,29 +198,211 @@ def login_with_keytab(user):
     if rc:
         raise AssertionError("kinit failed: '%s'; exit code = %d" % (cmd, rc))
 
+def run_as_user(user, func, *args):
+    """Call func with the programs run with a token for a user.
+
+    The token is acquired in a temporary credential context, which is
+    removed after the call, so the token of the caller is not changed.
+    Without `PAGSH` the context shares the token of the caller, which is
+    acquired again after the call.
+    """
+    keywords = _LoginKeywords()
+    previous = token_cache().user
+    pagsh = get_var('PAGSH')
+    name = "run-as.%s.%d" % (user.replace('/', '.'), thread.get_ident())
+    keywords.create_credential_context(name, user)
+    try:
+        return run_as(name, func, *args)
+    finally:
+        keywords.remove_credential_context(name)
+        if previous and not (pagsh and os.access(pagsh, os.X_OK)):
+            token_cache().clear()
+            keywords.login(previous)
+
 class _LoginKeywords(object):
 
     def login(self, user=None):
-        """Acquire an AFS token for authenticated access."""
+        """Acquire an AFS token for authenticated access.
+
+        The login is skipped when the current token was acquired for the
+        same user and has at least `AFS_TOKEN_MIN_LIFETIME` seconds left.
+        """
         if user is None:
             user = get_var('AFS_ADMIN')
         if get_var('AFS_AKIMPERSONATE'):
-            akimpersonate(user)
+            acquire = akimpersonate
         else:
-            login_with_keytab(user)
-
-    def logout(self):
-        """Release the AFS token."""
-        if not get_var('AFS_AKIMPERSONATE'):
-            site = get_var('SITE')
-            kdestroy = get_var('KDESTROY')
-            krb5cc = os.path.join(site, "krb5cc")
-            cmd = "KRB5CCNAME=%s %s" % (krb5cc, kdestroy)
-            rc,out,err = run_program(cmd)
-            if rc:
-                raise AssertionError("kdestroy failed: '%s'; exit code = %d" % (cmd, rc))
+            acquire = login_with_keytab
+        min_lifetime = get_var('AFS_TOKEN_MIN_LIFETIME')
+        if min_lifetime is None:
+            min_lifetime = TOKEN_MIN_LIFETIME
+        token_cache().login(user, get_var('AFS_CELL'), acquire, int(min_lifetime))
+
+    def logout(self, force=False):
+        """Release the AFS token.
+
+        The token is kept for the next login when `AFS_LAZY_LOGOUT` is set,
+        unless force is true. Use force when the test needs to run without
+        a token.
+        """
+        tokens = token_cache()
+        if get_var('AFS_LAZY_LOGOUT') and not is_true(force):
+            logger.info("Keeping the token of %s (lazy logout)." % (tokens.user))
+            return
+        # The credential caches are destroyed even when the token has
+        # expired, or was not found after the login.
+        kdestroy = get_var('KDESTROY')
+        for krb5cc in sorted(tokens.ccaches):
+            if os.path.exists(krb5cc):
+                cmd = "KRB5CCNAME=%s %s" % (krb5cc, kdestroy)
+                rc,out,err = run_program(cmd)
+                if rc:
+                    raise AssertionError("kdestroy failed: '%s'; exit code = %d" % (cmd, rc))
+            tokens.ccaches.discard(krb5cc)
+        tokens.clear()
         unlog = get_var('UNLOG')
         rc,out,err = run_program(unlog)
         if rc:
             raise AssertionError("unlog failed: '%s'; exit code = %d" % (unlog, rc))
 
+    def get_token_statistics(self):
+        """Returns the number of logins skipped (hits) and done (misses)."""
+        tokens = token_cache()
+        logger.info("Token cache: %d hits, %d misses" % (tokens.hits, tokens.misses))
+        return {'hits': tokens.hits, 'misses': tokens.misses}
+
+    def create_credential_context(self, name, user=None):
+        """Create a named credential context and optionally log in to it.
+
+        A context has its own Kerberos credential cache and, when `PAGSH`
+        is available, its own PAG, so the commands run in different
+        contexts can hold tokens for different users at the same time.
+        """
+        ccache = os.path.join(get_var('SITE'), "krb5cc.context.%s" % (name))
+        create_context(name, ccache, get_var('PAGSH'))
+        if user:
+            run_as(name, self.login, user)
+
+    def remove_credential_context(self, name):
+        """Release the token of a credential context and stop it."""
+        run_as(name, self.logout, force=True)
+        remove_context(name)
+
+    def run_keyword_as_context(self, name, keyword, *args):
+        """Run a keyword with the programs run in the named credential context."""
+        return run_as(name, BuiltIn().run_keyword, keyword, *args)
+
+    def run_program_in_contexts(self, cmd, *names):
+        """Run a program in each of the named credential contexts at once.
+
+        Returns the list of exit codes, in the same order as the names.
+        """
+        start = time.time()
+        results = parallel_map(lambda name: run_as(name, run_program, cmd), names,
+                               limit=len(names) or None)
+        logger.info("Ran in %d contexts in %.3f seconds." % (len(names), time.time() - start))
+        return [rc for rc,out,err in results]
+
+#
+# Unit tests
+#
+_TOKENS_OUTPUT = """
+Tokens held by the Cache Manager:
+
+User's (AFS ID 1) tokens for afs@robotest [Expires Apr 14 08:00]
+User's (AFS ID 101) rxkad tokens for other.example.com [>> Expired <<]
+   --End of list--
+"""
+
+def _test1():
+    now = time.mktime((2015, 4, 13, 20, 0, 0, 0, 0, -1))
+    tokens = parse_tokens(_TOKENS_OUTPUT, now)
+    assert tokens == [(1, "robotest", now + 12 * 3600), (101, "other.example.com", None)], tokens
+    # The year is not given.
+    new_year = time.mktime((2015, 12, 31, 23, 0, 0, 0, 0, -1))
+    assert parse_expires("Expires Jan  1 01:00", new_year) == new_year + 2 * 3600
+    assert parse_expires(">> Expired <<", now) is None
+
+def _test2():
+    global get_tokens
+    held = []
+    acquired = []
+    def stub_get_tokens():
+        return list(held)
+    def acquire(user):
+        acquired.append(user)
+        del held[:]
+        held.append(({'admin':1, 'user':2}[user], "robotest", time.time() + 3600))
+    saved = get_tokens
+    get_tokens = stub_get_tokens
+    try:
+        cache = TokenCache()
+        cache.login("admin", "robotest", acquire)
+        cache.login("admin", "robotest", acquire)
+        assert acquired == ["admin"]
+        cache.login("user", "robotest", acquire)
+        cache.login("admin", "robotest", acquire)
+        assert acquired == ["admin", "user", "admin"]
+        del held[:]  # unlog behind our back
+        cache.login("admin", "robotest", acquire)
+        assert acquired == ["admin", "user", "admin", "admin"]
+        cache.login("admin", "robotest", acquire, min_lifetime=7200)  # not enough left
+        assert (cache.hits, cache.misses) == (1, 5), (cache.hits, cache.misses)
+    finally:
+        get_tokens = saved
+
+def _test3():
+    import tempfile
+    from OpenAFSLibrary.util.credentials import get_context
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name in ("a", "b"):
+            create_context(name, os.path.join(tmpdir, "krb5cc.%s" % name))
+        assert run_as("a", token_cache) is run_as("a", token_cache)
+        assert run_as("a", token_cache) is not run_as("b", token_cache)
+        assert token_cache() is _tokens
+        assert run_as("b", credential_cache, "user") == os.path.join(tmpdir, "krb5cc.b")
+        # Programs run in the context shell, with the context credential cache.
+        rc,out,err = run_as("a", run_program, "echo $KRB5CCNAME")
+        assert out.strip() == os.path.join(tmpdir, "krb5cc.a"), out
+    finally:
+        for name in ("a", "b"):
+            remove_context(name)
+        os.rmdir(tmpdir)
+
+def _test4():
+    global get_var, run_program  # monkey patch test stubs.
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    commands = []
+    def stub_run_program(cmd):
+        commands.append(cmd)
+        if cmd.startswith("KRB5CCNAME="):
+            os.remove(cmd.split()[0].split("=", 1)[1])
+        return (0, "", "")
+    saved = get_var, run_program
+    get_var = lambda name: {'KDESTROY':"kdestroy", 'UNLOG':"unlog", 'SITE':tmpdir}.get(name)
+    run_program = stub_run_program
+    try:
+        krb5cc = credential_cache("admin")
+        open(krb5cc, "w").close()
+        _tokens.ccaches.add(krb5cc)
+        assert _tokens.user is None  # the token was not found after the login
+        _LoginKeywords().logout()
+        assert commands == ["KRB5CCNAME=%s kdestroy" % krb5cc, "unlog"], commands
+        assert not os.path.exists(krb5cc) and not _tokens.ccaches
+        _LoginKeywords().logout()  # nothing left to destroy
+        assert commands[2:] == ["unlog"], commands
+    finally:
+        get_var, run_program = saved
+        os.rmdir(tmpdir)
+
+def main():
+    _test1()
+    _test2()
+    _test3()
+    _test4()
+
+if __name__ == "__main__":
+    # usage: python -m OpenAFSLibrary.keywords.login
+    main()
@@ -0,0 +1,301 @@
+# Copyright (c) 2015 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+import os
+import time
+import mmap
+import zlib
+from robot.api import logger
+from OpenAFSLibrary.util import first_difference
+from OpenAFSLibrary.util.content import ContentGenerator
+from OpenAFSLibrary.util.populate import parse_size
+
+PAGE_SIZE = mmap.PAGESIZE
+WINDOW_SIZE = 256 * 1024 * 1024  # the part of the file mapped at once
+CHUNK_SIZE = 1024 * 1024         # the size of each read
+
+# The mappings are compared with buffer() slices, which do not copy the
+# data. (The mmap objects of python 2 do not support memoryview.)
+
+def _mb_per_sec(size, seconds):
+    return size / max(seconds, 1e-6) / (1024 * 1024)
+
+def write_pattern_file(path, size, seed=0):
+    """Create a file with the pattern content of its base name."""
+    generator = ContentGenerator(seed)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    try:
+        generator.write(fd, os.path.basename(path), size)
+    finally:
+        os.close(fd)
+
+def _windows(size):
+    """Yield the (offset, length) of the windows to map a file."""
+    offset = 0
+    while offset < size:
+        yield offset, min(WINDOW_SIZE, size - offset)
+        offset += WINDOW_SIZE
+
+def compare_mmap_and_read(path, shared=True, read_first=False):
+    """Compare the contents of a file read with mmap and with read().
+
+    The file is mapped one window at a time, shared or private, and read
+    in chunks into one reusable buffer, so the memory used does not grow
+    with the file size. Either the mapping or the read is done first for
+    each window. Returns the first differing offset or None, and the
+    MB/s of the mmap and read paths.
+    """
+    if shared:
+        access = mmap.ACCESS_READ
+    else:
+        access = mmap.ACCESS_COPY
+    buf = bytearray(CHUNK_SIZE)
+    f = open(path, 'rb', 0)
+    try:
+        size = os.fstat(f.fileno()).st_size
+        mmap_time = read_time = 0.0
+        for offset,length in _windows(size):
+            t = time.time()
+            m = mmap.mmap(f.fileno(), length, access=access, offset=offset)
+            mmap_time += time.time() - t
+            try:
+                if not read_first:
+                    t = time.time()
+                    zlib.crc32(buffer(m))  # fault in the pages
+                    mmap_time += time.time() - t
+                f.seek(offset)
+                pos = 0
+                while pos < length:
+                    n = min(len(buf), length - pos)
+                    t = time.time()
+                    got = f.readinto(buf)
+                    read_time += time.time() - t
+                    if got < n:
+                        return offset + pos + got, _mb_per_sec(size, mmap_time), _mb_per_sec(size, read_time)
+                    t = time.time()
+                    same = buffer(m, pos, n) == buffer(buf, 0, n)
+                    if read_first:
+                        mmap_time += time.time() - t
+                    if not same:
+                        i = first_difference(buffer(m, pos, n), buffer(buf, 0, n))
+                        return offset + pos + i, _mb_per_sec(size, mmap_time), _mb_per_sec(size, read_time)
+                    pos += n
+            finally:
+                m.close()
+        return None, _mb_per_sec(size, mmap_time), _mb_per_sec(size, read_time)
+    finally:
+        f.close()
+
+def write_via_shared_mmap(path, size, seed=0):
+    """Write the pattern content of a file through a shared mapping.
+
+    Each window is flushed with msync before it is unmapped. The data
+    written is checked with read() on a second descriptor right after the
+    msync, while the window is still mapped, and again after the file is
+    closed. Returns the first differing offset or None, and the MB/s of
+    the mmap write and the reads.
+    """
+    generator = ContentGenerator(seed)
+    name = os.path.basename(path)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+    reader = open(path, 'rb', 0)
+    buf = bytearray(CHUNK_SIZE)
+    mismatch = None
+    write_time = read_time = 0.0
+    try:
+        os.ftruncate(fd, size)
+        for offset,length in _windows(size):
+            m = mmap.mmap(fd, length, access=mmap.ACCESS_WRITE, offset=offset)
+            try:
+                t = time.time()
+                for pos in xrange(0, length, CHUNK_SIZE):
+                    n = min(CHUNK_SIZE, length - pos)
+                    m[pos:pos + n] = str(generator.generate(name, offset + pos, n))
+                m.flush()  # msync
+                write_time += time.time() - t
+                t = time.time()
+                reader.seek(offset)
+                for pos in xrange(0, length, CHUNK_SIZE):
+                    n = min(CHUNK_SIZE, length - pos)
+                    got = reader.readinto(buf)
+                    if got < n or buffer(buf, 0, n) != buffer(m, pos, n):
+                        mismatch = offset + pos + first_difference(buffer(buf, 0, got), buffer(m, pos, n))
+                        break
+                read_time += time.time() - t
+            finally:
+                m.close()
+            if mismatch is not None:
+                break
+    finally:
+        reader.close()
+        os.close(fd)
+    if mismatch is None:
+        mismatch = _verify_pattern(path, generator, name)
+    return mismatch, _mb_per_sec(size, write_time), _mb_per_sec(size, read_time)
+
+def _verify_pattern(path, generator, name, size=None):
+    """Returns the first offset which does not have the pattern content."""
+    f = open(path, 'rb', 0)
+    try:
+        offset = 0
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            expected = generator.generate(name, offset, len(data))
+            if data != expected:
+                return offset + first_difference(data, buffer(expected))
+            offset += len(data)
+        if size is not None and offset != size:
+            return offset
+        return None
+    finally:
+        f.close()
+
+def append_over_mapped_page(path, seed=0, pages=4):
+    """Append to a file while its partial last page is mapped and dirty.
+
+    The file is created with a size which ends in the middle of a page and
+    mapped shared. The mapped partial page is changed through the mapping
+    and flushed with msync, then data is appended past the page with
+    write(). Returns the first offset which does not have the expected
+    content, as seen by read() and by a new mapping, or None.
+    """
+    generator = ContentGenerator(seed)
+    name = os.path.basename(path)
+    size = PAGE_SIZE + PAGE_SIZE // 2
+    total = size + int(pages) * PAGE_SIZE
+    expected = generator.generate(name, 0, total)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+    try:
+        # The first part is written with a hole to be filled through the map.
+        hole = (PAGE_SIZE + 100, PAGE_SIZE + 200)
+        os.write(fd, buffer(expected, 0, hole[0]))
+        os.lseek(fd, hole[1], os.SEEK_SET)
+        os.write(fd, buffer(expected, hole[1], size - hole[1]))
+        m = mmap.mmap(fd, size, access=mmap.ACCESS_WRITE)
+        try:
+            m[hole[0]:hole[1]] = str(expected[hole[0]:hole[1]])
+            m.flush()
+            os.lseek(fd, 0, os.SEEK_END)
+            os.write(fd, buffer(expected, size, total - size))
+            if buffer(m) != buffer(expected, 0, size):
+                return first_difference(buffer(m), buffer(expected))
+        finally:
+            m.close()
+    finally:
+        os.close(fd)
+    mismatch = _verify_pattern(path, generator, name, total)
+    if mismatch is not None:
+        return mismatch
+    f = open(path, 'rb')
+    try:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if buffer(m) != buffer(expected):
+                return first_difference(buffer(m), buffer(expected))
+        finally:
+            m.close()
+    finally:
+        f.close()
+    return None
+
+class _MmapKeywords(object):
+
+    def create_pattern_file(self, path, size, seed=0):
+        """Create a file of size bytes with seeded content.
+
+        The content is the same as for files created in `pattern` mode with
+        the same base name and seed.
+        """
+        start = time.time()
+        size = parse_size(size)
+        write_pattern_file(path, size, int(seed))
+        logger.info("Wrote %d bytes: %.1f MB/s" % (size, _mb_per_sec(size, time.time() - start)))
+
+    def mmap_should_match_read(self, path, shared=True, read_first=False):
+        """Fails if a file read with mmap differs from the file read with read().
+
+        The file is mapped `shared` or private, and either the mapping or
+        read() is done first. Large files are mapped and read a part at a
+        time. Returns the MB/s of the mmap and read paths.
+        """
+        shared = shared not in (False, 'False', 'false', 'no', '0')
+        read_first = read_first not in (False, 'False', 'false', 'no', '0')
+        mismatch,mmap_rate,read_rate = compare_mmap_and_read(path, shared, read_first)
+        logger.info("%s mmap: %.1f MB/s, read: %.1f MB/s" % \
+            ("shared" if shared else "private", mmap_rate, read_rate))
+        if mismatch is not None:
+            raise AssertionError("mmap and read differ in %s at offset %d." % (path, mismatch))
+        return {'mmap_mb_per_sec': mmap_rate, 'read_mb_per_sec': read_rate}
+
+    def write_file_via_shared_mmap(self, path, size, seed=0):
+        """Write a file through a shared mapping and check it with read().
+
+        Each part is flushed with msync and read back with read() while it
+        is still mapped, and the whole file is read again after it is
+        closed. Returns the MB/s of the mmap writes and the reads.
+        """
+        size = parse_size(size)
+        mismatch,write_rate,read_rate = write_via_shared_mmap(path, size, int(seed))
+        logger.info("mmap write: %.1f MB/s, read: %.1f MB/s" % (write_rate, read_rate))
+        if mismatch is not None:
+            raise AssertionError("Data written via mmap differs in %s at offset %d." % (path, mismatch))
+        return {'mmap_mb_per_sec': write_rate, 'read_mb_per_sec': read_rate}
+
+    def append_over_mapped_page(self, path, seed=0, pages=4):
+        """Fails if appending past a dirty mapped page loses or changes data."""
+        mismatch = append_over_mapped_page(path, int(seed), int(pages))
+        if mismatch is not None:
+            raise AssertionError("Append over a mapped page: %s differs at offset %d." % (path, mismatch))
+
+#
+# Unit tests
+#
+def _test1():
+    import tempfile, shutil
+    global WINDOW_SIZE
+    tmpdir = tempfile.mkdtemp()
+    saved = WINDOW_SIZE
+    WINDOW_SIZE = 4 * CHUNK_SIZE  # several windows
+    try:
+        path = os.path.join(tmpdir, "file")
+        size = 3 * WINDOW_SIZE + 12345
+        write_pattern_file(path, size, 3)
+        for shared in (True, False):
+            for read_first in (True, False):
+                mismatch,a,b = compare_mmap_and_read(path, shared, read_first)
+                assert mismatch is None, (shared, read_first, mismatch)
+        assert write_via_shared_mmap(os.path.join(tmpdir, "mapped"), size, 3)[0] is None
+        assert _verify_pattern(os.path.join(tmpdir, "mapped"), ContentGenerator(3), "mapped", size) is None
+        assert append_over_mapped_page(os.path.join(tmpdir, "append"), 3) is None
+        assert os.path.getsize(os.path.join(tmpdir, "append")) == 5 * PAGE_SIZE + PAGE_SIZE // 2
+        assert _verify_pattern(path, ContentGenerator(4), "file") == 0
+    finally:
+        WINDOW_SIZE = saved
+        shutil.rmtree(tmpdir)
+
+def main():
+    _test1()
+
+if __name__ == "__main__":
+    # usage: python -m OpenAFSLibrary.keywords.mmapio
+    main()
@@ -23,40 +23,223 @@ import sys
 import os
 import re
 import math
+import time
 import socket
 from robot.api import logger
 from robot.libraries.BuiltIn import BuiltIn
-from OpenAFSLibrary.util import get_var,run_program
+from OpenAFSLibrary.util import get_var,run_program,fs
+from OpenAFSLibrary.util.populate import FilePopulator,SizeDistribution,parse_size,format_stats, \
+    populate_tree,remove_tree,format_rates
+from OpenAFSLibrary.util.content import ContentGenerator,ContentVerifier,list_files,read_manifest
+from OpenAFSLibrary.util.fsx import run_fsx,replay
+from OpenAFSLibrary.util import bench
+
+# The results of the benchmark runs, written to the output directory.
+_benchmarks = []
+
+def _flush_cache(target, directory, paths):
+    """Drop the benchmark files from the page cache, and from the AFS cache."""
+    for path in paths:
+        bench.drop_cache(path)
+    if target == 'afs':
+        fs('flushvolume', '-path', directory)
 
 class _PathKeywords(object):
 
-    def create_files(self, path, count, size=0):
+    def create_files(self, path, count, size=0, mode='write', template=None,
+                     per_directory=0, workers=1, sizes=None, seed=0):
         """Create count number fixed size files in the given path.
 
         Fails if the files are already present.
+
+        The files are filled with zeros (`write`), extended without writing
+        data (`sparse`), allocated with posix_fallocate (`fallocate`),
+        copied from a `template` file (`clone`), or filled with content
+        generated from the `seed` (`pattern`), which can be checked later
+        with `Verify Files`. The files are spread over
+        numbered subdirectories when `per_directory` is given, and created
+        by the number of `workers` in parallel. The `sizes` option gives a
+        distribution of file sizes instead of the fixed `size`, for example
+        `uniform:1k:1m`, `exp:64k` or `4k*70,64k*20,1m*10`, drawn with the
+        `seed`.
+
+        Returns a dictionary of the files, bytes, seconds, files_per_sec and
+        mb_per_sec.
         """
         count = int(count)
-        size = int(size)
         if count <= 0:
             return
-        fmt = "%%0%dd" % (int(math.log10(float(count))) + 1) # fixed width filenames
-        if size > 0:
-            block = '\0' * 8192
-            blocks = size // len(block)
-            partial = size % len(block)
-            if partial > 0:
-                pblock = '\0' * partial
-        for i in xrange(0, count):
-            num = os.path.join(path, fmt % (i))
-            fd = os.open(num, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0777)
-            if size > 0:
-                for j in xrange(0, blocks):
-                    if os.write(fd, block) != len(block):
-                        raise IOError("Failed to write block %d to file '%s'." % (j,num))
-                if partial:
-                    if os.write(fd, pblock) != len(pblock):
-                        raise IOError("Failed to write to file '%s'." % num)
-            os.close(fd)
+        try:
+            if sizes:
+                sizes = SizeDistribution(sizes, seed).sizes(count)
+            else:
+                sizes = [parse_size(size)] * count
+            populator = FilePopulator(mode, template, seed=int(seed))
+        except ValueError as e:
+            raise AssertionError(str(e))
+        result = populator.populate(path, count, sizes, int(per_directory), int(workers))
+        logger.info(format_stats("Created", result))
+        return result
+
+    def populate_directory_tree(self, path, depth=2, breadth=4, files=10, size=0,
+                                mode='write', workers=8, seed=0):
+        """Create a directory tree for metadata stress tests.
+
+        Creates the directory `path` and `depth` levels of `breadth`
+        subdirectories below it, with `files` files of `size` bytes in
+        each directory, using a pool of `workers`. Fails if the path
+        already exists. Returns the mkdir and create phase rates.
+        """
+        try:
+            populator = FilePopulator(mode, seed=int(seed))
+        except ValueError as e:
+            raise AssertionError(str(e))
+        result = populate_tree(path, int(depth), int(breadth), int(files),
+                               parse_size(size), int(workers), populator)
+        logger.info("Populated %s: %s" % (path, format_rates(result)))
+        return result
+
+    def remove_directory_tree(self, path, workers=8):
+        """Remove a directory tree with parallel removal.
+
+        The files are removed first, then the directories from the bottom
+        up. Returns the scan, unlink and rmdir phase rates.
+        """
+        if not os.path.isdir(path):
+            raise AssertionError("%s is not a directory." % path)
+        result = remove_tree(path, int(workers))
+        logger.info("Removed %s: %s" % (path, format_rates(result)))
+        return result
+
+    def verify_files(self, path, seed=0, workers=8, chunk_size='1m'):
+        """Fails if the files under path do not have the pattern content.
+
+        The files created in `pattern` mode with the same `seed` are read
+        in chunks by a pool of `workers` and compared with the content
+        generated again for each file and offset. Large files are split
+        between the workers. The files which are missing or do not have the
+        size recorded when they were created also fail. Returns the bytes,
+        seconds and mb_per_sec.
+        """
+        if not os.path.isdir(path):
+            raise AssertionError("%s is not a directory." % path)
+        sizes = read_manifest(path)
+        names = list_files(path)
+        if sizes is None:
+            logger.info("No manifest in %s; the file sizes are not checked." % path)
+        else:
+            names = sorted(set(names) | set(sizes.keys()))
+        verifier = ContentVerifier(ContentGenerator(int(seed)), parse_size(chunk_size))
+        result = verifier.verify(path, names, int(workers), sizes)
+        logger.info("Verified %d files, %.1f MB in %.3f seconds: %.1f MB/s" % \
+            (result['files'], result['bytes'] / (1024.0 * 1024), result['seconds'], result['mb_per_sec']))
+        if result['mismatch']:
+            name,offset = result['mismatch']
+            raise AssertionError("Content of %d files does not match; first mismatch in %s at offset %d." % \
+                (result['mismatches'], os.path.join(path, name), offset))
+        return result
+
+    def run_file_system_exerciser(self, path, ops=10000, seed=0, processes=1,
+                                  max_size='256k', max_op_size='64k', mapped=True):
+        """Run random operations on a file and fail if the data is not as expected.
+
+        A seeded random sequence of `ops` reads, writes, truncates, mapped
+        reads and writes (unless `mapped` is false), and close/reopens is
+        run on the file, in the manner of fsx. When more than one of
+        `processes` is given, each process has its own file, path.<n>, and
+        seed. On a mismatch, the last operations and the arguments to
+        repeat the run are written to the file name with a `.fsxlog`
+        suffix, and the expected content to a `.fsxgood` file. Returns the
+        ops, seconds and ops_per_sec.
+        """
+        processes = int(processes)
+        if processes > 1:
+            paths = ["%s.%d" % (path, i) for i in xrange(0, processes)]
+        else:
+            paths = [path]
+        mapped = mapped not in (False, 'False', 'false', 'no', '0')
+        result = run_fsx(paths, int(ops), int(seed), max_size=parse_size(max_size),
+                         max_op_size=parse_size(max_op_size), mapped=mapped)
+        logger.info("%d ops in %d processes, %.1f seconds: %.0f ops/s" % \
+            (result['ops'], result['processes'], result['seconds'], result['ops_per_sec']))
+        if result['errors']:
+            raise AssertionError("\n".join(result['errors']))
+        return result
+
+    def replay_file_system_exerciser_log(self, log, path=None):
+        """Run the operations of an fsx log again, to reproduce a failure.
+
+        The `log` is a `.fsxlog` file written by `Run File System Exerciser`.
+        The same seed and number of operations are run from the start on
+        `path`, which is truncated and rewritten. The `path` defaults to the
+        file the log was written for with a `.replay` suffix; the file
+        itself is kept as it was, and can not be given as the `path`. Fails
+        if the data is not as expected.
+        """
+        result = replay(log, path)
+        logger.info("%d ops, %.1f seconds: %.0f ops/s" % \
+            (result['ops'], result['seconds'], result['ops_per_sec']))
+        return result
+
+    def benchmark_file_io(self, path, patterns='seqwrite,seqread,randread,randwrite',
+                          size='64m', block_size='64k', workers=1, sync=False,
+                          baseline=None, name=None, cold=True):
+        """Measure the bandwidth, IOPS and latency of reads and writes in a directory.
+
+        Each of the `workers` reads or writes its own file of `size` bytes
+        in blocks of `block_size`, sequentially (`seqwrite`, `seqread`) or
+        at random offsets (`randwrite`, `randread`). Writes are buffered, or
+        each block is followed by an fsync when `sync` is true. The latency
+        of the last block of a write includes the close, where the AFS
+        client stores the data, so the buffered write latencies of most
+        blocks only measure the client cache. The files are flushed from
+        the AFS cache (fs flushvolume) and the page cache before the reads,
+        unless `cold` is false; the results show whether the reads were cold
+        or warm. The same runs are done in the local `baseline` directory,
+        when given, to find the ratio of the AFS rate to the local rate.
+
+        The results are logged and saved, with the `name` of the run, in
+        io-benchmark.json in the output directory. Returns the results.
+        """
+        patterns = [p.strip() for p in patterns.split(',') if p.strip()]
+        size = parse_size(size)
+        block_size = parse_size(block_size)
+        workers = int(workers)
+        sync = sync not in (False, 'False', 'false', 'no', '0')
+        cold = cold not in (False, 'False', 'false', 'no', '0')
+        targets = [('afs', path)]
+        if baseline:
+            targets.append(('baseline', baseline))
+        results = []
+        for target,directory in targets:
+            if not os.path.isdir(directory):
+                raise AssertionError("%s is not a directory." % directory)
+            flush = None
+            if cold:
+                flush = lambda paths, target=target, directory=directory: \
+                    _flush_cache(target, directory, paths)
+            try:
+                for pattern in patterns:
+                    result = bench.run_benchmark(directory, pattern, size, block_size, workers, sync,
+                                                 flush=flush)
+                    result['target'] = target
+                    result['path'] = directory
+                    results.append(result)
+            finally:
+                bench.remove_files(directory, workers)
+        if baseline:
+            rates = dict([(r['pattern'], r['mb_per_sec']) for r in results if r['target'] == 'baseline'])
+            for r in results:
+                if r['target'] == 'afs' and rates.get(r['pattern']):
+                    r['ratio'] = r['mb_per_sec'] / rates[r['pattern']]
+        logger.info(bench.format_results(results))
+        _benchmarks.append({'name': name or os.path.basename(path.rstrip('/')),
+                            'host': socket.gethostname(), 'time': int(time.time()),
+                            'results': results})
+        output_dir = get_var('OUTPUT_DIR')
+        if output_dir:
+            bench.export(os.path.join(output_dir, "io-benchmark.json"), _benchmarks)
+        return results
 
     def directory_entry_should_exist(self, path):
         """Fails if directory entry does not exist in the given path."""
@@ -26,13 +26,17 @@ import math
 import socket
 from robot.api import logger
 from robot.libraries.BuiltIn import BuiltIn
-from OpenAFSLibrary.util import get_var,sudo,run_program
+from OpenAFSLibrary.util import get_var,sudo,run_program,start_forkserver,stop_forkserver,suite_metrics
+from OpenAFSLibrary.util import start_sudo_helper,stop_sudo_helper,forget_var
+from OpenAFSLibrary.util.metrics import format_summary
+from OpenAFSLibrary.util.parallel import run_programs
 
 def set_global_variables():
     # Save this hostname as a global variable.
     try:
         hostname = socket.gethostname()
         BuiltIn().set_global_variable("${HOSTNAME}", hostname)
+        forget_var('HOSTNAME')
     except AttributeError:
         pass # allow to load outside of RF
 
@@ -189,10 +193,73 @@ class _SystemKeywords(object):
         if rc == 0:
             raise AssertionError("Command should have failed: %s" % cmd)
 
+    def start_fork_server(self):
+        """Run programs from a small pre-forked helper process.
+
+        This avoids forking the large test runner process for each command.
+        See the `RUN_BACKEND` setting.
+        """
+        start_forkserver()
+
+    def stop_fork_server(self):
+        """Stop the fork server and run programs directly."""
+        stop_forkserver()
+
+    def run_commands_in_parallel(self, commands, limit=None, mode='fail-fast'):
+        """Run a list of commands concurrently and return the results.
+
+        Each command is a shell command string or a list of arguments. At most
+        `limit` commands are run at the same time. Returns the list of
+        (rc, output, error) results in the same order as the commands.
+
+        The `mode` is one of:
+        | fail-fast   | Do not start any more commands after a command fails |
+        | collect-all | Run all of the commands, then fail if any failed |
+
+        Fails if any command exits with a non-zero status code.
+        """
+        if mode not in ('fail-fast', 'collect-all'):
+            raise AssertionError("Invalid mode: %s" % (mode))
+        if isinstance(commands, basestring):
+            commands = [commands]
+        results = run_programs(commands, limit=limit, fail_fast=(mode == 'fail-fast'))
+        failed = []
+        for cmd,result in zip(commands, results):
+            if result is None:
+                continue  # not started
+            rc,out,err = result
+            if rc != 0:
+                if not isinstance(cmd, basestring):
+                    cmd = " ".join(cmd)
+                failed.append("%s (exit code %d)" % (cmd, rc))
+        if failed:
+            raise AssertionError("%d command(s) failed: %s" % (len(failed), "; ".join(failed)))
+        return results
+
+    def log_command_metrics(self):
+        """Log the wall time statistics of the commands run in the current suite.
+
+        Times are in milliseconds. The per-suite statistics are also written to
+        `command-metrics.json` in the output directory at the end of each suite.
+        """
+        logger.info(format_summary(suite_metrics.current()))
+
     def sudo(self, cmd, *args):
         """Run a command as root."""
         sudo(cmd, *args)
 
+    def start_sudo_helper(self):
+        """Run the `Sudo` commands with a long running privileged helper.
+
+        The helper is started once with sudo and enforces the same command
+        policy as afs-robotest-sudo. See the `SUDO_BACKEND` setting.
+        """
+        start_sudo_helper()
+
+    def stop_sudo_helper(self):
+        """Stop the privileged helper and run sudo for each `Sudo` command."""
+        stop_sudo_helper()
+
     def get_host_by_name(self, hostname):
         """Return the ipv4 address of the hostname."""
         return socket.gethostbyname(hostname)
@@ -233,6 +300,8 @@ class _SystemKeywords(object):
         (count, last) = get_crash_count()
         BuiltIn().set_suite_variable('${CRASH_COUNT}', count)
         BuiltIn().set_suite_variable('${CRASH_LAST}', last)
+        forget_var('CRASH_COUNT')
+        forget_var('CRASH_LAST')
 
     def crash_check(self):
         """Fails if a server process crash was detected."""
@@ -19,8 +19,19 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 #
 
+import os
+import re
+import time
+import socket
 import struct
-from OpenAFSLibrary.util import vos,fs
+import threading
+from robot.api import logger
+from OpenAFSLibrary.util import vos,fs,vos_lines,add_command_hook,add_reset_hook
+from OpenAFSLibrary.util.parallel import parallel_map
+
+# vos subcommands which do not change any volumes.
+VOS_QUERIES = ('vos examine', 'vos listvldb', 'vos listvol', 'vos listpart',
+    'vos partinfo', 'vos listaddrs', 'vos size', 'vos status', 'vos help', 'vos apropos')
 
 class VolumeDump(object):
     """Helper class to create and check volume dumps."""
@@ -67,6 +78,417 @@ class VolumeDump(object):
         self.file.close()
         self.file = None
 
+_PART_RE = re.compile(r'^(?:/?vicep)?([a-z]{1,2})$')
+_HEADER_RE = re.compile(r'^(\S+)\s+(\d+)\s+(RW|RO|BK)\s+(\d+) K\s+(\S+)')
+_TOTAL_RE = re.compile(r'^Total number of volumes on server (\S+) partition (\S+):')
+_BUSY_RE = re.compile(r'^\*\*\*\* Volume (\d+) is busy')
+_UNATTACHED_RE = re.compile(r'^\*\*\*\* Could not attach volume (\d+)')
+_SERVER_PART_RE = re.compile(r'^\s+(\S+) (/vicep[a-z]{1,2})\s*$')
+_HEADER_IDS_RE = re.compile(r'^\s+RWrite\s+(\d+)\s+ROnly\s+(\d+)\s+Backup\s+(\d+)')
+_MAXQUOTA_RE = re.compile(r'^\s+MaxQuota\s+(\d+) K')
+_VLDB_IDS_RE = re.compile(r'(RWrite|ROnly|Backup|RClone):\s+(\d+)')
+_SITE_RE = re.compile(r'^\s+server (\S+) partition (\S+) (RW|RO|BK) Site(?:\s+-- (.*\S))?')
+_LOCKED_RE = re.compile(r'^\s+Volume is (currently LOCKED|locked for .*)')
+
+_addresses = {}
+
+def normalize_server(server):
+    """Returns the address of a server name, to compare servers named
+    differently, e.g. 'localhost' and the host name."""
+    address = _addresses.get(server)
+    if address is None:
+        try:
+            address = socket.gethostbyname(server)
+        except socket.error:
+            address = server.lower()
+        _addresses[server] = address
+    return address
+
+def normalize_partition(part):
+    """Returns the partition name, e.g. '/vicepa' for 'a', 'vicepa' or 0."""
+    part = str(part).strip()
+    if part.isdigit():
+        n = int(part)
+        if n < 26:
+            part = chr(ord('a') + n)
+        else:
+            part = chr(ord('a') + n / 26 - 1) + chr(ord('a') + n % 26)
+    m = _PART_RE.match(part)
+    if not m:
+        raise AssertionError("Invalid partition name: %s" % (part))
+    return "/vicep" + m.group(1)
+
+def split_name(name):
+    """Returns the read-write name and volume type of a volume name."""
+    if name.endswith(".readonly"):
+        return (name[:-len(".readonly")], 'RO')
+    if name.endswith(".backup"):
+        return (name[:-len(".backup")], 'BK')
+    return (name, 'RW')
+
+class Site(object):
+    """A volume location from the VLDB."""
+
+    def __init__(self, server, partition, type, flags=None):
+        self.server = server
+        self.partition = partition
+        self.type = type
+        self.flags = flags  # e.g. 'Not released'
+
+    def matches(self, server='*', part='*', type=None):
+        if type is not None and self.type != type:
+            return False
+        if server != '*' and normalize_server(self.server) != normalize_server(server):
+            return False
+        if part != '*' and self.partition != normalize_partition(part):
+            return False
+        return True
+
+    def __repr__(self):
+        return "Site(%s, %s, %s)" % (self.server, self.partition, self.type)
+
+class VldbEntry(object):
+    """A volume location database entry."""
+
+    def __init__(self, name):
+        self.name = name
+        self.ids = {}      # volume ids by type; 'RW', 'RO', 'BK' and 'RC'
+        self.sites = []
+        self.locked = False
+
+    def parse(self, line):
+        """Parse one line of the entry. Returns false if the line is not recognized."""
+        ids = _VLDB_IDS_RE.findall(line)
+        if ids:
+            for label,id in ids:
+                self.ids[{'RWrite':'RW', 'ROnly':'RO', 'Backup':'BK', 'RClone':'RC'}[label]] = int(id)
+            return True
+        m = _SITE_RE.match(line)
+        if m:
+            self.sites.append(Site(m.group(1), m.group(2), m.group(3), m.group(4)))
+            return True
+        if _LOCKED_RE.match(line):
+            self.locked = True
+            return True
+        return False
+
+    def has_site(self, server='*', part='*', type=None):
+        for site in self.sites:
+            if site.matches(server, part, type):
+                return True
+        return False
+
+    def __repr__(self):
+        return "VldbEntry(%s, %s, %s%s)" % \
+            (self.name, self.ids, self.sites, ", locked" if self.locked else "")
+
+class VolumeHeader(object):
+    """A volume on a fileserver partition."""
+
+    def __init__(self, name, id, type=None, size=None, status=None, server=None, partition=None):
+        self.name = name
+        self.id = id
+        self.type = type
+        self.size = size          # kilobytes
+        self.status = status      # 'On-line', 'Off-line', 'busy' or 'unattached'
+        self.server = server
+        self.partition = partition
+        self.ids = {}             # the related volume ids; 'RW', 'RO' and 'BK'
+        self.maxquota = None      # kilobytes
+        self.accesses = None
+
+    def parse(self, line):
+        """Parse one line of the long form. Returns false if the line is not recognized."""
+        m = _SERVER_PART_RE.match(line)
+        if m:
+            self.server,self.partition = m.groups()
+            return True
+        m = _HEADER_IDS_RE.match(line)
+        if m:
+            self.ids = {'RW':int(m.group(1)), 'RO':int(m.group(2)), 'BK':int(m.group(3))}
+            return True
+        m = _MAXQUOTA_RE.match(line)
+        if m:
+            self.maxquota = int(m.group(1))
+            return True
+        if "accesses in the past day" in line:
+            self.accesses = int(line.split()[0])
+            return True
+        return False
+
+    def __repr__(self):
+        return "VolumeHeader(%s, %d, %s, %s, %s, %s)" % \
+            (self.name, self.id, self.type, self.status, self.server, self.partition)
+
+def _header(line, server=None, partition=None):
+    """Returns the VolumeHeader of a listvol or examine volume line, or None."""
+    m = _HEADER_RE.match(line)
+    if m:
+        name,id,type,size,status = m.groups()
+        return VolumeHeader(name, int(id), type, int(size), status, server, partition)
+    m = _BUSY_RE.match(line)
+    if m:
+        return VolumeHeader(None, int(m.group(1)), status='busy', server=server, partition=partition)
+    m = _UNATTACHED_RE.match(line)
+    if m:
+        return VolumeHeader(None, int(m.group(1)), status='unattached', server=server, partition=partition)
+    return None
+
+def parse_listvldb(lines):
+    """Returns the list of VldbEntry objects from 'vos listvldb' output."""
+    entries = []
+    entry = None
+    for line in lines:
+        line = line.rstrip()
+        if not line:
+            continue
+        if not line[0].isspace():
+            if line.startswith("VLDB entries") or line.startswith("Total entries"):
+                entry = None
+            else:
+                entry = VldbEntry(line.strip())
+                entries.append(entry)
+        elif entry is not None:
+            entry.parse(line)
+    return entries
+
+def parse_listvol(lines):
+    """Returns the list of VolumeHeader objects from 'vos listvol' output.
+
+    The short and long (-long) forms are supported.
+    """
+    volumes = []
+    server = partition = None
+    volume = None
+    for line in lines:
+        line = line.rstrip()
+        if not line:
+            continue
+        m = _TOTAL_RE.match(line)
+        if m:
+            server,partition = m.groups()
+            volume = None
+            continue
+        header = _header(line, server, partition)
+        if header:
+            volumes.append(header)
+            volume = header
+        elif volume is not None and line[0].isspace():
+            volume.parse(line)
+        else:
+            volume = None
+    return volumes
+
+def parse_examine(lines):
+    """Returns the VolumeHeader and VldbEntry from 'vos examine' output.
+
+    The header is None if the volume could not be read from the fileserver.
+    """
+    header = None
+    entry = None
+    for line in lines:
+        line = line.rstrip()
+        if not line:
+            continue
+        if entry is None:
+            if header is None:
+                header = _header(line)
+                if header:
+                    continue
+            if _VLDB_IDS_RE.search(line):
+                if header and header.name:
+                    entry = VldbEntry(split_name(header.name)[0])
+                else:
+                    entry = VldbEntry(None)
+                entry.parse(line)
+            elif header is not None:
+                header.parse(line)
+        else:
+            entry.parse(line)
+    return (header, entry)
+
+class VolumeIndex(object):
+    """Snapshot of the VLDB and fileserver volumes.
+
+    The VLDB is read with a single 'vos listvldb' and the volumes of a
+    fileserver with a single 'vos listvol', on first use. The results are
+    indexed by volume name, id, server and partition, so many assertions
+    can be answered from one snapshot. The snapshot is discarded after any
+    vos command which may change the volumes, including vos commands run
+    with Sudo, and at the start of each suite and test.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Discard the snapshot.
+
+        A snapshot being loaded by another thread is discarded once the
+        load is done, since it may have been read before the change.
+        """
+        self.lock.acquire()
+        try:
+            self.entries = None   # VLDB entries by read-write name
+            self.ids = None       # (VLDB entry, type) by volume id
+            self.servers = {}     # volume headers by server address
+        finally:
+            self.lock.release()
+
+    def command_hook(self, tag, seconds, rc, size):
+        if tag.startswith('sudo '):
+            tag = tag[len('sudo '):]  # run as root with Sudo
+        if tag.startswith('vos ') and tag not in VOS_QUERIES:
+            self.clear()
+
+    def _load_vldb(self):
+        entries = {}
+        ids = {}
+        for entry in parse_listvldb(vos_lines('listvldb')):
+            entries[entry.name] = entry
+            for type,id in entry.ids.items():
+                ids[id] = (entry, type)
+        logger.info("Loaded %d VLDB entries." % (len(entries)))
+        self.ids = ids
+        self.entries = entries
+
+    def lookup(self, name):
+        """Returns the VLDB entry and volume type of a volume name or id.
+
+        Returns (None, None) if the volume is not in the VLDB.
+        """
+        self.lock.acquire()
+        try:
+            if self.entries is None:
+                self._load_vldb()
+            entries,ids = self.entries,self.ids
+        finally:
+            self.lock.release()
+        name = str(name)
+        if name.isdigit():
+            return ids.get(int(name), (None, None))
+        rwname,type = split_name(name)
+        entry = entries.get(rwname)
+        if entry is None or type not in entry.ids:
+            return (None, None)
+        return (entry, type)
+
+    def volumes(self, server):
+        """Returns the volumes on a fileserver."""
+        address = normalize_server(server)
+        self.lock.acquire()
+        try:
+            volumes = self.servers.get(address)
+            if volumes is None:
+                volumes = parse_listvol(vos_lines('listvol', '-server', server, '-long'))
+                logger.info("Loaded %d volume headers from %s." % (len(volumes), server))
+                self.servers[address] = volumes
+            return volumes
+        finally:
+            self.lock.release()
+
+    def find(self, name, server, part='*'):
+        """Returns the volume headers of a volume name or id on a fileserver."""
+        name = str(name)
+        if part != '*':
+            part = normalize_partition(part)
+        found = []
+        for volume in self.volumes(server):
+            if name.isdigit():
+                if volume.id != int(name):
+                    continue
+            elif volume.name != name:
+                continue
+            if part == '*' or volume.partition == part:
+                found.append(volume)
+        return found
+
+    def exists(self, name, server='*', part='*'):
+        """Returns true if the volume exists.
+
+        The fileserver is checked when a server is given, otherwise the
+        VLDB sites of the volume type are checked."""
+        if server != '*':
+            return len(self.find(name, server, part)) > 0
+        entry,type = self.lookup(name)
+        if entry is None:
+            return False
+        if type == 'BK':
+            type = 'RW'  # backup volumes are kept with the read-write volume
+        return part == '*' or entry.has_site(part=part, type=type)
+
+    def entry(self, name):
+        """Returns the VLDB entry of a volume. Fails if there is none."""
+        entry,type = self.lookup(name)
+        if entry is None:
+            raise AssertionError("Volume %s not found in the VLDB." % (name))
+        return entry
+
+_index = VolumeIndex()
+add_command_hook(_index.command_hook)
+add_reset_hook(_index.clear)
+
+def _split(value):
+    """Returns the list of values in a comma or space separated string."""
+    if value is None:
+        return []
+    if isinstance(value, basestring):
+        return value.replace(",", " ").split()
+    return list(value)
+
+def volume_names(name, count):
+    """Returns the volume names of a name pattern, e.g. 'test.%03d'.
+
+    The volume number is appended when the pattern does not have a
+    format specifier."""
+    if "%" not in name:
+        name += ".%d"
+    return [name % i for i in xrange(1, int(count) + 1)]
+
+class PartitionLimits(object):
+    """Limits the number of concurrent volume operations on each partition."""
+
+    def __init__(self, limit):
+        self.limit = int(limit)
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def get(self, server, part):
+        key = (normalize_server(server), normalize_partition(part))
+        self.lock.acquire()
+        try:
+            semaphore = self.semaphores.get(key)
+            if semaphore is None:
+                semaphore = threading.Semaphore(self.limit)
+                self.semaphores[key] = semaphore
+            return semaphore
+        finally:
+            self.lock.release()
+
+    def run(self, server, part, *args):
+        """Run a vos command when the partition is not too busy."""
+        semaphore = self.get(server, part)
+        semaphore.acquire()
+        try:
+            return vos(*args)
+        finally:
+            semaphore.release()
+
+def _mount_path(path, name):
+    if "%" in path:
+        return path % name
+    return os.path.join(path, name)
+
+def _finish(parent, start, count, what):
+    """Release the parent volume once and check the volumes once."""
+    if parent:
+        vos('release', '-id', parent, '-verbose')
+    fs('checkvolumes')
+    elapsed = time.time() - start
+    logger.info("%s %d volumes in %.1f seconds (%.1f volumes/sec)" % \
+        (what, count, elapsed, count / elapsed if elapsed else 0))
+
 class _VolumeKeywords(object):
     """Volume keywords."""
 
@@ -98,9 +520,12 @@ class _VolumeKeywords(object):
         dump.close()
 
     def create_volume(self, server, part, name):
-        """Create an AFS volume."""
-        # todo: return the volume id!
-        vos('create', '-server', server, '-partition', part, '-name', name, '-m', '0', '-verbose')
+        """Create an AFS volume. Returns the volume id."""
+        output = vos('create', '-server', server, '-partition', part, '-name', name, '-m', '0', '-verbose')
+        m = re.search(r'Volume (\d+) created', output)
+        if m:
+            return int(m.group(1))
+        return None
 
     def remove_volume(self, name):
         """Remove an AFS volume."""
@@ -135,3 +560,346 @@ class _VolumeKeywords(object):
         fs('mkmount', '-dir', path, '-vol', name)
         fs('setacl', '-dir', path, '-acl', 'system:anyuser', 'read')
 
+
+    def create_volumes(self, name, count, server, parts='a', path=None, acl=None,
+                       replicas=None, parent=None, limit=None, per_partition=2):
+        """Create, mount and replicate a number of volumes concurrently.
+
+        The volume names are given by a `name` pattern; `test.%03d` gives
+        test.001, test.002, and so on. The volumes are spread over the
+        comma separated list of partitions `parts` of the `server`.
+
+        When a `path` is given, each volume is mounted on a directory of the
+        path with the volume name, or on the path given by the pattern, e.g.
+        `/afs/.example.com/test/v%s`. The `acl` is a list of name and rights
+        pairs to set on each mount point, e.g. `system:anyuser rl`.
+
+        The `replicas` is a comma separated list of server:partition sites
+        of the read-only volumes. Each volume is released once after its
+        sites are added.
+
+        At most `limit` volumes are provisioned at the same time, and at most
+        `per_partition` vos commands are run on each partition at the same
+        time. The `parent` volume of the mount points is released and the
+        volumes are checked once at the end.
+
+        Returns the list of volume names.
+        """
+        start = time.time()
+        names = volume_names(name, count)
+        parts = _split(parts)
+        sites = [site.split(":") for site in _split(replicas)]
+        acl = _split(acl)
+        partitions = PartitionLimits(per_partition)
+
+        def create(args):
+            (n, name) = args
+            part = parts[n % len(parts)]
+            partitions.run(server, part, 'create', '-server', server,
+                           '-partition', part, '-name', name, '-m', '0')
+            if path:
+                dir = _mount_path(path, name)
+                fs('mkmount', '-dir', dir, '-vol', name)
+                if acl:
+                    fs('setacl', '-dir', dir, '-acl', *acl)
+            if sites:
+                for site_server,site_part in sites:
+                    partitions.run(site_server, site_part, 'addsite', '-server', site_server,
+                                   '-partition', site_part, '-id', name)
+                partitions.run(server, part, 'release', '-id', name)
+
+        parallel_map(create, enumerate(names), limit=limit)
+        _finish(parent, start, len(names), "Created")
+        return names
+
+    def remove_volumes(self, name, count, path=None, parent=None, limit=None, per_partition=2):
+        """Remove the volumes created by `Create Volumes`.
+
+        The mount points under `path` are removed, then the read-only sites
+        and the read-write volume of each volume. The `parent` volume is
+        released and the volumes are checked once at the end. Volumes which
+        are not in the VLDB are skipped.
+        """
+        start = time.time()
+        names = volume_names(name, count)
+        entries = {}
+        for n in names:
+            entries[n] = _index.lookup(n)[0]  # one listvldb for all the volumes
+        partitions = PartitionLimits(per_partition)
+
+        def remove(name):
+            if path:
+                dir = _mount_path(path, name)
+                if os.path.lexists(dir):
+                    fs('rmmount', '-dir', dir)
+            entry = entries[name]
+            if entry is None:
+                return
+            rw = None
+            for site in entry.sites:
+                if site.type == 'RO':
+                    partitions.run(site.server, site.partition, 'remove', '-server', site.server,
+                                   '-partition', site.partition, '-id', "%s.readonly" % name)
+                elif site.type == 'RW':
+                    rw = site
+            if rw:
+                partitions.run(rw.server, rw.partition, 'remove', '-server', rw.server,
+                               '-partition', rw.partition, '-id', name)
+
+        parallel_map(remove, names, limit=limit)
+        _finish(parent, start, len(names), "Removed")
+
+    def examine_volume(self, name):
+        """Returns the fileserver header and VLDB entry of a volume.
+
+        The header has the name, id, type, size, status, server, partition,
+        ids and maxquota attributes. The header is None when the volume
+        could not be read from the fileserver. The entry has the name, ids,
+        sites and locked attributes.
+        """
+        return parse_examine(vos_lines('examine', '-id', name))
+
+    def volume_should_exist(self, name, server='*', part='*'):
+        """Fails if the volume does not exist.
+
+        When a server is given, the volume must be present on the fileserver
+        (and partition, if given). Otherwise, the volume must be in the VLDB
+        (with a site of the volume type on the partition, if given).
+        """
+        if not _index.exists(name, server, part):
+            raise AssertionError("Volume %s does not exist (server=%s, part=%s)." % (name, server, part))
+
+    def volume_should_not_exist(self, name, server='*', part='*'):
+        """Fails if the volume exists. See `Volume Should Exist`."""
+        if _index.exists(name, server, part):
+            raise AssertionError("Volume %s exists (server=%s, part=%s)." % (name, server, part))
+
+    def volume_should_be_locked(self, name):
+        """Fails if the VLDB entry of the volume is not locked."""
+        if not _index.entry(name).locked:
+            raise AssertionError("Volume %s is not locked." % (name))
+
+    def volume_should_be_unlocked(self, name):
+        """Fails if the VLDB entry of the volume is locked."""
+        if _index.entry(name).locked:
+            raise AssertionError("Volume %s is locked." % (name))
+
+    def ro_site_should_exist(self, name, server='*', part='*'):
+        """Fails if the VLDB entry does not have a read-only site on the server and partition."""
+        if not _index.entry(name).has_site(server, part, 'RO'):
+            raise AssertionError("Volume %s does not have a read-only site (server=%s, part=%s)." % (name, server, part))
+
+    def ro_site_should_not_exist(self, name, server='*', part='*'):
+        """Fails if the VLDB entry has a read-only site on the server and partition."""
+        entry,type = _index.lookup(name)
+        if entry is not None and entry.has_site(server, part, 'RO'):
+            raise AssertionError("Volume %s has a read-only site (server=%s, part=%s)." % (name, server, part))
+
+    def rw_site_should_exist(self, name, server='*', part='*'):
+        """Fails if the VLDB entry does not have a read-write site on the server and partition."""
+        if not _index.entry(name).has_site(server, part, 'RW'):
+            raise AssertionError("Volume %s does not have a read-write site (server=%s, part=%s)." % (name, server, part))
+
+    def rw_site_should_not_exist(self, name, server='*', part='*'):
+        """Fails if the VLDB entry has a read-write site on the server and partition."""
+        entry,type = _index.lookup(name)
+        if entry is not None and entry.has_site(server, part, 'RW'):
+            raise AssertionError("Volume %s has a read-write site (server=%s, part=%s)." % (name, server, part))
+
+#
+# Unit tests
+#
+_LISTVLDB = """\
+VLDB entries for all servers
+
+root.afs
+    RWrite: 536870912     ROnly: 536870913
+    number of sites -> 2
+       server afs1.example.com partition /vicepa RW Site
+       server afs1.example.com partition /vicepa RO Site
+       server afs2.example.com partition /vicepb RO Site  -- Not released
+
+test.lock
+    RWrite: 536870918     Backup: 536870920
+    number of sites -> 1
+       server afs2.example.com partition /vicepab RW Site
+    Volume is currently LOCKED
+
+Total entries: 2
+"""
+
+_LISTVOL = """\
+Total number of volumes on server afs1.example.com partition /vicepa: 3
+root.afs                          536870912 RW          2 K  On-line
+    afs1.example.com /vicepa
+    RWrite  536870912 ROnly  536870913 Backup          0
+    MaxQuota       5000 K
+    Creation    Wed Mar 11 12:00:00 2015
+    Last Update Wed Mar 11 12:00:00 2015
+    7 accesses in the past day (i.e., vnode references)
+
+root.afs.readonly                 536870913 RO          2 K  On-line
+    afs1.example.com /vicepa
+    RWrite  536870912 ROnly  536870913 Backup          0
+    MaxQuota       5000 K
+    0 accesses in the past day (i.e., vnode references)
+
+**** Volume 536870930 is busy ****
+
+Total volumes onLine 2 ; Total volumes offLine 0 ; Total busy 1
+
+Total number of volumes on server afs1.example.com partition /vicepb: 1
+test.short                        536870922 RW          4 K On-line
+
+Total volumes onLine 1 ; Total volumes offLine 0 ; Total busy 0
+"""
+
+_EXAMINE = """\
+root.afs.readonly                 536870913 RO          2 K  On-line
+    afs1.example.com /vicepa
+    RWrite  536870912 ROnly  536870913 Backup          0
+    MaxQuota       5000 K
+    0 accesses in the past day (i.e., vnode references)
+
+    RWrite: 536870912     ROnly: 536870913
+    number of sites -> 2
+       server afs1.example.com partition /vicepa RW Site
+       server afs1.example.com partition /vicepa RO Site
+"""
+
+def _test1():
+    cases = [("a", "/vicepa"), ("vicepb", "/vicepb"), ("/vicepab", "/vicepab"),
+             ("0", "/vicepa"), ("25", "/vicepz"), ("26", "/vicepaa"), ("27", "/vicepab")]
+    for part,expected in cases:
+        assert normalize_partition(part) == expected, "part=%s" % part
+    for part in ("", "/vicep", "vicepabc", "b/"):
+        try:
+            normalize_partition(part)
+            assert False, "no error for %s" % part
+        except AssertionError as e:
+            assert str(e).startswith("Invalid partition name")
+
+def _test2():
+    entries = parse_listvldb(_LISTVLDB.splitlines())
+    assert [e.name for e in entries] == ["root.afs", "test.lock"]
+    root,lock = entries
+    assert root.ids == {'RW':536870912, 'RO':536870913}
+    assert len(root.sites) == 3
+    assert root.sites[2].flags == "Not released"
+    assert not root.locked
+    assert lock.locked
+    assert lock.ids['BK'] == 536870920
+    assert lock.sites[0].partition == "/vicepab"
+
+def _test3():
+    volumes = parse_listvol(_LISTVOL.splitlines())
+    assert len(volumes) == 4
+    rw,ro,busy,short = volumes
+    assert (rw.name, rw.id, rw.type, rw.status) == ("root.afs", 536870912, "RW", "On-line")
+    assert rw.maxquota == 5000 and rw.accesses == 7
+    assert ro.ids['RW'] == 536870912
+    assert (busy.id, busy.status, busy.partition) == (536870930, "busy", "/vicepa")
+    assert (short.name, short.partition, short.size) == ("test.short", "/vicepb", 4)
+
+def _test4():
+    header,entry = parse_examine(_EXAMINE.splitlines())
+    assert header.name == "root.afs.readonly"
+    assert header.server == "afs1.example.com"
+    assert header.partition == "/vicepa"
+    assert entry.name == "root.afs"
+    assert entry.ids == {'RW':536870912, 'RO':536870913}
+    assert len(entry.sites) == 2
+
+def _test5():
+    global vos_lines  # monkey patch a test stub.
+    calls = []
+    def stub(*args):
+        calls.append(args[0])
+        if args[0] == 'listvldb':
+            return _LISTVLDB.splitlines()
+        return _LISTVOL.splitlines()
+    vos_lines = stub
+    _addresses.update({'afs1.example.com':'10.0.0.1', 'afs2.example.com':'10.0.0.2', 'afs1':'10.0.0.1'})
+    index = VolumeIndex()
+    assert index.exists("root.afs")
+    assert index.exists("root.afs.readonly", part="b")
+    assert not index.exists("root.afs.backup")
+    assert index.exists("536870920")
+    assert index.exists("test.lock.backup", part="ab")
+    assert index.entry("test.lock").locked
+    assert index.entry("root.afs").has_site("afs1", "a", "RO")
+    assert not index.entry("root.afs").has_site("afs1", "b", "RO")
+    assert index.exists("root.afs", "afs1", "a")
+    assert not index.exists("root.afs", "afs1", "b")
+    assert index.exists("536870922", "afs1.example.com")
+    assert calls == ['listvldb', 'listvol']  # one of each
+    index.command_hook("vos examine", 0, 0, 0)
+    assert index.exists("root.afs")
+    assert calls == ['listvldb', 'listvol']
+    index.command_hook("vos release", 0, 0, 0)
+    assert index.exists("root.afs")
+    assert calls == ['listvldb', 'listvol', 'listvldb']
+    index.command_hook("sudo vos create", 0, 0, 0)  # run with Sudo
+    assert index.exists("root.afs")
+    assert calls == ['listvldb', 'listvol', 'listvldb', 'listvldb']
+    index.command_hook("sudo vos listvldb", 0, 0, 0)
+    assert index.exists("root.afs")
+    assert calls == ['listvldb', 'listvol', 'listvldb', 'listvldb']
+    # A change made by another thread while the VLDB is read is not lost.
+    changes = []
+    def changing_stub(*args):
+        t = threading.Thread(target=index.command_hook, args=("vos create", 0, 0, 0))
+        t.start()
+        changes.append(t)
+        time.sleep(0.1)
+        return stub(*args)
+    vos_lines = changing_stub
+    index.clear()
+    assert index.exists("root.afs")
+    changes[0].join()
+    assert index.entries is None
+
+def _test6():
+    global vos,fs  # monkey patch test stubs.
+    assert volume_names("test.%03d", 2) == ["test.001", "test.002"]
+    assert volume_names("test", 2) == ["test.1", "test.2"]
+    lock = threading.Lock()
+    busy = {}
+    calls = []
+    def vos_stub(*args):
+        part = args[args.index('-partition') + 1] if '-partition' in args else None
+        lock.acquire()
+        calls.append(args[0])
+        busy[part] = busy.get(part, 0) + 1
+        lock.release()
+        assert part is None or busy[part] <= 2, "too many commands on partition %s" % part
+        time.sleep(0.01)
+        lock.acquire()
+        busy[part] -= 1
+        lock.release()
+        return ""
+    vos = vos_stub
+    fs = lambda *args: calls.append(args[0])
+    _addresses['afs1'] = '10.0.0.1'
+    names = _VolumeKeywords().create_volumes("t.%d", 20, "afs1", parts="a,b",
+                path="/afs/.example.com/%s", acl="system:anyuser rl",
+                replicas="afs1:a", parent="root.cell", limit=10)
+    assert len(names) == 20
+    assert calls.count('create') == 20
+    assert calls.count('mkmount') == 20
+    assert calls.count('setacl') == 20
+    assert calls.count('addsite') == 20
+    assert calls.count('release') == 21  # each volume and the parent, once
+    assert calls.count('checkvolumes') == 1
+
+def main():
+    _test1()
+    _test2()
+    _test3()
+    _test4()
+    _test5()
+    _test6()
+
+if __name__ == "__main__":
+    # usage: python -m OpenAFSLibrary.keywords.volume
+    main()
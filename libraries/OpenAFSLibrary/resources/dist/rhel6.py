@@ -30,6 +30,7 @@ AKLOG = "/usr/bin/aklog"
 ASETKEY = "/usr/sbin/asetkey"
 BOS = "/usr/bin/bos"
 FS = "/usr/bin/fs"
+PAGSH = "/usr/bin/pagsh"
 PTS = "/usr/bin/pts"
 RXDEBUG = "/usr/sbin/rxdebug"
 TOKENS = "/usr/bin/tokens"
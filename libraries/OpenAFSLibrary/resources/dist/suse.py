@@ -32,6 +32,7 @@ AKLOG = "/usr/bin/aklog"
 ASETKEY = "/usr/sbin/asetkey"
 BOS = "/usr/sbin/bos"
 FS = "/usr/bin/fs"
+PAGSH = "/usr/bin/pagsh"
 PTS = "/usr/bin/pts"
 RXDEBUG = "/usr/sbin/rxdebug"
 TOKENS = "/usr/bin/tokens"
@@ -30,6 +30,7 @@ AKLOG = "/usr/afsws/bin/aklog"
 ASETKEY = "/usr/afs/bin/asetkey"
 BOS = "/usr/afs/bin/bos"
 FS = "/usr/afs/bin/fs"
+PAGSH = "/usr/afsws/bin/pagsh"
 PTS = "/usr/afs/bin/pts"
 RXDEBUG = "/usr/afsws/etc/rxdebug"
 TOKENS = "/usr/afsws/bin/tokens"
@@ -24,9 +24,21 @@ import os
 import re
 import imp
 import types
+import StringIO
+import time
+import atexit
+import ctypes
+import ctypes.util
+import threading
+import collections
 import subprocess
 from robot.api import logger
 from robot.libraries.BuiltIn import BuiltIn
+from OpenAFSLibrary.util.forkserver import ForkServer
+from OpenAFSLibrary.util.settingscache import SettingsCache
+from OpenAFSLibrary.util.sudohelper import SudoHelper
+from OpenAFSLibrary.util.metrics import CommandMetrics,SuiteMetrics,command_tag
+from OpenAFSLibrary.util.credentials import current_context,stop_contexts
 
 # Assume the root is relative to this module. In the future, an environment
 # variable may be needed.
@@ -35,32 +47,88 @@ DIST = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "resources"
 
 rf = BuiltIn()
 
+# The optional fork server backend for run_program. Started on first use
+# when the RUN_BACKEND setting is 'forkserver'.
+_forkserver = None
+_backend = None
+_backend_lock = threading.Lock()
+
+# The wrapper which runs the permitted commands as root, and the optional
+# long running helper, started on first use when the SUDO_BACKEND setting
+# is 'helper'.
+SUDO_WRAPPER = '/usr/sbin/afs-robotest-sudo'
+_sudo_helper = None
+_sudo_backend = None
+
+# Setting values, when running outside of RF.
+_settings = SettingsCache(ROOT, DIST)
+
+# Variable values looked up in the current keyword scope. This is only used
+# when the LibraryListener is active to clear it at the keyword boundaries;
+# the snapshot is enabled by the first listener call, so it stays off when
+# the listener is not supported (Robot Framework before 2.8.5).
+_snapshot = {}
+_snapshot_enabled = False
+
+# Measurements of the commands run, and the per-suite summaries.
+metrics = CommandMetrics()
+suite_metrics = SuiteMetrics(metrics)
+
+# Functions called with the (tag, seconds, rc, size) of each command run.
+_command_hooks = [metrics.record]
+
+# Functions called at the start of each suite and test, to discard cached
+# state which may have been changed outside of the library.
+_reset_hooks = []
+
 # Helpers
 
+class LibraryListener(object):
+    """Library listener to track the keyword scopes and suites."""
+    ROBOT_LISTENER_API_VERSION = 2
+
+    def start_suite(self, name, attrs):
+        begin_scope()
+        reset()
+        suite_metrics.start_suite()
+
+    def end_suite(self, name, attrs):
+        suite_metrics.end_suite(attrs['longname'])
+        output_dir = get_var('OUTPUT_DIR')
+        if output_dir:
+            suite_metrics.export(os.path.join(output_dir, "command-metrics.json"))
+
+    def start_test(self, name, attrs):
+        begin_scope()
+        reset()
+
+    def start_keyword(self, name, attrs):
+        begin_scope()
+
+    def end_keyword(self, name, attrs):
+        begin_scope()
+
+def begin_scope():
+    """Start a new variable snapshot."""
+    global _snapshot_enabled
+    _snapshot.clear()
+    _snapshot_enabled = True
+
+def refresh_settings():
+    """Discard the cached setting and variable values."""
+    _snapshot.clear()
+    _settings.refresh()
+
+def forget_var(name):
+    """Drop a variable from the snapshot after its value is changed."""
+    _snapshot.pop(name, None)
+
 def _emulate_get_variable_value(name):
     """Lookup setting variables when running outside of RF.
 
     This allows the setup tools to call library keywords.
     """
-    if name == 'SITE':
-        value = os.path.join(ROOT, 'site')
-        return value
-    # Local settings.
-    settings_py = os.path.join(ROOT, 'settings.py')
-    if not os.path.isfile(settings_py):
-        raise AssertionError("Cannot find settings.py file! path=%s" % settings_py)
-    settings = imp.load_source('settings', settings_py)
-    value = getattr(settings, name, None)
-    if value is not None:
-        return value
-    # Default settings for the current distribution type.
-    dist_py = os.path.join(DIST, "%s.py" % getattr(settings, 'AFS_DIST'))
-    if dist_py is None or not os.path.isfile(dist_py):
-        raise AssertionError("Cannot find dist.py file! path=%s" % dist_py)
-    dist = imp.load_source('settings.dist', dist_py)
-    value = getattr(dist, name, None)
-    return value  # may be None
-
+    return _settings.get(name)  # may be None
 
 def load_globals(path):
     """Load defaults into the global variable namespace."""
@@ -72,16 +140,171 @@ def load_globals(path):
             value = getattr(module, name, None)
             if value and not get_var(name):
                 rf.set_global_variable("${%s}" % name, value)
+                forget_var(name)
         except AttributeError:
             pass # allow to load outside of RF
 
 def get_var(name):
     """Return the named variable value or None if it does not exist."""
     try:
-        return rf.get_variable_value("${%s}" % name)
+        return _snapshot[name]
+    except KeyError:
+        pass
+    try:
+        value = rf.get_variable_value("${%s}" % name)
     except AttributeError:
         # Look in the settings files directly when running outside of the RF.
         return _emulate_get_variable_value(name)
+    if _snapshot_enabled:
+        _snapshot[name] = value
+    return value
+
+def start_forkserver():
+    """Start the fork server helper process and use it to run programs."""
+    global _forkserver, _backend
+    _backend_lock.acquire()
+    try:
+        if _forkserver is None or not _forkserver.is_running():
+            _forkserver = ForkServer()
+            _forkserver.start()
+        _backend = 'forkserver'
+    finally:
+        _backend_lock.release()
+
+def stop_forkserver():
+    """Stop the fork server helper process and run programs directly."""
+    global _forkserver, _backend
+    _backend_lock.acquire()
+    try:
+        if _forkserver is not None:
+            _forkserver.stop()
+            _forkserver = None
+        _backend = 'subprocess'
+    finally:
+        _backend_lock.release()
+
+def _get_backend():
+    """Returns the fork server when enabled, otherwise None."""
+    global _backend
+    if _backend is None:
+        try:
+            backend = get_var('RUN_BACKEND')
+        except AssertionError:
+            backend = None  # no settings file
+        if backend == 'forkserver':
+            start_forkserver()
+        else:
+            _backend = 'subprocess'
+    forkserver = _forkserver
+    if _backend == 'forkserver' and forkserver is not None:
+        return forkserver
+    return None
+
+atexit.register(stop_forkserver)
+
+def start_sudo_helper():
+    """Start the privileged helper process and use it to run sudo commands."""
+    global _sudo_helper, _sudo_backend
+    _backend_lock.acquire()
+    try:
+        if _sudo_helper is None or not _sudo_helper.is_running():
+            helper = SudoHelper(SUDO_WRAPPER)
+            helper.start()
+            _sudo_helper = helper
+        _sudo_backend = 'helper'
+    finally:
+        _backend_lock.release()
+
+def stop_sudo_helper():
+    """Stop the privileged helper process and run sudo for each command."""
+    global _sudo_helper, _sudo_backend
+    _backend_lock.acquire()
+    try:
+        if _sudo_helper is not None:
+            _sudo_helper.stop()
+            _sudo_helper = None
+        _sudo_backend = 'sudo'
+    finally:
+        _backend_lock.release()
+
+def _get_sudo_helper():
+    """Returns the privileged helper when enabled, otherwise None."""
+    global _sudo_backend
+    if _sudo_backend is None:
+        try:
+            backend = get_var('SUDO_BACKEND')
+        except AssertionError:
+            backend = None  # no settings file
+        if backend == 'helper':
+            start_sudo_helper()
+        else:
+            _sudo_backend = 'sudo'
+    helper = _sudo_helper
+    if _sudo_backend == 'helper' and helper is not None:
+        return helper
+    return None
+
+atexit.register(stop_sudo_helper)
+atexit.register(stop_contexts)
+
+def add_command_hook(hook):
+    """Call hook(tag, seconds, rc, size) after each program is run.
+
+    The tag is the tool and subcommand, e.g. 'vos release'.
+    """
+    _command_hooks.append(hook)
+
+def add_reset_hook(hook):
+    """Call hook() at the start of each suite and test."""
+    _reset_hooks.append(hook)
+
+def reset():
+    """Call the reset hooks."""
+    for hook in _reset_hooks:
+        hook()
+
+def is_true(value):
+    """Returns the boolean value of a keyword argument."""
+    if isinstance(value, basestring):
+        return value.lower() in ('true', 'yes', '1')
+    return bool(value)
+
+def libc_function(name, restype, argtypes):
+    """Returns the named libc function, or None if it is not available."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    func.restype = restype
+    func.argtypes = argtypes
+    return func
+
+def first_difference(a, b):
+    """Returns the index of the first differing byte of a and b."""
+    n = min(len(a), len(b))
+    low,high = 0, n
+    # Narrow down by comparing halves; avoids a python loop over every byte.
+    while high - low > 64:
+        mid = (low + high) // 2
+        if a[low:mid] != b[low:mid]:
+            high = mid
+        else:
+            low = mid
+    for i in xrange(low, high):
+        if a[i] != b[i]:
+            return i
+    return n
+
+def record_command(args, seconds, rc, size):
+    """Pass the measurements of a program run to the command hooks.
+
+    Used for programs which are not run with run_program, for example
+    requests sent to a long running process.
+    """
+    tag = command_tag(args)
+    for hook in _command_hooks:
+        hook(tag, seconds, rc, size)
 
 def run_program(args):
     if isinstance(args, types.StringTypes):
@@ -90,15 +313,156 @@ def run_program(args):
     else:
         logger.info("running: args=%s" % " ".join(args))
         shell = False
-    proc = subprocess.Popen(args, shell=shell, bufsize=-1, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, error = proc.communicate()
-    if proc.returncode:
+    start = time.time()
+    context = current_context()
+    forkserver = _get_backend()
+    if context:
+        rc, output, error = context.run(args, shell=shell)
+    elif forkserver:
+        rc, output, error = forkserver.run(args, shell=shell)
+    else:
+        proc = subprocess.Popen(args, shell=shell, bufsize=-1, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, error = proc.communicate()
+        rc = proc.returncode
+    record_command(args, time.time() - start, rc, len(output) + len(error))
+    if rc:
         logger.info("output: " + output)
         logger.info("error:  " + error)
-    return (proc.returncode, output, error)
+    return (rc, output, error)
+
+class _ContextProcess(object):
+    """The completed output of a program run in a credential context, with
+    the parts of the Popen interface used by ProgramStream."""
+
+    def __init__(self, context, args, shell):
+        self.returncode,output,error = context.run(args, shell=shell)
+        self.stdout = StringIO.StringIO(output)
+        self.stderr = StringIO.StringIO(error)
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        return self.returncode
+
+    def terminate(self):
+        pass
+
+class ProgramStream(object):
+    """Read the output of a program as it is produced.
+
+    Iterate over the stream to get the output lines, or use chunks() to get
+    fixed size blocks. The output is not buffered, other than the last few
+    lines (or chunks) of output and error, which are logged if the program
+    fails. The returncode is set once the output has been read.
+
+    Programs run in a credential context are run to completion first.
+    """
+
+    def __init__(self, args, tail=100):
+        if isinstance(args, types.StringTypes):
+            logger.info("running: string=%s" % args)
+            shell = True
+        else:
+            logger.info("running: args=%s" % " ".join(args))
+            shell = False
+        self.args = args
+        self.start = time.time()
+        self.size = 0
+        self.returncode = None
+        self.eof = False
+        self.output = collections.deque(maxlen=tail)
+        self.error = collections.deque(maxlen=tail)
+        context = current_context()
+        if context:
+            self.proc = _ContextProcess(context, args, shell)
+        else:
+            self.proc = subprocess.Popen(args, shell=shell, bufsize=-1, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # Drain stderr in the background so the program can not block on it.
+        self.reader = threading.Thread(target=self._read_error)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def _read_error(self):
+        for line in iter(self.proc.stderr.readline, ''):
+            self.size += len(line)
+            self.error.append(line)
+
+    def __iter__(self):
+        """Yield the output lines."""
+        try:
+            for line in iter(self.proc.stdout.readline, ''):
+                self.size += len(line)
+                self.output.append(line)
+                yield line
+            self.eof = True
+        finally:
+            self.close()
+
+    def chunks(self, size=65536):
+        """Yield the output in blocks of up to size bytes."""
+        try:
+            for chunk in iter(lambda: self.proc.stdout.read(size), ''):
+                self.size += len(chunk)
+                self.output.append(chunk)
+                yield chunk
+            self.eof = True
+        finally:
+            self.close()
+
+    def close(self):
+        """Wait for the program to exit. The program is stopped if the
+        output has not been completely read."""
+        if self.returncode is not None:
+            return self.returncode
+        if not self.eof and self.proc.poll() is None:
+            try:
+                self.proc.terminate()
+            except OSError:
+                pass  # already exited
+        self.proc.stdout.close()
+        self.returncode = self.proc.wait()
+        self.reader.join()
+        record_command(self.args, time.time() - self.start, self.returncode, self.size)
+        if self.returncode:
+            logger.info("output: " + "".join(self.output))
+            logger.info("error:  " + "".join(self.error))
+        return self.returncode
+
+def stream_program(args, tail=100):
+    """Run a program and return a ProgramStream to read the output."""
+    return ProgramStream(args, tail)
+
+def _command_lines(name, args):
+    """Yield the output lines of an AFS command. Fails if the command fails."""
+    stream = ProgramStream(args)
+    try:
+        for line in stream:
+            yield line
+    finally:
+        stream.close()
+    if stream.returncode != 0:
+        raise AssertionError("%s failed! %s" % (name, "".join(stream.error)))
+
+def vos_lines(*args):
+    """Yield the output lines of a vos command as they are produced."""
+    return _command_lines('vos', [get_var('VOS')] + list(args))
+
+def fs_lines(*args):
+    """Yield the output lines of a fs command as they are produced."""
+    return _command_lines('fs', [get_var('FS')] + list(args))
 
 def sudo(cmd, *args):
-    rc,out,err = run_program(['sudo', '-n', '/usr/sbin/afs-robotest-sudo', cmd] + list(args))
+    helper = _get_sudo_helper()
+    if helper:
+        logger.info("running: sudo helper: %s" % " ".join([cmd] + list(args)))
+        start = time.time()
+        rc,out = helper.run([cmd] + list(args))
+        record_command(['sudo', SUDO_WRAPPER, cmd] + list(args), time.time() - start, rc, len(out))
+        if rc:
+            logger.info("output: " + out)
+    else:
+        rc,out,err = run_program(['sudo', '-n', SUDO_WRAPPER, cmd] + list(args))
     if rc == os.EX_NOPERM:
         raise AssertionError("Command not permitted: %s\n" % (cmd));
     if rc != 0:
@@ -122,6 +486,12 @@ def vos(*args):
         raise AssertionError("vos failed! %s" % (err))
     return out
 
+def pts(*args):
+    rc,out,err = run_program([get_var('PTS')] + list(args))
+    if rc != 0:
+        raise AssertionError("pts failed! %s" % (err))
+    return out
+
 def fs(*args):
     rc,out,err = run_program([get_var('FS')] + list(args))
     if rc != 0:
@@ -0,0 +1,218 @@
+# Copyright (c) 2015 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+"""Streaming bandwidth and IOPS benchmarks of a file system path.
+
+Each worker thread reads or writes its own file in blocks, sequentially
+or at random block aligned offsets, and records the latency of each
+block. Writes are buffered, or followed by an fsync of each block. The
+close of a written file, where the AFS client stores the data, is timed
+as part of the last block. The cached pages of the files are dropped
+before the reads, unless warm cache reads are wanted.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import ctypes
+from OpenAFSLibrary.util import libc_function
+from OpenAFSLibrary.util.metrics import percentile
+from OpenAFSLibrary.util.parallel import parallel_map
+
+PATTERNS = ('seqwrite', 'seqread', 'randwrite', 'randread')
+
+POSIX_FADV_DONTNEED = 4
+_posix_fadvise = libc_function('posix_fadvise64', ctypes.c_int,
+                        [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int])
+
+def drop_cache(path):
+    """Drop the cached pages of a file from the local page cache."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)  # dirty pages are not dropped
+        if _posix_fadvise is not None:
+            _posix_fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+def _file_name(directory, worker):
+    return os.path.join(directory, "bench.%d" % (worker))
+
+def _run_worker(path, pattern, size, block_size, sync, seed):
+    """Run one pattern on one file. Returns the list of block latencies."""
+    blocks = size // block_size
+    data = buffer(os.urandom(block_size))
+    if pattern.endswith('read'):
+        flags = os.O_RDONLY
+    elif pattern == 'seqwrite':
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    else:
+        flags = os.O_WRONLY | os.O_CREAT
+    if pattern.startswith('rand'):
+        r = random.Random(seed)
+        offsets = [r.randrange(0, blocks) * block_size for i in xrange(0, blocks)]
+    else:
+        offsets = None
+    latencies = []
+    fd = os.open(path, flags, 0644)
+    try:
+        for i in xrange(0, blocks):
+            start = time.time()
+            if offsets:
+                os.lseek(fd, offsets[i], os.SEEK_SET)
+            if flags == os.O_RDONLY:
+                if len(os.read(fd, block_size)) != block_size:
+                    raise AssertionError("Short read of %s at block %d." % (path, i))
+            else:
+                os.write(fd, data)
+                if sync:
+                    os.fsync(fd)
+            if i == blocks - 1:
+                os.close(fd)  # the AFS client stores the data on close
+                fd = None
+            latencies.append(time.time() - start)
+    finally:
+        if fd is not None:
+            os.close(fd)
+    return latencies
+
+def _prepare(path, size, block_size):
+    """Create a file to read or rewrite, unless it already has the size."""
+    if os.path.exists(path) and os.path.getsize(path) >= size:
+        return
+    _run_worker(path, 'seqwrite', size, block_size, False, 0)
+
+def run_benchmark(directory, pattern, size, block_size, workers=1, sync=False, seed=0,
+                  flush=None):
+    """Run a pattern with a file of size bytes for each worker.
+
+    The flush function is called with the list of files before a read
+    pattern, to drop them from the caches; the reads are warm cache reads
+    when it is None. Returns a dict of the bytes, seconds, mb_per_sec,
+    iops and the block latency percentiles in milliseconds.
+    """
+    if pattern not in PATTERNS:
+        raise AssertionError("Invalid benchmark pattern: %s" % (pattern))
+    if block_size < 1 or size < block_size:
+        raise AssertionError("Invalid benchmark size %d or block size %d." % (size, block_size))
+    paths = [_file_name(directory, i) for i in xrange(0, workers)]
+    if pattern != 'seqwrite':
+        parallel_map(lambda p: _prepare(p, size, block_size), paths, limit=workers)
+    cold = pattern.endswith('read') and flush is not None
+    if cold:
+        flush(paths)
+    start = time.time()
+    results = parallel_map(lambda i: _run_worker(paths[i], pattern, size, block_size, sync, seed + i),
+                           range(0, workers), limit=workers)
+    seconds = max(time.time() - start, 1e-6)
+    latencies = sorted([l for r in results for l in r])
+    total = len(latencies) * block_size
+    result = {
+        'pattern': pattern,
+        'sync': bool(sync),
+        'cache': ('cold' if cold else 'warm') if pattern.endswith('read') else None,
+        'workers': workers,
+        'block_size': block_size,
+        'bytes': total,
+        'seconds': seconds,
+        'mb_per_sec': total / seconds / (1024 * 1024),
+        'iops': len(latencies) / seconds,
+    }
+    for p in (50, 95, 99):
+        result['p%d_ms' % p] = percentile(latencies, p) * 1000
+    result['max_ms'] = latencies[-1] * 1000
+    return result
+
+def remove_files(directory, workers):
+    for i in xrange(0, workers):
+        path = _file_name(directory, i)
+        if os.path.exists(path):
+            os.remove(path)
+
+def format_results(results):
+    """Returns a text table of benchmark results."""
+    lines = ["%-10s %-9s %4s %5s %8s %10s %10s %9s %9s %9s %8s" % \
+        ("pattern", "target", "sync", "cache", "block", "MB/s", "IOPS", "p50 ms", "p95 ms", "p99 ms", "ratio")]
+    for r in results:
+        ratio = r.get('ratio')
+        cache = r['cache'] or "-"
+        lines.append("%-10s %-9s %4s %5s %8d %10.1f %10.0f %9.3f %9.3f %9.3f %8s" % \
+            (r['pattern'], r['target'], "yes" if r['sync'] else "no", cache, r['block_size'],
+             r['mb_per_sec'], r['iops'], r['p50_ms'], r['p95_ms'], r['p99_ms'],
+             "%.2f" % ratio if ratio is not None else "-"))
+    return "\n".join(lines)
+
+def export(filename, runs):
+    """Write the benchmark runs to a json file."""
+    f = open(filename + ".tmp", "w")
+    json.dump({'benchmarks': runs}, f, indent=1, sort_keys=True)
+    f.close()
+    os.rename(filename + ".tmp", filename)
+
+#
+# Unit tests
+#
+def _test1():
+    import tempfile, shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        results = []
+        flushed = []
+        def flush(paths):
+            flushed.extend(paths)
+            for path in paths:
+                drop_cache(path)
+        for sync in (False, True):
+            for pattern in PATTERNS:
+                r = run_benchmark(tmpdir, pattern, 256 * 1024, 4096, workers=2, sync=sync,
+                                  flush=flush if sync else None)
+                if pattern.endswith('read'):
+                    assert r['cache'] == ('cold' if sync else 'warm'), r
+                else:
+                    assert r['cache'] is None, r
+                assert r['bytes'] == 2 * 256 * 1024 and r['iops'] > 0, r
+                assert r['p50_ms'] <= r['p95_ms'] <= r['p99_ms'] <= r['max_ms'], r
+                r['target'] = 'local'
+                results.append(r)
+        assert os.path.getsize(os.path.join(tmpdir, "bench.1")) == 256 * 1024
+        assert len(flushed) == 4  # two read patterns of two files
+        print format_results(results)
+        export(os.path.join(tmpdir, "bench.json"), results)
+        assert len(json.load(open(os.path.join(tmpdir, "bench.json")))['benchmarks']) == 8
+        remove_files(tmpdir, 2)
+        assert os.listdir(tmpdir) == ["bench.json"]
+        try:
+            run_benchmark(tmpdir, 'seqwrite', 100, 4096)
+            error = None
+        except AssertionError, e:
+            error = e
+        assert error
+    finally:
+        shutil.rmtree(tmpdir)
+
+def main():
+    _test1()
+
+if __name__ == "__main__":
+    # usage: python -m OpenAFSLibrary.util.bench
+    main()
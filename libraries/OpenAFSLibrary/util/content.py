@@ -0,0 +1,328 @@
+# Copyright (c) 2015 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+"""Deterministic file contents which can be checked without a copy.
+
+The content of a file is a window into a pool of random bytes made from
+the seed. The window starts at a position derived from the seed and the
+file name, so files have different contents. The first 16 bytes of each
+512 byte sector are replaced with a stamp of the file key and the sector
+offset, so a sector read from the wrong file or the wrong offset, or a
+zero filled page, does not match. Any range of a file can be generated
+again from the (seed, name, offset), so nothing is kept in memory.
+
+The sizes of the files are recorded in a manifest at the top of the
+population, so a truncated or short file is found as well.
+"""
+
+import os
+import sys
+import json
+import time
+import struct
+import random
+import hashlib
+import threading
+from OpenAFSLibrary.util import first_difference
+from OpenAFSLibrary.util.parallel import parallel_map
+
+SECTOR_SIZE = 512
+POOL_SIZE = 1024 * 1024 + 4099  # not a multiple of the sector size
+CHUNK_SIZE = 1024 * 1024        # the largest range generated at once
+SEGMENT_SIZE = 64 * 1024 * 1024 # the part of a file verified by one worker
+MANIFEST = ".robotest-manifest" # the expected file sizes, by relative name
+
+_STAMP = struct.Struct("!QQ")
+
+class ContentGenerator(object):
+    """Generates the content of files from a seed."""
+
+    def __init__(self, seed=0):
+        self.seed = int(seed)
+        r = random.Random(self.seed)
+        pool = "".join([struct.pack("!Q", r.getrandbits(64)) for i in xrange(0, POOL_SIZE // 8 + 1)])
+        pool = pool[:POOL_SIZE]
+        self.pool = pool + pool[:CHUNK_SIZE + SECTOR_SIZE]  # no wrap around within a chunk
+        self.keys = {}
+        self.lock = threading.Lock()
+
+    def key(self, name):
+        """Returns the 64 bit key of a file name."""
+        key = self.keys.get(name)
+        if key is None:
+            digest = hashlib.md5("%d:%s" % (self.seed, name)).digest()
+            key = struct.unpack("!Q", digest[:8])[0]
+            self.lock.acquire()
+            try:
+                self.keys[name] = key
+            finally:
+                self.lock.release()
+        return key
+
+    def _chunk(self, key, offset, length):
+        """Returns length bytes at a sector aligned offset."""
+        start = (key + offset) % POOL_SIZE
+        data = bytearray(buffer(self.pool, start, length))
+        for pos in xrange(0, length - _STAMP.size + 1, SECTOR_SIZE):
+            _STAMP.pack_into(data, pos, key, offset + pos)
+        tail = length % SECTOR_SIZE
+        if 0 < tail < _STAMP.size:  # a partial stamp in a short last sector
+            pos = length - tail
+            data[pos:] = _STAMP.pack(key, offset + pos)[:tail]
+        return data
+
+    def generate(self, name, offset, length):
+        """Returns the content of the file name at offset as a bytearray."""
+        key = self.key(name)
+        skip = offset % SECTOR_SIZE
+        offset -= skip
+        length += skip
+        parts = []
+        while length > 0:
+            n = min(length, CHUNK_SIZE)
+            parts.append(self._chunk(key, offset, n))
+            offset += n
+            length -= n
+        if len(parts) == 1:
+            data = parts[0]
+        else:
+            data = bytearray().join(parts)
+        if skip:
+            del data[:skip]
+        return data
+
+    def write(self, fd, name, size):
+        """Write the content of a file of size bytes to fd."""
+        offset = 0
+        while offset < size:
+            n = min(size - offset, CHUNK_SIZE)
+            data = self._chunk(self.key(name), offset, n)
+            written = 0
+            while written < n:
+                written += os.write(fd, buffer(data, written))
+            offset += n
+
+class ContentVerifier(object):
+    """Reads files in parallel and compares them with the generated content."""
+
+    def __init__(self, generator, chunk_size=CHUNK_SIZE, segment_size=SEGMENT_SIZE):
+        self.generator = generator
+        self.chunk_size = int(chunk_size)
+        self.segment_size = int(segment_size)
+
+    def _segments(self, root, names, sizes):
+        """Returns the segments to read, and the (name, offset) of the files
+        which do not have the expected size."""
+        segments = []
+        wrong = []
+        for name in names:
+            try:
+                size = os.path.getsize(os.path.join(root, name))
+            except OSError:
+                size = None  # missing
+            expected = sizes.get(name, size)
+            if size != expected:
+                wrong.append((name, min(size or 0, expected)))
+                size = min(size, expected)
+            if size is None:
+                continue
+            for offset in xrange(0, max(size, 1), self.segment_size):
+                segments.append((name, offset, min(self.segment_size, size - offset)))
+        return segments, wrong
+
+    def _verify_segment(self, root, segment):
+        """Returns (bytes read, mismatch offset or None) of one segment."""
+        name,offset,length = segment
+        f = open(os.path.join(root, name), 'rb', 0)
+        try:
+            f.seek(offset)
+            done = 0
+            while done < length:
+                data = f.read(min(self.chunk_size, length - done))
+                if not data:
+                    return done, offset + done  # shorter than expected
+                expected = self.generator.generate(name, offset + done, len(data))
+                if data != expected:
+                    return done, offset + done + first_difference(data, expected)
+                done += len(data)
+            return done, None
+        finally:
+            f.close()
+
+    def verify(self, root, names, workers=1, sizes=None):
+        """Verify the files. Returns a dict with the bytes, seconds, mb_per_sec
+        and the first mismatch as (name, offset), or None.
+
+        The sizes are the expected sizes of the files by name; a file of
+        another size, or a missing file, is a mismatch at the end of the
+        shorter of the two.
+        """
+        start = time.time()
+        segments,wrong = self._segments(root, names, sizes or {})
+        results = parallel_map(lambda s: self._verify_segment(root, s), segments, limit=workers)
+        seconds = max(time.time() - start, 1e-6)
+        mismatches = [(s[0], r[1]) for s,r in zip(segments, results) if r[1] is not None]
+        mismatches.extend(wrong)
+        size = sum([r[0] for r in results])
+        return {
+            'files': len(names),
+            'bytes': size,
+            'seconds': seconds,
+            'mb_per_sec': size / seconds / (1024 * 1024),
+            'mismatch': min(mismatches) if mismatches else None,
+            'mismatches': len(set([m[0] for m in mismatches])),  # files
+        }
+
+def list_files(root):
+    """Returns the sorted relative names of the files under root."""
+    names = []
+    for directory,subdirs,files in os.walk(root):
+        rel = os.path.relpath(directory, root)
+        for name in files:
+            names.append(os.path.normpath(os.path.join(rel, name)))
+    if MANIFEST in names:
+        names.remove(MANIFEST)
+    names.sort()
+    return names
+
+_manifest_lock = threading.Lock()
+
+def read_manifest(root):
+    """Returns the expected file sizes by name, or None if there is no
+    manifest."""
+    try:
+        f = open(os.path.join(root, MANIFEST))
+    except IOError:
+        return None
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def update_manifest(root, sizes):
+    """Add the sizes of files by name to the manifest of root."""
+    _manifest_lock.acquire()
+    try:
+        manifest = read_manifest(root) or {}
+        manifest.update(sizes)
+        filename = os.path.join(root, MANIFEST)
+        f = open(filename + ".tmp", "w")
+        json.dump(manifest, f, sort_keys=True)
+        f.close()
+        os.rename(filename + ".tmp", filename)
+    finally:
+        _manifest_lock.release()
+
+#
+# Unit tests
+#
+def _test1():
+    g = ContentGenerator(7)
+    a = g.generate("f1", 0, 3 * CHUNK_SIZE + 1000)
+    assert len(a) == 3 * CHUNK_SIZE + 1000
+    # Any range can be generated on its own.
+    for offset,length in ((0, 10), (5, 600), (511, 2), (CHUNK_SIZE - 7, 20),
+                          (2 * CHUNK_SIZE + 100, CHUNK_SIZE + 300)):
+        assert g.generate("f1", offset, length) == a[offset:offset + length], (offset, length)
+    assert ContentGenerator(7).generate("f1", 4096, 4096) == a[4096:8192]
+    assert ContentGenerator(8).generate("f1", 4096, 4096) != a[4096:8192]
+    assert g.generate("f2", 0, 4096) != a[:4096]
+    # Every sector is different, even within one file.
+    sectors = set([str(a[i:i + SECTOR_SIZE]) for i in xrange(0, len(a), SECTOR_SIZE)])
+    assert len(sectors) == (len(a) + SECTOR_SIZE - 1) // SECTOR_SIZE
+    assert first_difference("abcdef" * 100, "abcdef" * 50 + "abcdeX") == 305
+
+def _test2():
+    import tempfile, shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        g = ContentGenerator(1)
+        sizes = {"a": 0, "b": 100, "d/c": 3 * CHUNK_SIZE + 17}
+        os.mkdir(os.path.join(tmpdir, "d"))
+        for name,size in sizes.items():
+            fd = os.open(os.path.join(tmpdir, name), os.O_WRONLY | os.O_CREAT, 0644)
+            g.write(fd, name, size)
+            os.close(fd)
+        names = list_files(tmpdir)
+        assert names == ["a", "b", "d/c"], names
+        v = ContentVerifier(ContentGenerator(1), segment_size=CHUNK_SIZE)
+        result = v.verify(tmpdir, names, workers=4)
+        assert result['mismatch'] is None and result['bytes'] == sum(sizes.values())
+        # A zero page is found.
+        f = open(os.path.join(tmpdir, "d/c"), "r+b")
+        f.seek(2 * CHUNK_SIZE + 4096)
+        f.write('\0' * 4096)
+        f.close()
+        result = v.verify(tmpdir, names, workers=4)
+        assert result['mismatch'] == ("d/c", 2 * CHUNK_SIZE + 4096), result
+        # The content of another file is found.
+        os.rename(os.path.join(tmpdir, "b"), os.path.join(tmpdir, "e"))
+        result = ContentVerifier(ContentGenerator(1)).verify(tmpdir, ["e"])
+        assert result['mismatch'] == ("e", 0), result
+        # Short, long and missing files are found with the manifest.
+        update_manifest(tmpdir, sizes)
+        assert read_manifest(tmpdir) == sizes and MANIFEST not in list_files(tmpdir)
+        os.rename(os.path.join(tmpdir, "e"), os.path.join(tmpdir, "b"))
+        f = open(os.path.join(tmpdir, "d/c"), "r+b")
+        f.truncate(2 * CHUNK_SIZE)
+        f.close()
+        os.remove(os.path.join(tmpdir, "a"))
+        fd = os.open(os.path.join(tmpdir, "f"), os.O_WRONLY | os.O_CREAT, 0644)
+        g.write(fd, "f", 10)
+        os.close(fd)
+        update_manifest(tmpdir, {"f": 5})
+        manifest = read_manifest(tmpdir)
+        result = v.verify(tmpdir, sorted(manifest), workers=4, sizes=manifest)
+        assert result['mismatch'] == ("a", 0) and result['mismatches'] == 3, result
+        result = v.verify(tmpdir, ["b", "d/c"], sizes=manifest)
+        assert result['mismatch'] == ("d/c", 2 * CHUNK_SIZE), result
+        result = v.verify(tmpdir, ["b", "d/c"])  # without the sizes
+        assert result['mismatch'] is None, result
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench(size=256):
+    """Time generating and verifying a file of size MB."""
+    import tempfile
+    g = ContentGenerator(1)
+    size = int(size) * 1024 * 1024
+    fd,path = tempfile.mkstemp()
+    try:
+        start = time.time()
+        g.write(fd, os.path.basename(path), size)
+        os.close(fd)
+        written = time.time()
+        result = ContentVerifier(g).verify(os.path.dirname(path), [os.path.basename(path)])
+        print "generate and write: %.1f MB/s" % (size / (written - start) / 1024 / 1024)
+        print "read and verify:    %.1f MB/s (mismatch=%s)" % (result['mb_per_sec'], result['mismatch'])
+    finally:
+        os.remove(path)
+
+def main(args):
+    if args and args[0] == "--bench":
+        bench(*args[1:2])
+        return
+    _test1()
+    _test2()
+
+if __name__ == "__main__":
+    # usage: python -m OpenAFSLibrary.util.content [--bench [<MB>]]
+    main(sys.argv[1:])
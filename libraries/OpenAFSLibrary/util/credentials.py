@@ -0,0 +1,268 @@
+# Copyright (c) 2015 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+"""Credential contexts for running commands as different users at once.
+
+AFS tokens belong to a process authentication group (PAG), which is
+inherited by child processes. A context keeps a shell running in its own
+PAG (started with pagsh) and runs the commands of the context in that
+shell, with KRB5CCNAME set to the credential cache of the context. The
+commands run by a thread are sent to the context the thread has entered;
+other threads are not affected.
+"""
+
+import os
+import time
+import pipes
+import shutil
+import tempfile
+import threading
+import subprocess
+
+_local = threading.local()
+_contexts = {}
+_contexts_lock = threading.Lock()
+
+class CredentialContext(object):
+    """A shell with its own PAG and Kerberos credential cache."""
+
+    def __init__(self, name, ccache, pagsh=None):
+        self.name = name
+        self.ccache = ccache
+        self.pagsh = pagsh
+        self.proc = None
+        self.tmpdir = None
+        self.count = 0
+        self.data = {}  # per-context state of the callers, e.g. tokens
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the context shell, in a new PAG when pagsh is available."""
+        self.tmpdir = tempfile.mkdtemp(prefix="afs-robotest-context.")
+        env = dict(os.environ)
+        env['KRB5CCNAME'] = self.ccache
+        # pagsh runs the login shell of the user, which may be csh, so
+        # the commands are always sent to a Bourne shell.
+        if self.pagsh and os.access(self.pagsh, os.X_OK):
+            command = [self.pagsh, '-c', 'exec /bin/sh']
+        else:
+            command = ['/bin/sh']  # no PAG; tokens are shared
+        devnull = open(os.devnull, 'w')
+        try:
+            self.proc = subprocess.Popen(command, close_fds=True, env=env,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=devnull)
+        finally:
+            devnull.close()
+
+    def stop(self):
+        """Stop the context shell."""
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close()  # the shell exits at end of file
+            except (IOError, OSError):
+                pass
+            self.proc.wait()
+            self.proc = None
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            self.tmpdir = None
+
+    def is_running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def run(self, args, shell=False):
+        """Run a command in the context. Returns (rc, output, error).
+
+        The args are an argument list, or a shell command string when
+        shell is true, as for subprocess.
+        """
+        if shell:
+            command = args
+        else:
+            command = " ".join([pipes.quote(a) for a in args])
+        self.lock.acquire()
+        try:
+            if not self.is_running():
+                self.start()
+            self.count += 1
+            marker = "robotest_context_%d" % (self.count)
+            out = os.path.join(self.tmpdir, "out")
+            err = os.path.join(self.tmpdir, "err")
+            try:
+                self.proc.stdin.write("( %s\n) </dev/null >%s 2>%s; echo %s $?\n" % \
+                    (command, pipes.quote(out), pipes.quote(err), marker))
+                self.proc.stdin.flush()
+            except (IOError, OSError):
+                self.stop()
+                raise AssertionError("Context shell '%s' is not running." % (self.name))
+            while True:
+                line = self.proc.stdout.readline()
+                if not line:
+                    self.stop()
+                    raise AssertionError("Context shell '%s' exited." % (self.name))
+                if line.startswith(marker + " "):
+                    rc = int(line.split()[1])
+                    break
+            output = open(out).read()
+            error = open(err).read()
+            return (rc, output, error)
+        finally:
+            self.lock.release()
+
+def create_context(name, ccache, pagsh=None):
+    """Create a named context, replacing an existing one."""
+    context = CredentialContext(name, ccache, pagsh)
+    _contexts_lock.acquire()
+    try:
+        old = _contexts.pop(name, None)
+        _contexts[name] = context
+    finally:
+        _contexts_lock.release()
+    if old is not None:
+        old.stop()
+    return context
+
+def get_context(name):
+    """Returns the named context. Fails if the context does not exist."""
+    context = _contexts.get(name)
+    if context is None:
+        raise AssertionError("Credential context '%s' does not exist." % (name))
+    return context
+
+def remove_context(name):
+    """Stop the named context and forget it."""
+    _contexts_lock.acquire()
+    try:
+        context = _contexts.pop(name, None)
+    finally:
+        _contexts_lock.release()
+    if context is not None:
+        context.stop()
+    return context
+
+def stop_contexts():
+    for name in list(_contexts.keys()):
+        remove_context(name)
+
+def current_context():
+    """Returns the context entered by the calling thread, or None."""
+    return getattr(_local, 'context', None)
+
+def run_as(name, func, *args, **kwargs):
+    """Call func in the named context on the calling thread."""
+    context = get_context(name)
+    saved = current_context()
+    _local.context = context
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _local.context = saved
+
+#
+# Unit tests
+#
+_FAKE_PAGSH = """#!/bin/sh
+# The login shell of the user with a new fake PAG number.
+FAKE_PAG=$$
+export FAKE_PAG
+exec "$FAKE_PAG_DIR/loginshell" "$@"
+"""
+
+_FAKE_LOGIN_SHELL = """#!/bin/sh
+# A login shell which does not understand Bourne shell input, like csh.
+if [ "$1" = "-c" ]; then
+    exec /bin/sh -c "$2"
+fi
+echo "Missing name for redirect." >&2
+exit 1
+"""
+
+_FAKE_KINIT = """#!/bin/sh
+# usage: kinit <principal>; the credential cache holds the principal name
+echo "$1" > "$KRB5CCNAME"
+"""
+
+_FAKE_AKLOG = """#!/bin/sh
+cat "$KRB5CCNAME" > "$FAKE_PAG_DIR/pag.$FAKE_PAG"
+"""
+
+_FAKE_TOKENS = """#!/bin/sh
+cat "$FAKE_PAG_DIR/pag.$FAKE_PAG" 2>/dev/null || echo none
+"""
+
+def _test1():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        tools = {}
+        for name,script in (('pagsh', _FAKE_PAGSH), ('loginshell', _FAKE_LOGIN_SHELL), ('kinit', _FAKE_KINIT),
+                            ('aklog', _FAKE_AKLOG), ('tokens', _FAKE_TOKENS)):
+            tools[name] = os.path.join(tmpdir, name)
+            f = open(tools[name], 'w')
+            f.write(script)
+            f.close()
+            os.chmod(tools[name], 0755)
+        os.environ['FAKE_PAG_DIR'] = tmpdir
+        users = ["user%d" % i for i in xrange(0, 8)]
+        for user in users:
+            create_context(user, os.path.join(tmpdir, "krb5cc.%s" % user), tools['pagsh'])
+        def login(user):
+            context = current_context()
+            assert context.name == user
+            for tool in ('kinit', 'aklog'):
+                rc,out,err = context.run([tools[tool], user])
+                assert rc == 0, err
+            time.sleep(0.01)
+            rc,out,err = context.run("%s; echo done >&2" % tools['tokens'], shell=True)
+            assert (rc,out,err) == (0, user + "\n", "done\n"), (rc,out,err)
+            return out.strip()
+        # Log in as all of the users at once; each context keeps its own token.
+        from OpenAFSLibrary.util.parallel import parallel_map
+        assert parallel_map(lambda u: run_as(u, login, u), users) == users
+        for user in users:
+            rc,out,err = get_context(user).run([tools['tokens']])
+            assert out.strip() == user
+        assert current_context() is None
+        # Without pagsh, the contexts share the token.
+        create_context("nopag1", os.path.join(tmpdir, "krb5cc.nopag1"))
+        create_context("nopag2", os.path.join(tmpdir, "krb5cc.nopag2"))
+        get_context("nopag1").run([tools['kinit'], "nopag1"])
+        get_context("nopag1").run([tools['aklog']])
+        rc,out,err = get_context("nopag2").run([tools['tokens']])
+        assert out.strip() == "nopag1", out
+        rc,out,err = get_context("user1").run("exit 3", shell=True)
+        assert rc == 3
+        rc,out,err = get_context("user1").run(["printf", "%s", "a b'c"])
+        assert out == "a b'c", out
+        try:
+            get_context("nobody")
+            assert False, "no error for missing context"
+        except AssertionError:
+            pass
+    finally:
+        stop_contexts()
+        shutil.rmtree(tmpdir)
+
+def main():
+    _test1()
+
+if __name__ == "__main__":
+    # usage: python -m OpenAFSLibrary.util.credentials
+    main()
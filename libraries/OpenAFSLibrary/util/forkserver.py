@@ -0,0 +1,285 @@
+# Copyright (c) 2015 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+"""Run programs from a small helper process.
+
+Every fork of the Robot Framework process has to duplicate the page tables
+of a large address space. The fork server is a small python process, started
+once, which runs the commands on our behalf. Requests and replies are
+pickled tuples sent over the helper's stdin and stdout pipes, each prefixed
+with the payload length.
+
+This module must only depend on the standard library, since it is also run
+as the helper program.
+"""
+
+import sys
+import os
+import time
+import struct
+import threading
+import subprocess
+import cPickle as pickle
+
+HEADER = "!I"
+HEADER_SIZE = struct.calcsize(HEADER)
+
+def _send(stream, message):
+    """Write a length prefixed message."""
+    payload = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    stream.write(struct.pack(HEADER, len(payload)) + payload)
+    stream.flush()
+
+def _recv(stream):
+    """Read a length prefixed message. Returns None at end of file."""
+    header = stream.read(HEADER_SIZE)
+    if len(header) != HEADER_SIZE:
+        return None
+    (size,) = struct.unpack(HEADER, header)
+    payload = stream.read(size)
+    if len(payload) != size:
+        return None
+    return pickle.loads(payload)
+
+# Only one child is created at a time, so the pipes being set up for one
+# child are never inherited by another. This avoids the cost of close_fds.
+_spawn_lock = threading.Lock()
+_devnull = None
+
+def _spawn(args, shell, env=None, cwd=None):
+    """Run a program and return the (rc, output, error) tuple."""
+    global _devnull
+    _spawn_lock.acquire()
+    try:
+        if _devnull is None:
+            _devnull = open(os.devnull, "r")
+        proc = subprocess.Popen(args, shell=shell, env=env, cwd=cwd, bufsize=-1,
+                    stdin=_devnull, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    finally:
+        _spawn_lock.release()
+    output, error = proc.communicate()
+    return (proc.returncode, output, error)
+
+def _handle(request, output, lock):
+    """Run one request and send the reply."""
+    (id, args, shell, env, cwd) = request
+    try:
+        (rc, out, err) = _spawn(args, shell, env, cwd)
+        reply = (id, rc, out, err, None)
+    except OSError as e:
+        reply = (id, None, "", "", (e.errno, e.strerror))
+    lock.acquire()
+    try:
+        _send(output, reply)
+    finally:
+        lock.release()
+
+def serve(input=sys.stdin, output=sys.stdout):
+    """Helper process main loop.
+
+    Each request is run in a thread so slow commands do not hold up the
+    other callers. The helper exits when the request pipe is closed.
+    """
+    lock = threading.Lock()
+    threads = []
+    while True:
+        request = _recv(input)
+        if request is None:
+            break
+        thread = threading.Thread(target=_handle, args=(request, output, lock))
+        thread.daemon = True
+        thread.start()
+        threads = [t for t in threads if t.is_alive()]
+        threads.append(thread)
+    for thread in threads:
+        thread.join()  # send the remaining replies
+
+class ForkServer(object):
+    """Client side of the fork server."""
+
+    def __init__(self):
+        self.proc = None
+        self.reader = None
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.next_id = 0
+
+    def start(self):
+        """Start the helper process."""
+        script = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+        self.proc = subprocess.Popen([sys.executable, script, "--serve"], close_fds=True,
+                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.reader = threading.Thread(target=self._read_replies)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def stop(self):
+        """Stop the helper process after the running commands complete."""
+        if self.proc is None:
+            return
+        self.proc.stdin.close()
+        self.proc.wait()
+        self.reader.join()
+        self.proc = None
+
+    def is_running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def _read_replies(self):
+        """Pass the replies to the waiting callers."""
+        while True:
+            reply = _recv(self.proc.stdout)
+            if reply is None:
+                break
+            self.lock.acquire()
+            try:
+                slot = self.pending.pop(reply[0])
+            finally:
+                self.lock.release()
+            slot[1] = reply
+            slot[0].set()
+        # The helper is gone; wake any callers still waiting.
+        self.lock.acquire()
+        try:
+            for slot in self.pending.values():
+                slot[0].set()
+            self.pending.clear()
+        finally:
+            self.lock.release()
+
+    def run(self, args, shell=False, env=None, cwd=None):
+        """Run a program and return the (rc, output, error) tuple.
+
+        The program is run with the current environment and working
+        directory of the caller, unless env or cwd are given, as with
+        Popen.
+        """
+        if env is None:
+            env = dict(os.environ)
+        if cwd is None:
+            cwd = os.getcwd()
+        slot = [threading.Event(), None]
+        self.lock.acquire()
+        try:
+            if not self.is_running():
+                raise AssertionError("Fork server is not running!")
+            id = self.next_id
+            self.next_id += 1
+            self.pending[id] = slot
+            _send(self.proc.stdin, (id, args, shell, env, cwd))
+        finally:
+            self.lock.release()
+        # Wait in short intervals; a plain wait() is not interruptible.
+        while not slot[0].is_set():
+            slot[0].wait(1.0)
+        reply = slot[1]
+        if reply is None:
+            raise AssertionError("Fork server exited while running: %s" % (args,))
+        (id, rc, out, err, oserror) = reply
+        if oserror:
+            raise OSError(*oserror)
+        return (rc, out, err)
+
+#
+# Unit tests and benchmark
+#
+def _test1():
+    import tempfile
+    server = ForkServer()
+    server.start()
+    saved = os.getcwd()
+    tmpdir = os.path.realpath(tempfile.mkdtemp())
+    try:
+        assert server.run(["/bin/sh", "-c", "exit 3"]) == (3, "", "")
+        # Changes made after the server started are seen by the programs.
+        os.environ['FORKSERVER_TEST'] = "changed"
+        os.chdir(tmpdir)
+        rc,out,err = server.run("echo $FORKSERVER_TEST; pwd", shell=True)
+        assert (rc, out) == (0, "changed\n%s\n" % tmpdir), (rc, out, err)
+        del os.environ['FORKSERVER_TEST']
+        rc,out,err = server.run("echo x$FORKSERVER_TEST", shell=True)
+        assert out == "x\n", out
+        rc,out,err = server.run(["pwd"], cwd="/")
+        assert out == "/\n", out
+        try:
+            server.run(["/nonexistent/program"])
+            assert False, "no error for missing program"
+        except OSError:
+            pass
+    finally:
+        os.chdir(saved)
+        os.rmdir(tmpdir)
+        server.stop()
+
+def _popen(args):
+    """Run a program directly, as run_program does without the fork server."""
+    proc = subprocess.Popen(args, bufsize=-1, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, error = proc.communicate()
+    return (proc.returncode, output, error)
+
+def _rate(run, args, count):
+    start = time.time()
+    for i in xrange(0, count):
+        rc,out,err = run(args)
+        if rc != 0:
+            raise AssertionError("Command failed: %s" % (args,))
+    return count / (time.time() - start)
+
+def bench(count=500, ballast=512, args=None):
+    """Compare the commands per second of the subprocess and fork server backends.
+
+    The ballast (in megabytes) is allocated and touched before running the
+    commands to mimic the address space of a Robot Framework process.
+    """
+    if args is None:
+        args = ["/bin/true"]
+    ballast = bytearray(ballast * 1024 * 1024)
+    for i in xrange(0, len(ballast), 4096):
+        ballast[i] = 1  # touch each page
+    server = ForkServer()
+    server.start()
+    try:
+        rates = [
+            ("subprocess", _rate(_popen, args, count)),
+            ("forkserver", _rate(server.run, args, count)),
+        ]
+    finally:
+        server.stop()
+    for name,rate in rates:
+        print "%-12s %8.1f commands/sec" % (name, rate)
+    print "speedup      %8.2fx" % (rates[1][1] / rates[0][1])
+
+def main(args):
+    if args and args[0] == "--serve":
+        serve()
+        return
+    if args and args[0] == "--test":
+        _test1()
+        return
+    # usage: python forkserver.py --test
+    #        python forkserver.py [<count> [<ballast-mb> [<command> ...]]]
+    count = int(args[0]) if len(args) > 0 else 500
+    ballast = int(args[1]) if len(args) > 1 else 512
+    command = args[2:] or None
+    bench(count, ballast, command)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,378 @@
+# Copyright (c) 2015 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+"""A file system exerciser in the style of fsx.
+
+A seeded random sequence of reads, writes, truncates, mapped reads and
+writes, and close/reopen operations is run on a file. A copy of the
+expected file content is kept in memory and every read is checked
+against it. The recent operations are kept in a ring buffer; when a
+check fails, they are written to <file>.fsxlog together with the
+parameters to run the same sequence again, and the expected content is
+written to <file>.fsxgood. The log can be replayed with replay(), on
+<file>.replay by default.
+"""
+
+import os
+import sys
+import mmap
+import time
+import struct
+import random
+import collections
+import multiprocessing
+from OpenAFSLibrary.util import first_difference
+
+OPS = ('read', 'write', 'mapread', 'mapwrite', 'truncate', 'closeopen')
+WEIGHTS = {'read': 4, 'write': 4, 'mapread': 2, 'mapwrite': 2, 'truncate': 1, 'closeopen': 1}
+MAX_SIZE = 256 * 1024   # the largest file size
+MAX_OP_SIZE = 64 * 1024 # the largest read or write
+LOG_SIZE = 1024         # the number of operations kept in the log
+
+class _Mismatch(Exception):
+    pass
+
+class Fsx(object):
+    """Runs random operations on a file and checks the results.
+
+    The same path, seed and parameters always give the same operations.
+    """
+
+    def __init__(self, path, seed=0, max_size=MAX_SIZE, max_op_size=MAX_OP_SIZE,
+                 mapped=True, log_size=LOG_SIZE):
+        self.path = path
+        self.seed = int(seed)
+        self.max_size = int(max_size)
+        self.max_op_size = min(int(max_op_size), self.max_size)
+        self.mapped = mapped
+        self.random = random.Random(self.seed)
+        r = random.Random(self.seed)
+        words = (2 * self.max_op_size) // 8 + 32
+        self.pool = "".join([struct.pack("!Q", r.getrandbits(64)) for i in xrange(0, words)])
+        self.table = []
+        for op in OPS:
+            if mapped or not op.startswith('map'):
+                self.table.extend([op] * WEIGHTS[op])
+        self.model = bytearray()
+        self.log = collections.deque(maxlen=int(log_size))
+        self.counts = dict([(op, 0) for op in OPS])
+        self.ops = 0
+        self.fd = None
+
+    def _data(self, length):
+        """Returns the data to write in the current operation."""
+        start = (self.ops * 251) % (len(self.pool) - self.max_op_size)
+        return self.pool[start:start + length]
+
+    def _check(self, data, offset, what):
+        expected = buffer(self.model, offset, len(data))
+        if len(data) != len(expected) or buffer(data) != expected:
+            raise _Mismatch("%s differs at offset %d" % \
+                (what, offset + first_difference(buffer(data), expected)))
+
+    def _check_size(self):
+        size = os.fstat(self.fd).st_size
+        if size != len(self.model):
+            raise _Mismatch("file size is %d, expected %d" % (size, len(self.model)))
+
+    def _resize(self, size):
+        if size < len(self.model):
+            del self.model[size:]
+        else:
+            self.model.extend(bytearray(size - len(self.model)))
+
+    def _map(self, offset, length, access):
+        """Returns the mapping which covers the range, and the start of the
+        range within the mapping."""
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        m = mmap.mmap(self.fd, offset + length - start, access=access, offset=start)
+        return m, offset - start
+
+    def _read(self, offset, length):
+        if length:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            self._check(os.read(self.fd, length), offset, "read")
+        self._check_size()
+
+    def _mapread(self, offset, length):
+        if length:
+            m,pos = self._map(offset, length, mmap.ACCESS_READ)
+            try:
+                self._check(buffer(m, pos, length), offset, "mapped read")
+            finally:
+                m.close()
+
+    def _write(self, offset, length):
+        data = self._data(length)
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        os.write(self.fd, data)
+        if offset > len(self.model):
+            self._resize(offset)
+        self.model[offset:offset + length] = data
+
+    def _mapwrite(self, offset, length):
+        data = self._data(length)
+        if offset + length > len(self.model):
+            os.ftruncate(self.fd, offset + length)
+            self._resize(offset + length)
+        m,pos = self._map(offset, length, mmap.ACCESS_WRITE)
+        try:
+            m[pos:pos + length] = data
+            m.flush()
+        finally:
+            m.close()
+        self.model[offset:offset + length] = data
+
+    def _truncate(self, offset, length):
+        os.ftruncate(self.fd, offset)
+        self._resize(offset)
+
+    def _closeopen(self, offset, length):
+        os.close(self.fd)
+        self.fd = os.open(self.path, os.O_RDWR)
+        self._check_size()
+
+    def _next(self):
+        """Returns the next (op, offset, length)."""
+        r = self.random
+        op = r.choice(self.table)
+        size = len(self.model)
+        if op in ('read', 'mapread'):
+            if size == 0:
+                return op, 0, 0
+            offset = r.randint(0, size - 1)
+            return op, offset, r.randint(1, min(self.max_op_size, size - offset))
+        elif op in ('write', 'mapwrite'):
+            offset = r.randint(0, self.max_size - 1)
+            return op, offset, r.randint(1, min(self.max_op_size, self.max_size - offset))
+        elif op == 'truncate':
+            return op, r.randint(0, self.max_size), 0
+        return op, 0, 0
+
+    def run(self, count):
+        """Run count operations. Returns the ops, seconds and ops_per_sec.
+
+        Fails with an AssertionError when a check fails, after writing the
+        log and the expected content next to the file.
+        """
+        start = time.time()
+        if self.fd is None:
+            flags = os.O_RDWR | os.O_CREAT
+            if self.ops == 0:
+                flags |= os.O_TRUNC  # start empty, as the model does
+            self.fd = os.open(self.path, flags, 0644)
+        try:
+            for i in xrange(0, int(count)):
+                self.ops += 1
+                op,offset,length = self._next()
+                self.log.append((self.ops, op, offset, length))
+                self.counts[op] += 1
+                try:
+                    getattr(self, '_' + op)(offset, length)
+                except _Mismatch, e:
+                    raise AssertionError("fsx: %s: operation %d (%s %d %d): %s; see %s" % \
+                        (self.path, self.ops, op, offset, length, e, self.dump(str(e))))
+        finally:
+            self.close()
+        seconds = max(time.time() - start, 1e-6)
+        return {'ops': int(count), 'seconds': seconds, 'ops_per_sec': int(count) / seconds,
+                'counts': dict(self.counts)}
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def dump(self, message):
+        """Write the operation log and the expected content. Returns the
+        name of the log."""
+        name = self.path + ".fsxlog"
+        f = open(name, 'w')
+        try:
+            f.write("# %s\n" % (message))
+            f.write("# replay: seed=%d ops=%d max_size=%d max_op_size=%d mapped=%s\n" % \
+                (self.seed, self.ops, self.max_size, self.max_op_size, self.mapped))
+            for entry in self.log:
+                f.write("%d %s %d %d\n" % entry)
+        finally:
+            f.close()
+        f = open(self.path + ".fsxgood", 'wb')
+        try:
+            f.write(self.model)
+        finally:
+            f.close()
+        return name
+
+def read_log(name):
+    """Returns the replay parameters and the operations of an fsx log."""
+    params = {}
+    entries = []
+    for line in open(name):
+        if line.startswith("# replay:"):
+            for field in line.split()[2:]:
+                key,value = field.split("=", 1)
+                params[key] = value == 'True' if key == 'mapped' else int(value)
+        elif not line.startswith("#"):
+            n,op,offset,length = line.split()
+            entries.append((int(n), op, int(offset), int(length)))
+    return params, entries
+
+def replay(name, path=None):
+    """Run the operations of an fsx log again, from the start.
+
+    The file at path is truncated and rewritten. The path defaults to the
+    file the log was written for with a .replay suffix; the file itself is
+    not used, so it is kept for inspection. Fails at the same operation if
+    the problem can be reproduced.
+    """
+    params,entries = read_log(name)
+    if not params:
+        raise AssertionError("No replay parameters in %s" % (name))
+    original = name[:-len(".fsxlog")] if name.endswith(".fsxlog") else name
+    if path is None:
+        path = original + ".replay"
+    if os.path.exists(path) and os.path.samefile(path, original):
+        raise AssertionError("Refusing to replay over %s, the file of the log." % (path))
+    ops = params.pop('ops')
+    return Fsx(path, **params).run(ops)
+
+def _run_one(args):
+    """Run fsx in a worker process. Returns (result, error)."""
+    path,count,kwargs = args
+    try:
+        return Fsx(path, **kwargs).run(count), None
+    except AssertionError, e:
+        return None, str(e)
+
+def run_fsx(paths, count, seed=0, **kwargs):
+    """Run fsx on each path at once, each in its own process with its own
+    seed. Returns the total ops, seconds and ops_per_sec, and the errors."""
+    jobs = [(path, count, dict(kwargs, seed=int(seed) + i)) for i,path in enumerate(paths)]
+    start = time.time()
+    if len(jobs) == 1:
+        results = [_run_one(jobs[0])]
+    else:
+        pool = multiprocessing.Pool(len(jobs))
+        try:
+            results = pool.map(_run_one, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    seconds = max(time.time() - start, 1e-6)
+    ops = sum([r['ops'] for r,e in results if r])
+    return {'ops': ops, 'seconds': seconds, 'ops_per_sec': ops / seconds,
+            'processes': len(jobs), 'errors': [e for r,e in results if e]}
+
+#
+# Unit tests
+#
+def _test1():
+    import tempfile, shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "f")
+        a = Fsx(path, seed=5, max_size=64 * 1024, max_op_size=8 * 1024)
+        result = a.run(5000)
+        assert result['ops'] == 5000 and min(result['counts'].values()) > 0, result
+        good = str(a.model)
+        assert open(path, 'rb').read() == good
+        b = Fsx(path, seed=5, max_size=64 * 1024, max_op_size=8 * 1024)
+        b.run(5000)
+        assert str(b.model) == good and list(b.log) == list(a.log)  # repeatable
+        c = Fsx(path, seed=5, mapped=False)
+        assert 'mapread' not in c.table and 'mapwrite' not in c.table
+        # The file is kept between runs.
+        c = Fsx(path, seed=5, max_size=64 * 1024, max_op_size=8 * 1024)
+        c.run(2500)
+        c.run(2500)
+        assert str(c.model) == good
+        # Change the file behind the back of the model; a later check finds it.
+        d = Fsx(path, seed=6, max_size=64 * 1024, max_op_size=8 * 1024, log_size=10)
+        d.run(100)
+        fd = os.open(path, os.O_RDWR)
+        os.write(fd, "\xff" * len(d.model))
+        os.close(fd)
+        try:
+            d.run(1000)
+            error = None
+        except AssertionError, e:
+            error = str(e)
+        assert error and "differs" in error, error
+        params,entries = read_log(path + ".fsxlog")
+        assert params == {'seed': 6, 'ops': d.ops, 'max_size': 64 * 1024,
+                          'max_op_size': 8 * 1024, 'mapped': True}, params
+        assert len(entries) == 10 and entries[-1][0] == d.ops, entries
+        assert open(path + ".fsxgood", 'rb').read() == str(d.model)
+        # The replay runs the same operations, which pass on a good file.
+        # The failed file is not changed.
+        failed = open(path, 'rb').read()
+        result = replay(path + ".fsxlog", os.path.join(tmpdir, "replay"))
+        assert result['ops'] == d.ops, result
+        e = Fsx(os.path.join(tmpdir, "e"), seed=6, max_size=64 * 1024, max_op_size=8 * 1024)
+        e.run(d.ops)
+        assert open(os.path.join(tmpdir, "replay"), 'rb').read() == str(e.model)
+        replay(path + ".fsxlog")
+        assert open(path + ".replay", 'rb').read() == str(e.model)
+        try:
+            replay(path + ".fsxlog", path)
+            assert False, "replayed over the failed file"
+        except AssertionError, error:
+            assert str(error).startswith("Refusing"), str(error)
+        assert open(path, 'rb').read() == failed
+    finally:
+        shutil.rmtree(tmpdir)
+
+def _test2():
+    import tempfile, shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        paths = [os.path.join(tmpdir, "f%d" % i) for i in xrange(0, 3)]
+        result = run_fsx(paths, 2000, seed=1)
+        assert result['ops'] == 6000 and not result['errors'], result
+        assert open(paths[0], 'rb').read() != open(paths[1], 'rb').read()
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench(count=100000):
+    """Time count operations on a local file."""
+    import tempfile
+    fd,path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        result = Fsx(path).run(int(count))
+        print "%d ops in %.1f seconds: %.0f ops/s" % (result['ops'], result['seconds'], result['ops_per_sec'])
+    finally:
+        os.remove(path)
+
+def main(args):
+    if args and args[0] == "--bench":
+        bench(*args[1:2])
+        return
+    if args and args[0] == "--replay":
+        result = replay(*args[1:3])
+        print "%d ops in %.1f seconds: no mismatch" % (result['ops'], result['seconds'])
+        return
+    _test1()
+    _test2()
+
+if __name__ == "__main__":
+    # usage: python -m OpenAFSLibrary.util.fsx [--bench [<count>] | --replay <fsxlog> [<file>]]
+    main(sys.argv[1:])
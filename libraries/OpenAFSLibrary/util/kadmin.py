@@ -0,0 +1,229 @@
+# Copyright (c) 2015 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+"""Run many kadmin.local queries in one process.
+
+kadmin.local reads requests from stdin when no query is given on the
+command line. The session writes each request followed by an unknown
+request name, the marker. kadmin.local flushes the output of a request
+before it prompts for the next one, then complains about the marker on
+stderr, so the output of a request is the text read up to the complaint.
+"""
+
+import os
+import re
+import sys
+import time
+import threading
+import subprocess
+
+# The interactive prompts, which are not followed by a newline.
+_PROMPT = re.compile(r'^(kadmin(\.local)?:  )+')
+
+class KadminSession(object):
+    """Send requests to a long running kadmin.local process.
+
+    The command is the argument list to start kadmin.local, for example
+    ['sudo', '-n', '/usr/sbin/kadmin.local']. The optional done function
+    is called with the (args, seconds, rc, size) of each request.
+    """
+
+    def __init__(self, command, done=None):
+        self.command = list(command)
+        self.done = done
+        self.proc = None
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the kadmin.local process."""
+        self.proc = subprocess.Popen(self.command, close_fds=True, bufsize=0,
+                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT)
+
+    def stop(self):
+        """Stop the kadmin.local process."""
+        if self.proc is not None:
+            try:
+                self.proc.stdin.write("quit\n")
+                self.proc.stdin.close()
+            except (IOError, OSError):
+                pass  # already gone
+            self.proc.wait()
+            self.proc = None
+
+    def is_running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def query(self, request):
+        """Run one request. Returns the list of output lines.
+
+        kadmin.local does not report the exit status of a request; the
+        caller checks the output for errors.
+        """
+        if "\n" in request or "\r" in request:
+            raise AssertionError("Invalid kadmin request: %s" % (request))
+        self.lock.acquire()
+        try:
+            if not self.is_running():
+                self.start()
+            self.count += 1
+            marker = "robotest_marker_%d_%d" % (os.getpid(), self.count)
+            start = time.time()
+            try:
+                self.proc.stdin.write("%s\n%s\n" % (request, marker))
+                self.proc.stdin.flush()
+            except (IOError, OSError):
+                self.stop()
+                raise AssertionError("kadmin.local is not running: %s" % (" ".join(self.command)))
+            lines = []
+            size = 0
+            while True:
+                line = self.proc.stdout.readline()
+                if not line:
+                    output = "".join(lines)
+                    self.stop()
+                    raise AssertionError("kadmin.local exited: request=%s output=%s" % (request, output))
+                size += len(line)
+                if marker in line:
+                    break
+                line = _PROMPT.sub("", line.rstrip("\n"))
+                if line:
+                    lines.append(line)
+            if self.done:
+                self.done([os.path.basename(self.command[-1])] + request.split(),
+                          time.time() - start, 0, size)
+            return lines
+        finally:
+            self.lock.release()
+
+    def errors(self, lines, request):
+        """Returns the error lines of a request. kadmin.local prefixes the
+        error messages with the request name or the program name."""
+        names = (request.split()[0], "kadmin.local", "kadmin")
+        return [l for l in lines if l.split(": ", 1)[0] in names and ": " in l]
+
+def parse_principal_keys(lines, principal):
+    """Returns the list of keys in the get_principal output."""
+    keys = []
+    for line in lines:
+        if line.startswith("Key:"):
+            k = [x.strip() for x in line.replace("Key:", "", 1).split(',')]
+            kvno = int(k[0].strip('vno '))
+            enctype = k[1]
+            salt = k[2]
+            if salt == 'no salt':
+                salt = 'normal'
+            keys.append({'kvno':kvno, 'enctype':enctype, 'salt':salt, 'principal':principal})
+    return keys
+
+#
+# Unit tests
+#
+_FAKE_KADMIN = r'''
+import sys
+principals = {}
+prompt = "kadmin.local:  "
+while True:
+    sys.stdout.write(prompt)
+    sys.stdout.flush()
+    line = sys.stdin.readline()
+    if not line:
+        break
+    args = line.split()
+    if not args:
+        continue
+    if args[0] == "quit":
+        break
+    elif args[0] == "get_principal":
+        name = args[-1]
+        if name not in principals:
+            sys.stderr.write('get_principal: Principal does not exist while retrieving "%s".\n' % name)
+        else:
+            print 'Principal: %s' % name
+            print 'Number of keys: %d' % len(principals[name])
+            for kvno,enctype in principals[name]:
+                print 'Key: vno %d, %s, no salt' % (kvno, enctype)
+    elif args[0] == "add_principal":
+        name = args[-1]
+        if name in principals:
+            sys.stderr.write('add_principal: Principal or policy already exists while creating "%s".\n' % name)
+        else:
+            principals[name] = [(1, "aes256-cts-hmac-sha1-96")]
+            print 'Principal "%s" created.' % name
+    elif args[0] == "ktadd":
+        name = args[-1]
+        for kvno,enctype in principals.get(name, []):
+            principals[name] = [(kvno + 1, enctype)]
+            print 'Entry for principal %s with kvno %d added to keytab.' % (name, kvno + 1)
+        if name not in principals:
+            sys.stderr.write('kadmin.local: Principal does not exist while adding key to keytab\n')
+    else:
+        sys.stderr.write('kadmin.local: Unknown request "%s".  Type "?" for a request list.\n' % args[0])
+'''
+
+def _test1():
+    import tempfile
+    fd,script = tempfile.mkstemp(suffix=".py")
+    os.write(fd, _FAKE_KADMIN)
+    os.close(fd)
+    done = []
+    session = KadminSession([sys.executable, script], done=lambda *a: done.append(a))
+    try:
+        lines = session.query("get_principal user@EXAMPLE.COM")
+        assert parse_principal_keys(lines, "user@EXAMPLE.COM") == []
+        assert session.errors(lines, "get_principal user@EXAMPLE.COM")
+        lines = session.query("add_principal -randkey user@EXAMPLE.COM")
+        assert lines == ['Principal "user@EXAMPLE.COM" created.'], lines
+        assert not session.errors(lines, "add_principal")
+        lines = session.query("add_principal -randkey user@EXAMPLE.COM")
+        assert session.errors(lines, "add_principal")
+        lines = session.query("ktadd -k /tmp/x.keytab user@EXAMPLE.COM")
+        assert not session.errors(lines, "ktadd")
+        lines = session.query("ktadd -k /tmp/x.keytab nobody@EXAMPLE.COM")
+        assert session.errors(lines, "ktadd") == \
+            ["kadmin.local: Principal does not exist while adding key to keytab"], lines
+        keys = parse_principal_keys(session.query("get_principal user@EXAMPLE.COM"), "user@EXAMPLE.COM")
+        assert keys == [{'kvno':2, 'enctype':"aes256-cts-hmac-sha1-96", 'salt':'normal',
+                         'principal':"user@EXAMPLE.COM"}], keys
+        pid = session.proc.pid
+        start = time.time()
+        for i in xrange(0, 200):
+            session.query("get_principal user%d@EXAMPLE.COM" % i)
+        elapsed = time.time() - start
+        assert session.proc.pid == pid  # one process for all the requests
+        assert len(done) == 206
+        assert done[0][0][:2] == [os.path.basename(script), "get_principal"]
+        print "200 requests in %.3f seconds" % (elapsed)
+        session.stop()
+        assert not session.is_running()
+        lines = session.query("get_principal user@EXAMPLE.COM")  # restarted
+        assert parse_principal_keys(lines, "user@EXAMPLE.COM") == []
+    finally:
+        session.stop()
+        os.remove(script)
+
+def main():
+    _test1()
+
+if __name__ == "__main__":
+    # usage: python -m OpenAFSLibrary.util.kadmin
+    main()
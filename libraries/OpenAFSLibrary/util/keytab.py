@@ -0,0 +1,493 @@
+# Copyright (c) 2015 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+"""Read and write MIT Kerberos keytab files.
+
+The following C-like structure definitions illustrate the MIT keytab
+file format. All values are in network byte order in version 0x502, and
+in the host byte order in version 0x501. All text is ASCII.
+
+    keytab {
+        uint16_t file_format_version;                    /* 0x502 */
+        keytab_entry entries[*];
+    };
+    keytab_entry {
+        int32_t size;        /* a negative size is a hole of -size bytes */
+        uint16_t num_components;    /* sub 1 if version 0x501 */
+        counted_octet_string realm;
+        counted_octet_string components[num_components];
+        uint32_t name_type;   /* not present if version 0x501 */
+        uint32_t timestamp;
+        uint8_t vno8;
+        keyblock key;
+        uint32_t vno; /* only present if >= 4 bytes left in entry */
+    };
+    counted_octet_string {
+        uint16_t length;
+        uint8_t data[length];
+    };
+    keyblock {
+        uint16_t type;
+        counted_octet_string key;
+    };
+"""
+
+import os
+import sys
+import stat
+import mmap
+import time
+import struct
+import threading
+
+KRB_KEYTAB_MAGIC = 0x0502
+KRB_KEYTAB_MAGIC_V1 = 0x0501
+KRB_NT_PRINCIPAL = 1
+
+# IANA Kerberos Encryption Type Numbers
+KRB_ENCTYPE_NUMBERS = {
+    'des-cbc-crc': 1,
+    'des-cbc-md4': 2,
+    'des-cbc-md5': 3,
+    'des3-cbc-md5': 5,
+    'des3-cbc-sha1': 7,
+    'dsaWithSHA1-CmsOID': 9,
+    'md5WithRSAEncryption-CmsOID': 10,
+    'sha1WithRSAEncryption-CmsOID': 11,
+    'rc2CBC-EnvOID': 12,
+    'rsaEncryption-EnvOID': 13,
+    'rsaES-OAEP-ENV-OID': 14,
+    'des-ede3-cbc-Env-OID': 15,
+    'des3-cbc-sha1-kd': 16,
+    'aes128-cts-hmac-sha1-96': 17, # common
+    'aes256-cts-hmac-sha1-96': 18, # common
+    'rc4-hmac': 23,
+    'rc4-hmac-exp': 24,
+    'camellia128-cts-cmac': 25,
+    'camellia256-cts-cmac': 26,
+    'subkey-keymaterial': 65,
+}
+
+# Encryption type names by number.
+KRB_ENCTYPE_NAMES = dict([(v, k) for k,v in KRB_ENCTYPE_NUMBERS.items()])
+
+def enctype_name(number):
+    """Returns the name of an encryption type number."""
+    return KRB_ENCTYPE_NAMES.get(number, "enctype-%d" % (number))
+
+class KeytabEntry(object):
+    """A key in a keytab."""
+    __slots__ = ('principal', 'realm', 'components', 'name_type', 'timestamp',
+                 'kvno', 'enctype', 'key')
+
+    def __init__(self, realm, components, name_type, timestamp, kvno, enctype, key):
+        self.realm = realm
+        self.components = components
+        self.principal = "%s@%s" % ("/".join(components), realm)
+        self.name_type = name_type
+        self.timestamp = timestamp
+        self.kvno = kvno
+        self.enctype = enctype  # number
+        self.key = key
+
+    def __repr__(self):
+        return "KeytabEntry(%s, kvno=%d, enctype=%s)" % \
+            (self.principal, self.kvno, enctype_name(self.enctype))
+
+def _parse_entry(buf, start, end, order, version):
+    """Decode the keytab entry in buf[start:end]."""
+    pos = start
+    def unpack(fmt):
+        values = struct.unpack_from(order + fmt, buf, pos)
+        return (pos + struct.calcsize(order + fmt),) + values
+    def octets():
+        (p, length) = unpack("H")
+        return (p + length, buf[p:p+length])
+    (pos, count) = unpack("H")
+    if version == KRB_KEYTAB_MAGIC_V1:
+        count -= 1  # the count includes the realm
+    (pos, realm) = octets()
+    components = []
+    for i in xrange(0, count):
+        (pos, component) = octets()
+        components.append(component)
+    if version == KRB_KEYTAB_MAGIC_V1:
+        name_type = KRB_NT_PRINCIPAL
+    else:
+        (pos, name_type) = unpack("L")
+    (pos, timestamp, kvno, enctype) = unpack("LBH")
+    (pos, key) = octets()
+    if pos + 4 <= end:
+        (p, vno32) = unpack("L")
+        if vno32 != 0:
+            kvno = vno32  # the 8 bit kvno wraps
+    if pos > end:
+        raise ValueError("Keytab entry overruns its size at offset %d" % (start))
+    return KeytabEntry(realm, components, name_type, timestamp, kvno, enctype, key)
+
+def parse_keytab(buf):
+    """Returns the list of keytab entries of a keytab file image."""
+    if len(buf) < 2:
+        raise ValueError("Not a keytab: file is too short.")
+    (version,) = struct.unpack_from("!H", buf, 0)
+    if version == KRB_KEYTAB_MAGIC:
+        order = "!"
+    elif version == KRB_KEYTAB_MAGIC_V1:
+        order = "="
+    else:
+        raise ValueError("Not a keytab: unsupported version 0x%x" % (version))
+    entries = []
+    pos = 2
+    while pos + 4 <= len(buf):
+        (size,) = struct.unpack_from(order + "l", buf, pos)
+        pos += 4
+        if size == 0:
+            break  # end of the entries
+        if size < 0:
+            pos += -size  # a hole left by a deleted entry
+            continue
+        if pos + size > len(buf):
+            raise ValueError("Truncated keytab entry at offset %d" % (pos - 4))
+        entries.append(_parse_entry(buf, pos, pos + size, order, version))
+        pos += size
+    return entries
+
+class Keytab(object):
+    """The entries of a keytab file, indexed by principal, enctype and kvno."""
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.principals = {}  # entries by principal
+        self.keys = {}        # entry by (principal, enctype, kvno)
+        self.latest = {}      # highest kvno by (principal, enctype)
+        for entry in entries:
+            self.principals.setdefault(entry.principal, []).append(entry)
+            self.keys[(entry.principal, entry.enctype, entry.kvno)] = entry
+            key = (entry.principal, entry.enctype)
+            if entry.kvno > self.latest.get(key, -1):
+                self.latest[key] = entry.kvno
+
+    @classmethod
+    def read(cls, path):
+        """Read a keytab file."""
+        f = open(path, "rb")
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                raise ValueError("Not a keytab: file is empty.")
+            buf = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                return cls(parse_keytab(buf))
+            finally:
+                buf.close()
+        finally:
+            f.close()
+
+    def lookup(self, principal, enctype, kvno=None):
+        """Returns the entry of a principal and enctype number, or None.
+
+        The entry with the highest kvno is returned if no kvno is given.
+        """
+        if kvno is None:
+            kvno = self.latest.get((principal, enctype))
+        return self.keys.get((principal, enctype, kvno))
+
+    def kvno(self, principal, enctype):
+        """Returns the highest kvno of a principal and enctype number, or None."""
+        return self.latest.get((principal, enctype))
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+def read_keytab(path):
+    """Returns the Keytab of a file, reusing the last result if the file
+    has not been changed."""
+    st = os.stat(path)
+    signature = (st.st_ino, st.st_mtime, st.st_ctime, st.st_size)
+    _cache_lock.acquire()
+    try:
+        cached = _cache.get(path)
+    finally:
+        _cache_lock.release()
+    if cached and cached[0] == signature:
+        return cached[1]
+    keytab = Keytab.read(path)
+    _cache_lock.acquire()
+    try:
+        _cache[path] = (signature, keytab)
+    finally:
+        _cache_lock.release()
+    return keytab
+
+# Key sizes in bytes by encryption type number.
+KEY_SIZES = {1:8, 2:8, 3:8, 5:24, 7:24, 16:24, 17:16, 18:32, 23:16, 24:16, 25:16, 26:32}
+
+def des_key():
+    """Generate a random DES key with correct parity bits."""
+    key = bytearray(os.urandom(8))
+    for i in xrange(0, len(key)):
+        b = key[i] & 0xfe
+        if bin(b).count('1') % 2 == 0:
+            b |= 1  # odd parity
+        key[i] = b
+    return bytes(key)
+
+def random_key(enctype):
+    """Returns a random key for an encryption type number. The key is not
+    derived properly for the triple DES types; only use it for testing."""
+    if enctype in (1, 2, 3):
+        return des_key()
+    size = KEY_SIZES.get(enctype)
+    if size is None:
+        raise ValueError("Cannot create a key for enctype %s" % (enctype_name(enctype)))
+    return os.urandom(size)
+
+def _entry_size(entry):
+    """Returns the size of an encoded entry, not including the size field."""
+    size = 2 + 2 + len(entry.realm) + 4 + 4 + 1 + 2 + 2 + len(entry.key) + 4
+    for component in entry.components:
+        size += 2 + len(component)
+    return size
+
+def _pack_entry(buf, pos, entry):
+    """Encode an entry in the buffer at pos. Returns the end position."""
+    struct.pack_into("!lH", buf, pos, _entry_size(entry), len(entry.components))
+    pos += 6
+    for s in [entry.realm] + entry.components:
+        struct.pack_into("!H%ds" % len(s), buf, pos, len(s), s)
+        pos += 2 + len(s)
+    struct.pack_into("!LLBHH%dsL" % len(entry.key), buf, pos, entry.name_type, entry.timestamp,
+        entry.kvno & 0xff, entry.enctype, len(entry.key), entry.key, entry.kvno)
+    return pos + 4 + 4 + 1 + 2 + 2 + len(entry.key) + 4
+
+class KeytabWriter(object):
+    """Build a keytab file with many entries in one pass.
+
+    An entry added for the same principal, enctype and kvno as an existing
+    entry replaces it. The file is written in the 0x502 format from a
+    preallocated buffer and replaced atomically.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.index = {}  # position of the entry by (principal, enctype, kvno)
+        self.timestamp = int(time.time())
+
+    def _put(self, entry):
+        key = (entry.principal, entry.enctype, entry.kvno)
+        i = self.index.get(key)
+        if i is None:
+            self.index[key] = len(self.entries)
+            self.entries.append(entry)
+        else:
+            self.entries[i] = entry
+
+    def load(self, path):
+        """Keep the entries of an existing keytab."""
+        for entry in Keytab.read(path).entries:
+            self._put(entry)
+
+    def add(self, principal, enctype, key=None, kvno=1):
+        """Add the key of a principal, e.g. 'afs/example.com@EXAMPLE.COM'.
+
+        A random key is generated when no key is given.
+        """
+        if isinstance(enctype, basestring):
+            if enctype not in KRB_ENCTYPE_NUMBERS:
+                raise ValueError("Unknown enctype: %s" % (enctype))
+            enctype = KRB_ENCTYPE_NUMBERS[enctype]
+        if "@" not in principal:
+            raise ValueError("Principal name has no realm: %s" % (principal))
+        name,realm = principal.rsplit("@", 1)
+        if key is None:
+            key = random_key(enctype)
+        self._put(KeytabEntry(realm, name.split("/"), KRB_NT_PRINCIPAL,
+                              self.timestamp, int(kvno), enctype, key))
+
+    def pack(self):
+        """Returns the keytab file image."""
+        size = 2
+        for entry in self.entries:
+            size += 4 + _entry_size(entry)
+        buf = bytearray(size)
+        struct.pack_into("!H", buf, 0, KRB_KEYTAB_MAGIC)
+        pos = 2
+        for entry in self.entries:
+            pos = _pack_entry(buf, pos, entry)
+        assert pos == size
+        return buf
+
+    def write(self, path):
+        """Write the keytab file, replacing any existing file atomically.
+
+        An existing file keeps its mode; a new file is created with the
+        default mode, as with open().
+        """
+        buf = self.pack()
+        tmp = "%s.tmp.%d" % (path, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+        try:
+            try:
+                os.fchmod(fd, stat.S_IMODE(os.stat(path).st_mode))
+            except OSError:
+                pass  # a new file
+            os.write(fd, buf)
+        finally:
+            os.close(fd)
+        os.rename(tmp, path)
+
+#
+# Unit tests
+#
+def _entry(order, version, realm, components, enctype, key, kvno, vno32=True):
+    """Pack a keytab entry, for the tests."""
+    count = len(components)
+    if version == KRB_KEYTAB_MAGIC_V1:
+        count += 1
+    data = struct.pack(order + "H", count)
+    for s in [realm] + components:
+        data += struct.pack(order + "H", len(s)) + s
+    if version != KRB_KEYTAB_MAGIC_V1:
+        data += struct.pack(order + "L", KRB_NT_PRINCIPAL)
+    data += struct.pack(order + "LBH", 1400000000, kvno & 0xff, enctype)
+    data += struct.pack(order + "H", len(key)) + key
+    if vno32:
+        data += struct.pack(order + "L", kvno)
+    return struct.pack(order + "l", len(data)) + data
+
+def _test1():
+    buf = struct.pack("!H", KRB_KEYTAB_MAGIC)
+    buf += _entry("!", KRB_KEYTAB_MAGIC, "EXAMPLE.COM", ["afs", "example.com"], 18, "k" * 32, 3)
+    buf += struct.pack("!l", -20) + "\0" * 20  # hole
+    buf += _entry("!", KRB_KEYTAB_MAGIC, "EXAMPLE.COM", ["afs", "example.com"], 18, "k" * 32, 300)
+    buf += _entry("!", KRB_KEYTAB_MAGIC, "EXAMPLE.COM", ["user"], 17, "u" * 16, 2, vno32=False)
+    entries = parse_keytab(buf)
+    assert len(entries) == 3
+    assert entries[0].principal == "afs/example.com@EXAMPLE.COM"
+    assert entries[1].kvno == 300
+    assert entries[2].principal == "user@EXAMPLE.COM"
+    assert entries[2].kvno == 2 and entries[2].key == "u" * 16
+    keytab = Keytab(entries)
+    assert keytab.kvno("afs/example.com@EXAMPLE.COM", 18) == 300
+    assert keytab.lookup("afs/example.com@EXAMPLE.COM", 18, 3) is entries[0]
+    assert keytab.lookup("user@EXAMPLE.COM", 17) is entries[2]
+    assert keytab.lookup("user@EXAMPLE.COM", 18) is None
+
+def _test2():
+    buf = struct.pack("!H", KRB_KEYTAB_MAGIC_V1)
+    buf += _entry("=", KRB_KEYTAB_MAGIC_V1, "EXAMPLE.COM", ["afs"], 1, "d" * 8, 5, vno32=False)
+    entries = parse_keytab(buf)
+    assert len(entries) == 1
+    assert entries[0].principal == "afs@EXAMPLE.COM"
+    assert (entries[0].kvno, entries[0].enctype) == (5, 1)
+    for bad in ("", "\x05\x03", struct.pack("!H", KRB_KEYTAB_MAGIC) + struct.pack("!l", 100)):
+        try:
+            parse_keytab(bad)
+            assert False, "no error for %r" % bad
+        except ValueError:
+            pass
+
+def _test3():
+    import tempfile
+    fd,path = tempfile.mkstemp()
+    try:
+        os.write(fd, struct.pack("!H", KRB_KEYTAB_MAGIC) +
+            _entry("!", KRB_KEYTAB_MAGIC, "EXAMPLE.COM", ["user"], 17, "u" * 16, 1))
+        os.close(fd)
+        keytab = read_keytab(path)
+        assert keytab.kvno("user@EXAMPLE.COM", 17) == 1
+        assert read_keytab(path) is keytab
+    finally:
+        os.remove(path)
+
+def _test4():
+    import tempfile, shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "test.keytab")
+        w = KeytabWriter()
+        w.add("afs/example.com@EXAMPLE.COM", "aes256-cts-hmac-sha1-96", kvno=300)
+        w.add("afs/example.com@EXAMPLE.COM", "des-cbc-crc", kvno=2)
+        w.add("user@EXAMPLE.COM", 17, key="u" * 16)
+        w.write(path)
+        keytab = read_keytab(path)
+        assert [(e.principal, e.enctype, e.kvno) for e in keytab.entries] == [
+            ("afs/example.com@EXAMPLE.COM", 18, 300),
+            ("afs/example.com@EXAMPLE.COM", 1, 2),
+            ("user@EXAMPLE.COM", 17, 1)]
+        assert keytab.lookup("user@EXAMPLE.COM", 17).key == "u" * 16
+        for b in bytearray(keytab.lookup("afs/example.com@EXAMPLE.COM", 1).key):
+            assert bin(b).count('1') % 2 == 1  # odd parity
+        # Append a kvno and rewrite a key.
+        w = KeytabWriter()
+        w.load(path)
+        w.add("user@EXAMPLE.COM", 17, key="v" * 16)
+        w.add("user@EXAMPLE.COM", 17, key="w" * 16, kvno=2)
+        w.write(path)
+        keytab = read_keytab(path)
+        assert len(keytab.entries) == 4
+        assert keytab.lookup("user@EXAMPLE.COM", 17, 1).key == "v" * 16
+        assert keytab.lookup("user@EXAMPLE.COM", 17).key == "w" * 16
+        assert os.listdir(tmpdir) == ["test.keytab"]
+        # The mode of an existing file is kept.
+        os.chmod(path, 0640)
+        w.write(path)
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0640
+        try:
+            w.add("user@EXAMPLE.COM", "rc4-hmac-exp-unknown")
+            assert False, "no error for unknown enctype"
+        except ValueError:
+            pass
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench(count=1000):
+    """Time writing and reading a keytab for each of a number of users."""
+    import tempfile, shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        for i in xrange(0, count):
+            w = KeytabWriter()
+            for enctype in (17, 18):
+                w.add("user%d@EXAMPLE.COM" % i, enctype)
+            w.write(os.path.join(tmpdir, "user%d.keytab" % i))
+        written = time.time()
+        for i in xrange(0, count):
+            read_keytab(os.path.join(tmpdir, "user%d.keytab" % i))
+        read = time.time()
+        print "write %d keytabs: %.3f seconds" % (count, written - start)
+        print "read %d keytabs:  %.3f seconds" % (count, read - written)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def main(args):
+    if args and args[0] == "--bench":
+        bench(*[int(a) for a in args[1:2]])
+        return
+    _test1()
+    _test2()
+    _test3()
+    _test4()
+
+if __name__ == "__main__":
+    # usage: python -m OpenAFSLibrary.util.keytab [--bench [<count>]]
+    main(sys.argv[1:])
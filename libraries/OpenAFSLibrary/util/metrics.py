@@ -0,0 +1,290 @@
+# Copyright (c) 2015 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+import os
+import re
+import math
+import json
+import threading
+
+# Programs which take a subcommand as the first argument.
+COMMAND_SUITES = ('vos', 'fs', 'bos', 'pts', 'backup', 'kas', 'uss', 'kadmin', 'kadmin.local')
+
+def command_tag(args):
+    """Returns the tool and subcommand name of a command line.
+
+    For example, 'vos release' or 'fs setacl'. Privileged commands run
+    with the afs-robotest-sudo wrapper are tagged as 'sudo <command>'.
+    """
+    if isinstance(args, basestring):
+        args = args.split()
+    args = list(args)
+    # Skip the environment assignments in shell command strings.
+    while args and re.match(r'\w+=', args[0]):
+        args.pop(0)
+    if not args:
+        return ""
+    tool = os.path.basename(args.pop(0))
+    if tool == 'sudo':
+        while args and args[0].startswith('-'):
+            args.pop(0)
+        if args and os.path.basename(args[0]) == 'afs-robotest-sudo':
+            args.pop(0)
+        if len(args) == 1:
+            args = args[0].split()  # a command line given as one argument
+        if args:
+            return "sudo %s" % command_tag(args)
+        return tool
+    if tool in COMMAND_SUITES:
+        for arg in args:
+            if not arg.startswith('-'):
+                return "%s %s" % (tool, arg)
+    return tool
+
+def percentile(values, p):
+    """Returns the nearest-rank percentile of a sorted list of values."""
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+# The latencies are counted in buckets which grow by one percent, so the
+# percentiles are within one percent of the measured times and the memory
+# used does not grow with the number of commands run.
+BUCKET_RATIO = 1.01
+MIN_TIME = 1e-6
+
+def _bucket(seconds):
+    if seconds <= MIN_TIME:
+        return 0
+    return int(math.ceil(math.log(seconds / MIN_TIME) / math.log(BUCKET_RATIO)))
+
+class TagStats(object):
+    """The measurements of the commands with one tag."""
+
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.bytes = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = {}  # number of times by bucket
+
+    def add(self, seconds, rc, size):
+        self.count += 1
+        self.bytes += size
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if rc:
+            self.failures += 1
+        b = _bucket(seconds)
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+
+    def percentile(self, p):
+        """Returns the nearest-rank percentile, rounded up to the bucket."""
+        rank = max(1, int(math.ceil(p / 100.0 * self.count)))
+        seen = 0
+        for b in sorted(self.buckets.keys()):
+            seen += self.buckets[b]
+            if seen >= rank:
+                return min(MIN_TIME * BUCKET_RATIO ** b, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'failures': self.failures,
+            'bytes': self.bytes,
+            'total': self.total,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+class CommandMetrics(object):
+    """Wall time, exit code and output size of the commands run.
+
+    The measurements are added up by tag for the whole run and for each
+    open scope, e.g. the running suites; the samples are not kept.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.scopes = {}   # the stats by tag of each open scope
+        self.next_scope = 0
+
+    def record(self, tag, seconds, rc, size):
+        """Save the measurements of one command."""
+        self.lock.acquire()
+        try:
+            for stats in [self.totals] + self.scopes.values():
+                tagged = stats.get(tag)
+                if tagged is None:
+                    tagged = stats[tag] = TagStats()
+                tagged.add(seconds, rc, size)
+        finally:
+            self.lock.release()
+
+    def open_scope(self):
+        """Start to add up the commands of a scope. Returns the scope id."""
+        self.lock.acquire()
+        try:
+            scope = self.next_scope
+            self.next_scope += 1
+            self.scopes[scope] = {}
+            return scope
+        finally:
+            self.lock.release()
+
+    def close_scope(self, scope):
+        """Returns the summary of a scope and forgets it."""
+        summary = self.summarize(scope)
+        self.lock.acquire()
+        try:
+            self.scopes.pop(scope, None)
+        finally:
+            self.lock.release()
+        return summary
+
+    def summarize(self, scope=None):
+        """Returns the statistics for each tag of a scope, or of the whole run."""
+        self.lock.acquire()
+        try:
+            if scope is None:
+                stats = self.totals
+            else:
+                stats = self.scopes.get(scope, {})
+            return dict([(tag, s.summary()) for tag,s in stats.items()])
+        finally:
+            self.lock.release()
+
+def format_summary(summary):
+    """Returns a text table of a summary, slowest total time first. Times are
+    in milliseconds."""
+    lines = ["%-24s %6s %6s %10s %9s %9s %9s %9s" % \
+        ("command", "count", "failed", "total", "p50", "p95", "p99", "max")]
+    tags = sorted(summary.keys(), key=lambda t: summary[t]['total'], reverse=True)
+    for tag in tags:
+        s = summary[tag]
+        lines.append("%-24s %6d %6d %10.1f %9.1f %9.1f %9.1f %9.1f" % \
+            (tag, s['count'], s['failures'], s['total'] * 1000, s['p50'] * 1000,
+             s['p95'] * 1000, s['p99'] * 1000, s['max'] * 1000))
+    return "\n".join(lines)
+
+class SuiteMetrics(object):
+    """Per-suite summaries of the command metrics."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.marks = []
+        self.suites = []
+
+    def start_suite(self):
+        self.marks.append(self.metrics.open_scope())
+
+    def end_suite(self, name):
+        """Summarize the commands run in the suite (and the child suites)."""
+        if self.marks:
+            summary = self.metrics.close_scope(self.marks.pop())
+        else:
+            summary = self.metrics.summarize()  # the library was imported after the suite started
+        self.suites.append({'suite': name, 'commands': summary})
+        return summary
+
+    def current(self):
+        """Returns the summary of the commands run so far in the current suite."""
+        if self.marks:
+            return self.metrics.summarize(self.marks[-1])
+        return self.metrics.summarize()
+
+    def export(self, filename):
+        """Write the completed suite summaries to a json file."""
+        f = open(filename + ".tmp", "w")
+        json.dump({'suites': self.suites}, f, indent=1, sort_keys=True)
+        f.close()
+        os.rename(filename + ".tmp", filename)
+
+#
+# Unit tests
+#
+def _test1():
+    cases = [
+        (['/usr/afs/bin/vos', 'release', '-id', 'x'], "vos release"),
+        (['/usr/afs/bin/fs', '-help'], "fs"),
+        ("/usr/afs/bin/fs setacl -dir /afs -acl x rl", "fs setacl"),
+        ("KRB5CCNAME=/tmp/cc /usr/bin/kinit -k user", "kinit"),
+        (['sudo', '-n', '/usr/sbin/afs-robotest-sudo', 'cp', 'a', 'b'], "sudo cp"),
+        (['sudo', '-n', '/usr/sbin/afs-robotest-sudo', 'mkdir -p /afs'], "sudo mkdir"),
+        (['sudo', '-n', '/usr/sbin/afs-robotest-sudo', '/usr/afs/bin/vos', 'create', 'x'], "sudo vos create"),
+        (['sudo', '/usr/sbin/afs-robotest-sudo', '/usr/afs/bin/vos remove -id x'], "sudo vos remove"),
+        (['/usr/afsws/etc/rxdebug', 'host', '7000'], "rxdebug"),
+        ("", ""),
+    ]
+    for args,expected in cases:
+        tag = command_tag(args)
+        assert tag == expected, "expected='%s', got='%s'" % (expected, tag)
+
+def _test2():
+    values = range(1, 101)
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile([7], 99) == 7
+    assert percentile([], 50) is None
+
+def _test3():
+    m = CommandMetrics()
+    s = SuiteMetrics(m)
+    s.start_suite()
+    m.record("vos release", 0.5, 0, 10)
+    s.start_suite()
+    m.record("vos release", 1.5, 1, 20)
+    m.record("fs setacl", 0.1, 0, 0)
+    inner = s.end_suite("top.inner")
+    outer = s.end_suite("top")
+    assert inner["vos release"]['count'] == 1
+    assert inner["vos release"]['failures'] == 1
+    assert outer["vos release"]['count'] == 2
+    assert outer["vos release"]['max'] == 1.5
+    assert outer["vos release"]['bytes'] == 30
+    assert [x['suite'] for x in s.suites] == ["top.inner", "top"]
+    assert format_summary(outer).splitlines()[1].startswith("vos release")
+    assert not m.scopes and m.summarize()["fs setacl"]['count'] == 1
+    # The percentiles are within one percent; the samples are not kept.
+    t = TagStats()
+    for i in xrange(1, 100001):
+        t.add(i / 1000.0, 0, 0)
+    for p in (50, 95, 99):
+        assert p - 0.01 <= t.percentile(p) <= (p + 0.01) * 1.01, (p, t.percentile(p))
+    assert t.percentile(100) == t.max == 100.0
+    assert len(t.buckets) < 1000
+
+def main():
+    _test1()
+    _test2()
+    _test3()
+
+if __name__ == "__main__":
+    # usage: python -m OpenAFSLibrary.util.metrics
+    main()
@@ -0,0 +1,98 @@
+# Copyright (c) 2015 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+import sys
+import threading
+import Queue
+from OpenAFSLibrary.util import run_program
+
+# Default number of concurrent workers. The commands are mostly waiting on
+# the servers, so this is not tied to the number of local cores.
+PARALLEL_LIMIT = 8
+
+def parallel_map(func, items, limit=None, stop=None):
+    """Call func for each item using a bounded pool of threads.
+
+    Returns the list of results in the same order as the items. The optional
+    stop function is called with each result; no more items are started once
+    it returns true, and the results of the items not started are None.
+
+    An exception raised by func also stops the remaining items from being
+    started. The first exception is raised again once the running calls have
+    completed.
+    """
+    items = list(items)
+    if limit is None:
+        limit = PARALLEL_LIMIT
+    limit = min(int(limit), len(items))
+    if limit < 1:
+        if not items:
+            return []
+        raise ValueError("Invalid concurrency limit: %s" % (limit))
+    results = [None] * len(items)
+    errors = []
+    stopped = threading.Event()
+    queue = Queue.Queue()
+    for i,item in enumerate(items):
+        queue.put((i, item))
+
+    def worker():
+        while not stopped.is_set():
+            try:
+                i,item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = func(item)
+            except:
+                errors.append(sys.exc_info())
+                stopped.set()
+                return
+            if stop and stop(results[i]):
+                stopped.set()
+
+    if limit == 1:
+        worker()  # no need for threads
+    else:
+        threads = [threading.Thread(target=worker) for i in xrange(0, limit)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1.0)  # a plain join() is not interruptible
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+def run_programs(commands, limit=None, fail_fast=False):
+    """Run a batch of programs concurrently.
+
+    Each command is an argument list or a shell command string, as given to
+    run_program. Returns the list of (rc, output, error) tuples in the same
+    order as the commands. In fail fast mode, no more commands are started
+    after a command fails; the results of the commands not started are None.
+    """
+    if fail_fast:
+        stop = lambda result: result[0] != 0
+    else:
+        stop = None
+    return parallel_map(run_program, commands, limit=limit, stop=stop)
@@ -22,7 +22,7 @@
 import sys
 import os
 import re
-import subprocess
+from OpenAFSLibrary.util import sudo
 
 
 def create_fake_partition(id):
@@ -34,11 +34,6 @@ def create_fake_partition(id):
         if not os.path.isdir(path):
             raise AssertionError("File %s is in the way!" % path)
         return
-    rc = subprocess.call(['sudo', '-n', 'mkdir', path])
-    if rc:
-        raise OSError(rc, "Failed to make directory.", path)
-    aa = "/".join([path, "AlwaysAttach"])
-    rc = subprocess.call(['sudo', '-n', 'touch', aa])
-    if rc:
-        raise OSError(rc, "Failed to create file.", aa)
+    sudo('mkdir', path)
+    sudo('touch', "/".join([path, "AlwaysAttach"]))
 
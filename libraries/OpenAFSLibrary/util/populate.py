@@ -0,0 +1,513 @@
+# Copyright (c) 2015 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+"""Create large numbers of test files quickly.
+
+The files are created by a pool of worker threads (the file system calls
+release the interpreter lock). The file contents are one of:
+
+    write      zeros written from one preallocated buffer
+    sparse     ftruncate to the size, no data is written
+    fallocate  posix_fallocate the blocks, no data is written
+    clone      a copy of a template file, with copy_file_range or
+               sendfile when available, otherwise read and write
+    pattern    seeded content which can be verified later, see content.py
+
+posix_fallocate, sendfile and copy_file_range are not in the python 2
+os module, so they are called from libc with ctypes.
+"""
+
+import os
+import re
+import sys
+import math
+import time
+import errno
+import random
+import ctypes
+from OpenAFSLibrary.util import libc_function
+from OpenAFSLibrary.util.parallel import parallel_map
+from OpenAFSLibrary.util.content import ContentGenerator,MANIFEST,read_manifest,update_manifest
+
+BLOCK_SIZE = 1024 * 1024
+CHUNK_SIZE = 256   # files per work item
+MODES = ('write', 'sparse', 'fallocate', 'clone', 'pattern')
+
+_off_p = ctypes.POINTER(ctypes.c_int64)
+_posix_fallocate = libc_function('posix_fallocate64', ctypes.c_int,
+                        [ctypes.c_int, ctypes.c_int64, ctypes.c_int64])
+_sendfile = libc_function('sendfile64', ctypes.c_ssize_t,
+                        [ctypes.c_int, ctypes.c_int, _off_p, ctypes.c_size_t])
+_copy_file_range = libc_function('copy_file_range', ctypes.c_ssize_t,
+                        [ctypes.c_int, _off_p, ctypes.c_int, _off_p, ctypes.c_size_t, ctypes.c_uint])
+
+# Errors which mean the call can not be used for these files.
+_UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+
+def fallocate(fd, size):
+    """Allocate the blocks of a file without writing them."""
+    if _posix_fallocate is None:
+        raise OSError(errno.ENOSYS, "posix_fallocate is not available")
+    rc = _posix_fallocate(fd, 0, size)
+    if rc:
+        raise OSError(rc, os.strerror(rc))
+
+def _kernel_copy(func, src, dst, size):
+    """Copy with copy_file_range or sendfile. Returns the bytes copied."""
+    offset = ctypes.c_int64(0)
+    done = 0
+    while done < size:
+        if func is _copy_file_range:
+            n = func(src, ctypes.byref(offset), dst, None, size - done, 0)
+        else:
+            n = func(dst, src, ctypes.byref(offset), size - done)
+        if n < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        if n == 0:
+            break
+        done += n
+    return done
+
+def parse_size(value):
+    """Returns the number of bytes of a size like '512', '64k', '1m' or '2g'."""
+    if isinstance(value, (int, long)):
+        return value
+    m = re.match(r'^\s*(\d+)\s*([kmg]?)i?b?\s*$', str(value), re.I)
+    if not m:
+        raise ValueError("Invalid size: %s" % (value))
+    return int(m.group(1)) * {'': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3}[m.group(2).lower()]
+
+class SizeDistribution(object):
+    """File sizes drawn from a distribution.
+
+    The spec is one of:
+
+        <size>                  every file has the same size
+        uniform:<min>:<max>     sizes evenly spread between min and max
+        exp:<mean>              exponentially distributed sizes
+        <size>*<weight>,...     a weighted choice, e.g. 4k*70,64k*20,1m*10
+
+    The sizes are drawn from a seeded generator, so the same spec and seed
+    give the same files.
+    """
+
+    def __init__(self, spec, seed=0):
+        self.spec = str(spec).strip()
+        self.seed = int(seed)
+        parts = self.spec.split(':')
+        if parts[0] == 'uniform' and len(parts) == 3:
+            low,high = parse_size(parts[1]), parse_size(parts[2])
+            self.draw = lambda r: r.randint(low, high)
+        elif parts[0] == 'exp' and len(parts) == 2:
+            mean = float(parse_size(parts[1]))
+            self.draw = lambda r: int(r.expovariate(1.0 / mean)) if mean else 0
+        elif len(parts) == 1:
+            choices = []
+            for item in self.spec.split(','):
+                if '*' in item:
+                    size,weight = item.split('*', 1)
+                else:
+                    size,weight = item, 1
+                choices.append((parse_size(size), int(weight)))
+            if len(choices) == 1:
+                self.draw = lambda r: choices[0][0]
+            else:
+                self.draw = lambda r: self._weighted(r, choices)
+        else:
+            raise ValueError("Invalid size distribution: %s" % (self.spec))
+
+    def _weighted(self, r, choices):
+        n = r.randint(1, sum([w for s,w in choices]))
+        for size,weight in choices:
+            n -= weight
+            if n <= 0:
+                return size
+        return choices[-1][0]
+
+    def sizes(self, count):
+        r = random.Random(self.seed)
+        return [self.draw(r) for i in xrange(0, count)]
+
+def file_names(count, per_directory=0):
+    """Returns the list of relative file names of a population.
+
+    The names are fixed width numbers. When per_directory is given, the
+    files are spread over numbered subdirectories of that many files each.
+    """
+    if count <= 0:
+        return []
+    fmt = "%%0%dd" % (int(math.log10(float(count))) + 1)
+    if not per_directory:
+        return [fmt % (i) for i in xrange(0, count)]
+    per_directory = int(per_directory)
+    dfmt = "d%%0%dd" % (len(str(max((count - 1) // per_directory, 0))))
+    return [os.path.join(dfmt % (i // per_directory), fmt % (i)) for i in xrange(0, count)]
+
+class FilePopulator(object):
+    """Create the files of a population with a pool of workers."""
+
+    def __init__(self, mode='write', template=None, block_size=BLOCK_SIZE, seed=0):
+        if mode not in MODES:
+            raise ValueError("Invalid mode '%s'; expected one of %s" % (mode, ", ".join(MODES)))
+        if mode == 'clone' and not template:
+            raise ValueError("A template file is required to clone.")
+        self.mode = mode
+        self.template = template
+        self.block = '\0' * int(block_size)  # shared by the workers; never changed
+        self.copiers = [f for f in (_copy_file_range, _sendfile) if f is not None]
+        self.template_size = os.path.getsize(template) if template else 0
+        self.generator = ContentGenerator(seed) if mode == 'pattern' else None
+
+    def _write(self, fd, size):
+        block = self.block
+        left = size
+        while left > 0:
+            n = os.write(fd, buffer(block, 0, min(left, len(block))))
+            left -= n
+
+    def _clone(self, fd, size):
+        """Copy the template into the file. The kernel copy functions are
+        dropped on the first failure. The list is shared by the workers, so
+        a copy of it is used."""
+        src = os.open(self.template, os.O_RDONLY)
+        try:
+            for func in list(self.copiers):
+                try:
+                    done = _kernel_copy(func, src, fd, size)
+                    if done == size:
+                        return
+                    raise OSError(errno.EIO, "Short copy of template '%s'" % (self.template))
+                except OSError as e:
+                    if e.errno not in _UNSUPPORTED:
+                        raise
+                    try:
+                        self.copiers.remove(func)
+                    except ValueError:
+                        pass  # removed by another worker
+                    os.ftruncate(fd, 0)  # start over
+                    os.lseek(fd, 0, os.SEEK_SET)
+            while True:
+                data = os.read(src, len(self.block))
+                if not data:
+                    break
+                while data:
+                    n = os.write(fd, data)
+                    data = data[n:]
+        finally:
+            os.close(src)
+
+    def create(self, path, size, name=None):
+        """Create one file. Fails if the file already exists.
+
+        The pattern content is generated for the name, the path relative
+        to the top of the population.
+        """
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0777)
+        try:
+            if self.mode == 'write':
+                self._write(fd, size)
+            elif self.mode == 'sparse':
+                os.ftruncate(fd, size)
+            elif self.mode == 'fallocate':
+                if size:
+                    fallocate(fd, size)
+            elif self.mode == 'pattern':
+                self.generator.write(fd, name or os.path.basename(path), size)
+            else:
+                self._clone(fd, size)
+        finally:
+            os.close(fd)
+
+    def _create_chunk(self, chunk):
+        path,directory,files = chunk
+        if not os.path.isdir(directory):
+            try:
+                os.mkdir(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        total = 0
+        for name,size in files:
+            self.create(os.path.join(path, name), size, name)
+            total += size
+        return total
+
+    def populate(self, path, count, sizes=None, per_directory=0, workers=1):
+        """Create count files under path. Returns a dict of statistics.
+
+        The sizes are a list of the file sizes, in the order of the names;
+        the template size is used when cloning.
+        """
+        names = file_names(count, per_directory)
+        if self.mode == 'clone':
+            sizes = [self.template_size] * count
+        elif sizes is None:
+            sizes = [0] * count
+        chunks = []
+        current = None
+        for name,size in zip(names, sizes):
+            directory = os.path.join(path, os.path.dirname(name))
+            if current is None or current[1] != directory or len(current[2]) >= CHUNK_SIZE:
+                current = (path, directory, [])
+                chunks.append(current)
+            current[2].append((name, size))
+        start = time.time()
+        written = parallel_map(self._create_chunk, chunks, limit=workers)
+        if self.mode == 'pattern':
+            update_manifest(path, dict(zip(names, sizes)))
+        return stats(count, sum(written), time.time() - start)
+
+def _fan_out(func, items, workers):
+    """Apply func to the items in parallel. Returns (count, seconds)."""
+    start = time.time()
+    parallel_map(func, items, limit=workers)
+    return len(items), time.time() - start
+
+def rate(count, seconds):
+    """Returns the rate of a phase of count operations."""
+    seconds = max(seconds, 1e-6)
+    return {'count': count, 'seconds': seconds, 'per_sec': count / seconds}
+
+def tree_directories(path, depth, breadth):
+    """Returns the directories of a tree by level, the top one first."""
+    levels = [[path]]
+    for level in xrange(0, int(depth)):
+        levels.append([os.path.join(parent, "d%d" % (i))
+                       for parent in levels[-1] for i in xrange(0, int(breadth))])
+    return levels
+
+def populate_tree(path, depth, breadth, files, size=0, workers=1, populator=None):
+    """Create a tree of directories, each with a number of files.
+
+    The directories are created level by level, and the files of all the
+    directories after that. Returns the mkdir and create phase rates.
+    """
+    if populator is None:
+        populator = FilePopulator()
+    levels = tree_directories(path, depth, breadth)
+    result = {}
+    count,seconds = 0, 0.0
+    for level in levels:
+        n,t = _fan_out(os.mkdir, level, workers)
+        count,seconds = count + n, seconds + t
+    result['mkdir'] = rate(count, seconds)
+    names = file_names(int(files))
+    def create(directory):
+        for name in names:
+            filename = os.path.join(directory, name)
+            populator.create(filename, size, os.path.relpath(filename, path))
+    directories = [d for level in levels for d in level]
+    n,t = _fan_out(create, directories, workers)
+    result['create'] = rate(n * len(names), t)
+    if populator.mode == 'pattern':
+        update_manifest(path, dict([(os.path.relpath(os.path.join(d, name), path), size)
+                                    for d in directories for name in names]))
+    return result
+
+def remove_tree(path, workers=1):
+    """Remove a tree: the files of all the directories in parallel, then
+    the directories from the bottom up, each level in parallel. Returns
+    the scan, unlink and rmdir phase rates."""
+    result = {}
+    start = time.time()
+    levels = []
+    files = []
+    top = path.rstrip(os.sep).count(os.sep)
+    for directory,subdirs,names in os.walk(path):
+        level = directory.count(os.sep) - top
+        while len(levels) <= level:
+            levels.append([])
+        levels[level].append(directory)
+        for name in subdirs:
+            if os.path.islink(os.path.join(directory, name)):
+                files.append(os.path.join(directory, name))  # not followed by walk
+        files.extend([os.path.join(directory, name) for name in names])
+    result['scan'] = rate(sum([len(l) for l in levels]), time.time() - start)
+    # Unlink in batches, to keep the work items big enough.
+    batches = [files[i:i + CHUNK_SIZE] for i in xrange(0, len(files), CHUNK_SIZE)]
+    def unlink(batch):
+        for name in batch:
+            os.unlink(name)
+    n,t = _fan_out(unlink, batches, workers)
+    result['unlink'] = rate(len(files), t)
+    count,seconds = 0, 0.0
+    for level in reversed(levels):
+        n,t = _fan_out(os.rmdir, level, workers)
+        count,seconds = count + n, seconds + t
+    result['rmdir'] = rate(count, seconds)
+    return result
+
+def format_rates(result):
+    return ", ".join(["%s %d in %.3f s (%.0f/s)" % (phase, r['count'], r['seconds'], r['per_sec'])
+                      for phase,r in sorted(result.items())])
+
+def stats(count, size, seconds):
+    """Returns the rates of an operation on count files of size bytes."""
+    seconds = max(seconds, 1e-6)
+    return {
+        'files': count,
+        'bytes': size,
+        'seconds': seconds,
+        'files_per_sec': count / seconds,
+        'mb_per_sec': size / seconds / (1024 * 1024),
+    }
+
+def format_stats(what, s):
+    return "%s %d files, %.1f MB in %.3f seconds: %.0f files/s, %.1f MB/s" % \
+        (what, s['files'], s['bytes'] / (1024.0 * 1024), s['seconds'],
+         s['files_per_sec'], s['mb_per_sec'])
+
+#
+# Unit tests
+#
+def _check(path, names, sizes):
+    for name,size in zip(names, sizes):
+        st = os.stat(os.path.join(path, name))
+        assert st.st_size == size, (name, st.st_size, size)
+
+def _test1():
+    assert parse_size("64k") == 65536
+    assert parse_size("1MiB") == 1024**2
+    assert parse_size(12) == 12
+    assert file_names(3) == ["0", "1", "2"]
+    assert file_names(10)[9] == "09"
+    assert file_names(0) == []
+    assert file_names(12, 5)[:2] == ["d0/00", "d0/01"]
+    assert file_names(12, 5)[11] == "d2/11"
+    d = SizeDistribution("4k*70,64k*20,1m*10", seed=1)
+    sizes = d.sizes(1000)
+    assert sizes == SizeDistribution("4k*70,64k*20,1m*10", seed=1).sizes(1000)
+    assert set(sizes) == set([4096, 65536, 1024**2])
+    assert 600 < sizes.count(4096) < 800
+    sizes = SizeDistribution("uniform:1k:2k", seed=2).sizes(100)
+    assert min(sizes) >= 1024 and max(sizes) <= 2048
+    assert SizeDistribution("100").sizes(2) == [100, 100]
+    SizeDistribution("exp:8k").sizes(10)
+    for bad in ("uniform:1", "x:1:2:3", "12q"):
+        try:
+            SizeDistribution(bad)
+            assert False, "no error for %s" % (bad)
+        except ValueError:
+            pass
+
+def _test2():
+    import tempfile, shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        count = 600
+        sizes = SizeDistribution("uniform:0:20000", seed=3).sizes(count)
+        names = file_names(count, 100)
+        for mode in ('write', 'sparse', 'fallocate', 'pattern'):
+            path = os.path.join(tmpdir, mode)
+            os.mkdir(path)
+            s = FilePopulator(mode, block_size=4096, seed=5).populate(path, count, sizes, 100, workers=4)
+            assert s['files'] == count and s['bytes'] == sum(sizes)
+            _check(path, names, sizes)
+            assert len([n for n in os.listdir(path) if n != MANIFEST]) == 6
+        assert read_manifest(os.path.join(tmpdir, "pattern")) == dict(zip(names, sizes))
+        assert read_manifest(os.path.join(tmpdir, "write")) is None
+        data = open(os.path.join(tmpdir, "write", names[1])).read()
+        assert data == '\0' * sizes[1]
+        data = open(os.path.join(tmpdir, "pattern", names[1])).read()
+        assert data == ContentGenerator(5).generate(names[1], 0, sizes[1])
+        # Clone a template, with each of the available copy methods.
+        template = os.path.join(tmpdir, "template")
+        content = "".join([chr(i % 251) for i in xrange(0, 100000)])
+        f = open(template, "w")
+        f.write(content)
+        f.close()
+        for copiers in ([_copy_file_range], [_sendfile], []):
+            path = os.path.join(tmpdir, "clone%d" % len(os.listdir(tmpdir)))
+            os.mkdir(path)
+            p = FilePopulator('clone', template=template)
+            p.copiers = [c for c in copiers if c is not None]
+            p.populate(path, 20, workers=2)
+            for name in file_names(20):
+                assert open(os.path.join(path, name)).read() == content
+        # A copy function dropped by another worker during a copy.
+        def unsupported(*args):
+            del p.copiers[:]
+            ctypes.set_errno(errno.EINVAL)
+            return -1
+        p = FilePopulator('clone', template=template)
+        p.copiers = [unsupported, unsupported]
+        path = os.path.join(tmpdir, "clone-dropped")
+        os.mkdir(path)
+        p.populate(path, 2)
+        assert open(os.path.join(path, file_names(2)[0])).read() == content
+        # Existing files are not replaced.
+        try:
+            FilePopulator().populate(os.path.join(tmpdir, "write"), count, sizes, 100)
+            assert False, "no error for existing files"
+        except OSError as e:
+            assert e.errno == errno.EEXIST
+    finally:
+        shutil.rmtree(tmpdir)
+
+def _test3():
+    import tempfile, shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "tree")
+        levels = tree_directories(path, 2, 3)
+        assert [len(l) for l in levels] == [1, 3, 9]
+        result = populate_tree(path, 2, 3, 5, size=10, workers=4)
+        assert result['mkdir']['count'] == 13
+        assert result['create']['count'] == 65
+        assert os.path.getsize(os.path.join(path, "d2", "d1", "4")) == 10
+        os.symlink("/", os.path.join(path, "d0", "link"))
+        try:
+            populate_tree(path, 2, 3, 5)
+            assert False, "no error for existing tree"
+        except OSError as e:
+            assert e.errno == errno.EEXIST
+        result = remove_tree(path, workers=4)
+        assert result['unlink']['count'] == 66
+        assert result['rmdir']['count'] == 13
+        assert os.listdir(tmpdir) == []
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench(count=20000, size="4k", workers=8):
+    import tempfile, shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        sizes = SizeDistribution(size).sizes(count)
+        for mode in ('write', 'sparse', 'fallocate'):
+            path = os.path.join(tmpdir, mode)
+            os.mkdir(path)
+            s = FilePopulator(mode).populate(path, count, sizes, per_directory=1000, workers=workers)
+            print format_stats("%-9s" % mode, s)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def main(args):
+    if args and args[0] == "--bench":
+        bench(*[int(a) for a in args[1:2]])
+        return
+    _test1()
+    _test2()
+    _test3()
+
+if __name__ == "__main__":
+    # usage: python -m OpenAFSLibrary.util.populate [--bench [<count>]]
+    main(sys.argv[1:])
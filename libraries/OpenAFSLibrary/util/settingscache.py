@@ -0,0 +1,107 @@
+# Copyright (c) 2015 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+import os
+import imp
+import time
+import threading
+
+class SettingsCache(object):
+    """Setting values resolved from settings.py and the dist defaults.
+
+    The files are loaded once and the resolved values are kept in a
+    dictionary. The files are checked for changes (by modification time and
+    size) at most once per check interval. Call refresh() after writing
+    the settings file to see the new values immediately.
+    """
+
+    def __init__(self, root, dist, interval=1.0):
+        self.root = root
+        self.dist = dist
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """Discard the cached values."""
+        self.values = None
+        self.signature = None
+        self.checked = 0
+
+    def _settings_py(self):
+        return os.path.join(self.root, 'settings.py')
+
+    def _dist_py(self, dist):
+        return os.path.join(self.dist, "%s.py" % dist)
+
+    def _signature(self, paths):
+        """Returns the modification times and sizes of the files."""
+        signature = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                signature.append((path, st.st_mtime, st.st_size))
+            except OSError:
+                signature.append((path, None, None))
+        return tuple(signature)
+
+    def _load(self):
+        """Load the settings files and resolve the values."""
+        settings_py = self._settings_py()
+        if not os.path.isfile(settings_py):
+            raise AssertionError("Cannot find settings.py file! path=%s" % settings_py)
+        settings = imp.load_source('settings', settings_py)
+        dist_py = self._dist_py(getattr(settings, 'AFS_DIST', None))
+        if not os.path.isfile(dist_py):
+            raise AssertionError("Cannot find dist.py file! path=%s" % dist_py)
+        dist = imp.load_source('settings.dist', dist_py)
+        values = {}
+        for module in (dist, settings):
+            for name in dir(module):
+                if name.startswith('_'):
+                    continue
+                value = getattr(module, name)
+                if value is not None:
+                    values[name] = value
+        self.values = values
+        self.signature = self._signature([settings_py, dist_py])
+
+    def _check(self):
+        """Returns the values, reloaded if the files were changed."""
+        now = time.time()
+        values = self.values
+        if values is not None and now - self.checked < self.interval:
+            return values
+        self.lock.acquire()
+        try:
+            if self.values is None or \
+                    self._signature([s[0] for s in self.signature]) != self.signature:
+                self._load()
+            self.checked = now
+            return self.values
+        finally:
+            self.lock.release()
+
+    def get(self, name):
+        """Return the setting value or None if it is not set."""
+        if name == 'SITE':
+            return os.path.join(self.root, 'site')  # does not need settings.py
+        return self._check().get(name)
@@ -32,6 +32,7 @@ import traceback
 from OpenAFSLibrary.util.download import download
 from OpenAFSLibrary.util.partition import create_fake_partition
 from OpenAFSLibrary import OpenAFSLibrary
+from OpenAFSLibrary.util import refresh_settings
 
 try:
     import settings as old_settings
@@ -177,6 +178,7 @@ class Settings:
             setting.emit(f)
         f.close()
         self.saved = True
+        refresh_settings()
 
 class SetupShell(cmd.Cmd):
     """Console interface to setup the OpenAFS Robotest harness."""
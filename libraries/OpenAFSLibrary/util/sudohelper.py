@@ -0,0 +1,90 @@
+# Copyright (c) 2015 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+"""Client for the long running afs-robotest-sudo helper.
+
+The helper is started once with sudo and then runs the permitted
+commands sent to it over a unix socket, which saves starting sudo and
+a new python interpreter for each privileged command. The helper
+enforces the same command policy as afs-robotest-sudo.
+"""
+
+import os
+import json
+import socket
+import subprocess
+import collections
+
+class SudoHelper(object):
+    """Run permitted commands as root with the afs-robotest-sudo helper."""
+
+    def __init__(self, wrapper):
+        self.wrapper = wrapper
+        self.proc = None
+        self.path = None
+
+    def start(self):
+        """Start the helper process with sudo."""
+        # The helper creates the socket in a directory owned by root and
+        # reports the path; only the current user can reach the socket.
+        self.proc = subprocess.Popen(['sudo', '-n', self.wrapper, '--serve'],
+                        close_fds=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        ready = self.proc.stdout.readline().split()
+        if len(ready) != 2 or ready[0] != "ready":
+            self.stop()
+            raise AssertionError("Failed to start the sudo helper.")
+        self.path = ready[1]
+
+    def stop(self):
+        """Stop the helper process."""
+        if self.proc is not None:
+            self.proc.stdin.close()  # the helper exits at end of file
+            self.proc.wait()
+            self.proc = None
+        self.path = None
+
+    def is_running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def run(self, args, tail=100):
+        """Run a command as root.
+
+        Returns the exit code and the last lines of output. The exit codes
+        are the same as for the afs-robotest-sudo command line.
+        """
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(self.path)
+        reader = conn.makefile('rb')
+        output = collections.deque(maxlen=tail)
+        try:
+            conn.sendall(json.dumps(list(args)) + "\n")
+            while True:
+                header = reader.readline()
+                if not header:
+                    raise AssertionError("Lost connection to the sudo helper.")
+                kind,value = header.split()
+                if kind == 'X':
+                    return (int(value), "".join(output))
+                data = reader.read(int(value))
+                output.extend(data.splitlines(True))
+        finally:
+            reader.close()
+            conn.close()